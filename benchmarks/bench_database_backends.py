@@ -0,0 +1,110 @@
+"""Benchmark of the storage backends per handled update
+
+Replays the Database calls made by bot.py for a text message and for /mode (as
+bench_database_bytes.py does) against each backend and reports the median time
+per update. memory:// and SQLite (in a temporary directory) always run, MongoDB
+runs if MONGO_CONNECT_STRING is set in config/config.env; its benchmark
+database is dropped afterwards.
+
+Usage:
+    python3 benchmarks/bench_database_backends.py [--n-repeats 200]
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import config
+import database
+
+
+DATABASE_NAME = "chatgpt_telegram_bot_benchmark"
+USER_ID = 1
+DIALOG_SIZES = [0, 10, 50, 200]
+
+
+def setup_user(db, n_dialog_messages):
+    db.add_new_user(USER_ID, USER_ID, username="benchmark")
+    db.start_new_dialog(USER_ID)
+
+    dialog_messages = [
+        {"user": "How do I reverse a list in Python? " * 5, "bot": "Use reversed() or slicing. " * 30, "date": datetime.now()}
+        for _ in range(n_dialog_messages)
+    ]
+    db.set_dialog_messages(USER_ID, dialog_messages)
+
+
+def handle_text_message(db):
+    # register_user_if_not_exists
+    db.check_if_user_exists(USER_ID)
+    db.get_user_attributes(USER_ID, ["current_dialog_id", "current_model", "n_used_tokens", "n_transcribed_seconds", "n_generated_images", "chat_modes", "current_chat_mode_index"])
+
+    # message_handle
+    user_dict = db.get_user_attributes(USER_ID, ["current_chat_mode", "current_chat_mode_index"])
+    db.get_last_interaction(USER_ID)
+    db.get_dialog_messages(USER_ID, last_n=1)
+    db.set_last_interaction(USER_ID, datetime.now())
+    db.get_user_attributes(USER_ID, ["current_model", "current_dialog_id"])
+    db.get_dialog_messages(USER_ID)
+    db.get_chat_modes(USER_ID)[user_dict["current_chat_mode_index"]]
+
+    # saving the answer
+    db.push_dialog_message(USER_ID, {"user": "question", "bot": "answer", "date": datetime.now()})
+    db.update_n_used_tokens(USER_ID, "gpt-3.5-turbo", 100, 100)
+
+    db.pop_dialog_message(USER_ID)  # keep dialog size constant between repeats
+
+
+def handle_mode_command(db):
+    db.check_if_user_exists(USER_ID)
+    db.get_user_attributes(USER_ID, ["current_dialog_id", "current_model", "n_used_tokens", "n_transcribed_seconds", "n_generated_images", "chat_modes", "current_chat_mode_index"])
+    db.set_last_interaction(USER_ID, datetime.now())
+    db.get_user_attributes(USER_ID, ["current_chat_mode", "chat_modes_version"])
+    db.get_chat_modes(USER_ID)
+
+
+def measure(fn, db, n_repeats):
+    fn(db)  # warm-up
+
+    timings = []
+    for _ in range(n_repeats):
+        t = time.perf_counter()
+        fn(db)
+        timings.append(time.perf_counter() - t)
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        uris = ["memory://", f"sqlite:///{tmp_dir}"]
+        if config.mongodb_uri is not None:
+            uris.append(config.mongodb_uri)
+
+        print(f"{'backend':<10} {'update':<14} {'dialog':>7} {'ms':>8}")
+        for uri in uris:
+            backend = database.get_backend(uri)
+            for n_dialog_messages in DIALOG_SIZES:
+                db = database.open_database(database_name=f"{DATABASE_NAME}_{n_dialog_messages}", uri=uri)
+                try:
+                    setup_user(db, n_dialog_messages)
+                    for name, fn in [("text message", handle_text_message), ("/mode", handle_mode_command)]:
+                        t = measure(fn, db, args.n_repeats)
+                        print(f"{backend:<10} {name:<14} {n_dialog_messages:>7} {1000 * t:>8.3f}")
+                finally:
+                    if backend.startswith("mongodb"):
+                        db.client.drop_database(db.db.name)
+
+
+if __name__ == "__main__":
+    main()
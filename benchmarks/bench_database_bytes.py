@@ -0,0 +1,194 @@
+"""Benchmark of bytes transferred between the bot and MongoDB per handled update
+
+Replays the Database calls made by bot.py for a text message (register user, timeout
+check, prompt building, saving the answer) and for /mode, and counts request and reply
+bytes with pymongo command monitoring. A "legacy" variant replays the same update with
+whole-document reads, as Database did before projections were used.
+
+last_interaction writes are buffered and flushed in bulk for all users, so they are
+not counted per update.
+
+Needs a running MongoDB (MONGO_CONNECT_STRING in config/config.env). Writes go to a
+separate "chatgpt_telegram_bot_benchmark" database, which is dropped afterwards.
+
+Usage:
+    python3 benchmarks/bench_database_bytes.py
+"""
+
+import sys
+from pathlib import Path
+from datetime import datetime
+
+import bson
+from pymongo import monitoring
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import config
+
+
+DATABASE_NAME = "chatgpt_telegram_bot_benchmark"
+USER_ID = 1
+DIALOG_SIZES = [0, 10, 50, 200]
+N_CUSTOM_CHAT_MODES = [0, 10]
+
+
+class ByteCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n_commands = 0
+        self.n_request_bytes = 0
+        self.n_reply_bytes = 0
+
+    def started(self, event):
+        self.n_commands += 1
+        self.n_request_bytes += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        self.n_reply_bytes += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+
+byte_counter = ByteCounter()
+monitoring.register(byte_counter)
+
+from mongo_database import MongoDatabase  # noqa: E402 (listener has to be registered before the client is created)
+
+
+def setup_user(db, n_dialog_messages, n_custom_chat_modes):
+    db.user_collection.delete_many({})
+    db.dialog_collection.delete_many({})
+
+    db.add_new_user(USER_ID, USER_ID, username="benchmark")
+    db.start_new_dialog(USER_ID)
+
+    custom_chat_modes = [
+        {"name": f"Custom {i}", "welcome_message": f"Hi, I'm Custom {i}", "prompt_start": "You are a helpful assistant. " * 40, "parse_mode": "html"}
+        for i in range(n_custom_chat_modes)
+    ]
+    db.set_chat_modes(USER_ID, db.get_chat_modes(USER_ID) + custom_chat_modes)
+
+    dialog_messages = [
+        {"user": "How do I reverse a list in Python? " * 5, "bot": "Use reversed() or slicing. " * 30, "date": datetime.now()}
+        for _ in range(n_dialog_messages)
+    ]
+    db.set_dialog_messages(USER_ID, dialog_messages)
+
+
+def handle_text_message(db):
+    # register_user_if_not_exists
+    db.check_if_user_exists(USER_ID)
+    db.get_user_attributes(USER_ID, ["current_dialog_id", "current_model", "n_used_tokens", "n_transcribed_seconds", "n_generated_images", "chat_modes", "current_chat_mode_index"])
+
+    # message_handle
+    user_dict = db.get_user_attributes(USER_ID, ["current_chat_mode", "current_chat_mode_index"])
+    db.get_last_interaction(USER_ID)
+    db.get_dialog_messages(USER_ID, last_n=1)
+    db.set_last_interaction(USER_ID, datetime.now())
+    db.get_user_attribute(USER_ID, "current_model")
+    db.get_dialog_messages(USER_ID)
+    db.get_chat_modes(USER_ID)[user_dict["current_chat_mode_index"]]
+    db.get_chat_modes(USER_ID)[user_dict["current_chat_mode_index"]]
+
+    # saving the answer
+    db.push_dialog_message(USER_ID, {"user": "question", "bot": "answer", "date": datetime.now()})
+    db.update_n_used_tokens(USER_ID, "gpt-3.5-turbo", 100, 100)
+
+    db.pop_dialog_message(USER_ID)  # keep dialog size constant between repeats
+
+
+def handle_text_message_legacy(db):
+    def get_user_attribute(key):
+        db.user_collection.count_documents({"_id": USER_ID})
+        return db.user_collection.find_one({"_id": USER_ID}).get(key)
+
+    def get_dialog_messages():
+        dialog_id = get_user_attribute("current_dialog_id")
+        db.user_collection.count_documents({"_id": USER_ID})
+        return db.dialog_collection.find_one({"_id": dialog_id, "user_id": USER_ID})["messages"]
+
+    def set_user_attribute(key, value):
+        db.user_collection.count_documents({"_id": USER_ID})
+        db.user_collection.update_one({"_id": USER_ID}, {"$set": {key: value}})
+
+    def set_dialog_messages(dialog_messages):
+        dialog_id = get_user_attribute("current_dialog_id")
+        db.user_collection.count_documents({"_id": USER_ID})
+        db.dialog_collection.update_one({"_id": dialog_id, "user_id": USER_ID}, {"$set": {"messages": dialog_messages}})
+
+    # register_user_if_not_exists
+    db.user_collection.count_documents({"_id": USER_ID})
+    for key in ["current_dialog_id", "current_model", "n_used_tokens", "n_transcribed_seconds", "n_generated_images", "chat_modes", "current_chat_mode_index"]:
+        get_user_attribute(key)
+
+    # message_handle
+    get_user_attribute("current_chat_mode")
+    get_user_attribute("current_chat_mode_index")
+    get_user_attribute("last_interaction")
+    get_dialog_messages()
+    set_user_attribute("last_interaction", datetime.now())
+    get_user_attribute("current_model")
+    dialog_messages = get_dialog_messages()
+    get_user_attribute("chat_modes")
+    get_user_attribute("chat_modes")
+
+    # saving the answer
+    set_dialog_messages(get_dialog_messages() + [{"user": "question", "bot": "answer", "date": datetime.now()}])
+    n_used_tokens = get_user_attribute("n_used_tokens")
+    set_user_attribute("n_used_tokens", n_used_tokens)
+
+    set_dialog_messages(dialog_messages)  # keep dialog size constant between repeats
+
+
+def handle_mode_command(db):
+    db.check_if_user_exists(USER_ID)
+    db.get_user_attributes(USER_ID, ["current_dialog_id", "current_model", "n_used_tokens", "n_transcribed_seconds", "n_generated_images", "chat_modes", "current_chat_mode_index"])
+    db.set_last_interaction(USER_ID, datetime.now())
+    db.get_user_attributes(USER_ID, ["current_chat_mode", "chat_modes_version"])
+    db.get_chat_modes(USER_ID)
+
+
+def measure(fn, db, n_repeats=5):
+    fn(db)  # warm-up
+
+    byte_counter.reset()
+    for _ in range(n_repeats):
+        fn(db)
+
+    return (
+        byte_counter.n_commands / n_repeats,
+        byte_counter.n_request_bytes / n_repeats,
+        byte_counter.n_reply_bytes / n_repeats
+    )
+
+
+def main():
+    if config.mongodb_uri is None:
+        print("MONGO_CONNECT_STRING is not set")
+        sys.exit(1)
+
+    db = MongoDatabase(database_name=DATABASE_NAME, uri=config.mongodb_uri)
+
+    print(f"{'update':<24} {'dialog':>7} {'custom modes':>13} {'commands':>9} {'sent, B':>10} {'received, B':>12}")
+    try:
+        for n_custom_chat_modes in N_CUSTOM_CHAT_MODES:
+            for n_dialog_messages in DIALOG_SIZES:
+                setup_user(db, n_dialog_messages, n_custom_chat_modes)
+
+                for name, fn in [
+                    ("text message", handle_text_message),
+                    ("text message (legacy)", handle_text_message_legacy),
+                    ("/mode", handle_mode_command),
+                ]:
+                    n_commands, n_request_bytes, n_reply_bytes = measure(fn, db)
+                    print(f"{name:<24} {n_dialog_messages:>7} {n_custom_chat_modes:>13} {n_commands:>9.0f} {n_request_bytes:>10.0f} {n_reply_bytes:>12.0f}")
+    finally:
+        db.client.drop_database(DATABASE_NAME)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Micro-benchmarks for prompt building and token counting in bot/openai_utils.py
+
+Usage:
+    python3 benchmarks/bench_openai_utils.py                  # run and print results
+    python3 benchmarks/bench_openai_utils.py --save-baseline  # run and save results as baseline
+    python3 benchmarks/bench_openai_utils.py --compare        # run and compare with saved baseline (exit 1 on regression)
+
+The baseline is committed in benchmarks/baselines/openai_utils.json, with the
+Python version and platform it was recorded on; re-record it on the machine you
+compare on. Token counting needs tiktoken and its encodings, which are read from
+TIKTOKEN_CACHE_DIR (see config.tiktoken_cache_dir and the Dockerfile) or
+downloaded. If they can't be loaded, e.g. offline with an empty cache, the
+_count_tokens_* cases are skipped with a message and listed as "skipped" in a
+saved baseline; prompt building is still measured.
+"""
+
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import config
+import openai_utils
+
+
+BASELINE_PATH = Path(__file__).parent.resolve() / "baselines" / "openai_utils.json"
+
+DIALOG_SIZES = [0, 1, 5, 20, 50, 100, 200]
+CHAT_MODES_DIALOG_SIZE = 20
+DEFAULT_CHAT_MODE = "assistant"
+
+TOKENIZER_MODELS = ["gpt-3.5-turbo", "text-davinci-003"]
+TOKEN_COUNTING_CASES = ("_count_tokens_from_messages", "_count_tokens_from_prompt")
+
+MAX_TIME_RATIO = 1.25
+MAX_MEMORY_RATIO = 1.10
+
+USER_MESSAGE = "Could you explain how Python generators work and when I should prefer them over lists?"
+BOT_ANSWER = (
+    "Generators produce values lazily, one at a time, instead of building the whole sequence in memory. "
+    "They are a good fit for large or infinite streams, pipelines and anything you only iterate over once."
+)
+CODE_BLOCK = "```python\n" + "\n".join(
+    f"def handler_{i}(update, context):\n"
+    f"    user_id = update.message.from_user.id\n"
+    f"    return {{'id': user_id, 'step': {i}, 'text': update.message.text.strip()}}\n"
+    for i in range(40)
+) + "```"
+
+
+def make_dialog_messages(n_turns, with_code=False):
+    dialog_messages = []
+    for i in range(n_turns):
+        bot_answer = f"{BOT_ANSWER} ({i})"
+        if with_code:
+            bot_answer += "\n\n" + CODE_BLOCK
+
+        dialog_messages.append({"user": f"{USER_MESSAGE} ({i})", "bot": bot_answer})
+
+    return dialog_messages
+
+
+def measure(fn, n_repeats=5):
+    # time: best of n_repeats, each over an auto-ranged number of loops
+    timer = timeit.Timer(fn)
+    n_loops, _ = timer.autorange()
+    best_time = min(timer.repeat(repeat=n_repeats, number=n_loops)) / n_loops
+
+    # allocations: peak and retained bytes of a single call
+    tracemalloc.start()
+    try:
+        fn()
+        n_retained_bytes, n_peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "time_us": best_time * 1e6,
+        "peak_bytes": n_peak_bytes,
+        "retained_bytes": n_retained_bytes,
+    }
+
+
+def get_cases():
+    cases = []
+
+    def add_cases(chat_mode, n_turns, with_code):
+        prompt_start = config.chat_modes[chat_mode]["prompt_start"]
+        dialog_messages = make_dialog_messages(n_turns, with_code=with_code)
+        case_key = f"{chat_mode}|turns={n_turns}|code={int(with_code)}"
+
+        chatgpt = openai_utils.ChatGPT(model="gpt-3.5-turbo")
+        davinci = openai_utils.ChatGPT(model="text-davinci-003")
+
+        messages = chatgpt._generate_prompt_messages(USER_MESSAGE, dialog_messages, prompt_start)
+        prompt = davinci._generate_prompt(USER_MESSAGE, dialog_messages, prompt_start)
+
+        cases.append((
+            f"_generate_prompt_messages|{case_key}",
+            lambda: chatgpt._generate_prompt_messages(USER_MESSAGE, dialog_messages, prompt_start)
+        ))
+        cases.append((
+            f"_generate_prompt|{case_key}",
+            lambda: davinci._generate_prompt(USER_MESSAGE, dialog_messages, prompt_start)
+        ))
+        cases.append((
+            f"_count_tokens_from_messages|{case_key}",
+            lambda: chatgpt._count_tokens_from_messages(messages, BOT_ANSWER, model="gpt-3.5-turbo")
+        ))
+        cases.append((
+            f"_count_tokens_from_prompt|{case_key}",
+            lambda: davinci._count_tokens_from_prompt(prompt, BOT_ANSWER, model="text-davinci-003")
+        ))
+
+    # dialog sizes, with and without long code blocks
+    for n_turns in DIALOG_SIZES:
+        for with_code in (False, True):
+            add_cases(DEFAULT_CHAT_MODE, n_turns, with_code)
+
+    # every chat mode at a typical dialog size
+    for chat_mode in config.chat_modes.keys():
+        if chat_mode == DEFAULT_CHAT_MODE:
+            continue
+        add_cases(chat_mode, CHAT_MODES_DIALOG_SIZE, False)
+
+    return cases
+
+
+def can_count_tokens():
+    try:
+        openai_utils.warm_up_tokenizers(TOKENIZER_MODELS)
+    except Exception as e:
+        print(f"Skipping token counting cases, tiktoken encodings can't be loaded ({type(e).__name__}: {e})")
+        return False
+
+    return True
+
+
+def run_benchmarks(name_filter=None):
+    results, skipped = {}, []
+    with_token_counting = can_count_tokens()
+    for name, fn in get_cases():
+        if name_filter is not None and name_filter not in name:
+            continue
+        if not with_token_counting and name.startswith(TOKEN_COUNTING_CASES):
+            skipped.append(name)
+            continue
+
+        fn()  # warm-up (loads tiktoken encodings)
+        results[name] = measure(fn)
+
+        r = results[name]
+        print(f"{name:<90} {r['time_us']:>12.1f} us {r['peak_bytes']:>12d} B peak {r['retained_bytes']:>10d} B retained")
+
+    return results, skipped
+
+
+def compare_with_baseline(results, baseline):
+    n_regressions = 0
+    for name, r in results.items():
+        if name not in baseline["results"]:
+            continue
+
+        b = baseline["results"][name]
+        time_ratio = r["time_us"] / max(b["time_us"], 1e-9)
+        memory_ratio = r["peak_bytes"] / max(b["peak_bytes"], 1)
+
+        if time_ratio > MAX_TIME_RATIO or memory_ratio > MAX_MEMORY_RATIO:
+            n_regressions += 1
+            print(f"REGRESSION {name}: time x{time_ratio:.2f}, peak memory x{memory_ratio:.2f}")
+
+    return n_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--save-baseline", action="store_true", help="save results to the baseline file")
+    parser.add_argument("--compare", action="store_true", help="compare results with the baseline file")
+    parser.add_argument("--filter", default=None, help="run only cases whose name contains this substring")
+    parser.add_argument("--baseline-path", type=Path, default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    results, skipped = run_benchmarks(name_filter=args.filter)
+
+    if args.compare:
+        with open(args.baseline_path, "r") as f:
+            baseline = json.load(f)
+
+        n_regressions = compare_with_baseline(results, baseline)
+        if n_regressions > 0:
+            print(f"{n_regressions} regression(s) compared to {args.baseline_path}")
+            sys.exit(1)
+        print(f"No regressions compared to {args.baseline_path}")
+
+    if args.save_baseline:
+        args.baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+            "skipped": skipped,
+        }
+        with open(args.baseline_path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
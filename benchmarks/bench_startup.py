@@ -0,0 +1,75 @@
+"""Startup-time benchmark
+
+Runs each measurement in a fresh interpreter and reports the median of:
+- import_bot: importing bot/bot.py (config, telegram stack, handlers)
+- warm_up_tokenizers: loading tiktoken encodings for available_text_models (as post_init does)
+- first_update: building the prompt and counting tokens for the first message, i.e. the
+  CPU work of handling an update before the OpenAI request, with and without warm-up
+
+Network calls (Telegram, MongoDB, OpenAI) are not part of the measurement.
+
+Usage:
+    python3 benchmarks/bench_startup.py [--n-runs 5]
+"""
+
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+
+BOT_DIR = Path(__file__).parent.parent.resolve() / "bot"
+
+RUN_SCRIPT = """
+import sys, time, json
+t_start = time.perf_counter()
+sys.path.insert(0, {bot_dir!r})
+
+timings = {{}}
+
+t = time.perf_counter()
+import bot
+import config
+import openai_utils
+timings["import_bot"] = time.perf_counter() - t
+
+if {warm_up}:
+    t = time.perf_counter()
+    openai_utils.warm_up_tokenizers(config.get_snapshot().available_text_models)
+    timings["warm_up_tokenizers"] = time.perf_counter() - t
+
+t = time.perf_counter()
+chatgpt = openai_utils.ChatGPT(model="gpt-3.5-turbo")
+messages = chatgpt._generate_prompt_messages("Hi! What can you do?", [], config.get_snapshot().chat_modes["assistant"]["prompt_start"])
+chatgpt._count_tokens_from_messages(messages, "I can help you with many things.", model="gpt-3.5-turbo")
+timings["first_update"] = time.perf_counter() - t
+
+timings["total"] = time.perf_counter() - t_start
+print(json.dumps(timings))
+"""
+
+
+def run_once(warm_up):
+    script = RUN_SCRIPT.format(bot_dir=str(BOT_DIR), warm_up=warm_up)
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for warm_up in (False, True):
+        runs = [run_once(warm_up) for _ in range(args.n_runs)]
+
+        print(f"warm-up: {'yes' if warm_up else 'no'}")
+        for key in runs[0].keys():
+            median = statistics.median(run[key] for run in runs)
+            print(f"  {key:<20} {median * 1000:>10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Benchmark of time to first token of a streamed reply
+
+Replays the request path of bot.py for a text message up to the first streamed
+token, with the order of calls before and after the placeholder, typing action
+and prompt data were made concurrent:
+
+    sequential  placeholder, typing action, DB reads one by one, then the OpenAI request
+    concurrent  placeholder and typing action as tasks, DB reads in the thread pool,
+                then the OpenAI request (the current message_handle_fn)
+
+Telegram calls sleep for --telegram-rtt, every Database call blocks for
+--db-latency (as a pymongo round trip does) before running on a memory://
+database, and openai_utils.ChatGPT.send_message_stream runs against a stubbed
+streaming client whose first chunk arrives after --openai-ttft. Prompt building
+and token counting are real.
+
+Usage:
+    python3 benchmarks/bench_time_to_first_token.py [--n-repeats 20] [--telegram-rtt 0.1] [--db-latency 0.005] [--openai-ttft 0.3]
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from pathlib import Path
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import database
+import openai_utils
+
+
+USER_ID = 1
+DIALOG_SIZES = [0, 10, 50]
+ANSWER_CHUNKS = ["Generators ", "produce ", "values ", "lazily", "."]
+
+
+class StubDelta(dict):
+    # "content" in delta and delta.content, as in openai's streamed chunks
+    __getattr__ = dict.__getitem__
+
+
+class StubChoice:
+    def __init__(self, index, content):
+        self.index = index
+        self.delta = StubDelta(content=content)
+
+
+class StubChunk:
+    def __init__(self, content):
+        self.choices = [StubChoice(0, content)]
+
+
+class StubChatCompletion:
+    def __init__(self, ttft, chunk_interval):
+        self.ttft = ttft
+        self.chunk_interval = chunk_interval
+
+    async def acreate(self, stream=False, **kwargs):
+        await asyncio.sleep(self.ttft)
+
+        async def chunks():
+            for i, content in enumerate(ANSWER_CHUNKS):
+                if i > 0:
+                    await asyncio.sleep(self.chunk_interval)
+                yield StubChunk(content)
+
+        return chunks()
+
+
+class StubOpenAI:
+    class error:
+        class InvalidRequestError(Exception):
+            pass
+
+    def __init__(self, ttft, chunk_interval=0.02):
+        self.ChatCompletion = StubChatCompletion(ttft, chunk_interval)
+
+
+class SlowDatabase:
+    """Database whose calls block for latency seconds, as network round trips do"""
+
+    def __init__(self, db, latency):
+        self.db = db
+        self.latency = latency
+
+    def __getattr__(self, name):
+        fn = getattr(self.db, name)
+
+        def call(*args, **kwargs):
+            time.sleep(self.latency)
+            return fn(*args, **kwargs)
+
+        return call
+
+
+class StubTelegram:
+    def __init__(self, rtt):
+        self.rtt = rtt
+
+    async def reply_text(self, text):
+        await asyncio.sleep(self.rtt)
+        return text
+
+    async def send_action(self, action):
+        await asyncio.sleep(self.rtt)
+
+
+async def get_first_token(current_model, dialog_messages, chat_mode_dict):
+    chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+    gen = chatgpt_instance.send_message_stream(
+        "How do generators work?",
+        dialog_messages=dialog_messages,
+        chat_mode_prompt=chat_mode_dict["prompt_start"]
+    )
+    try:
+        await gen.__anext__()
+    finally:
+        await gen.aclose()
+
+
+async def handle_sequential(db, telegram):
+    # message_handle_fn before: each call waits for the previous one
+    t_start = time.perf_counter()
+    chat_mode_index = db.get_user_attribute(USER_ID, "current_chat_mode_index")  # read by message_handle
+
+    await telegram.reply_text("thinking ...")
+    await telegram.send_action("typing")
+
+    current_model = db.get_user_attribute(USER_ID, "current_model")
+    dialog_messages = db.get_dialog_messages(USER_ID, dialog_id=None)
+    db.get_chat_modes(USER_ID)  # once for parse_mode
+    chat_mode_dict = db.get_chat_modes(USER_ID)[chat_mode_index]  # and once for prompt_start
+
+    await get_first_token(current_model, dialog_messages, chat_mode_dict)
+    return time.perf_counter() - t_start
+
+
+def load_prompt_data(db, chat_mode_index):
+    # as bot.load_prompt_data without summaries, memory and quotas (disabled by default)
+    user_dict = db.get_user_attributes(USER_ID, ["current_model", "current_dialog_id"])
+    dialog_messages = db.get_dialog_messages(USER_ID, dialog_id=user_dict["current_dialog_id"])
+    chat_mode_dict = db.get_chat_modes(USER_ID)[chat_mode_index]
+
+    return user_dict["current_model"], dialog_messages, chat_mode_dict
+
+
+async def handle_concurrent(db, telegram):
+    # message_handle_fn now: Telegram calls run while the prompt data is loaded
+    t_start = time.perf_counter()
+    chat_mode_index = db.get_user_attribute(USER_ID, "current_chat_mode_index")  # read by message_handle
+
+    placeholder_task = asyncio.ensure_future(telegram.reply_text("thinking ..."))
+    typing_task = asyncio.ensure_future(telegram.send_action("typing"))
+
+    loop = asyncio.get_running_loop()
+    current_model, dialog_messages, chat_mode_dict = await loop.run_in_executor(None, load_prompt_data, db, chat_mode_index)
+    await get_first_token(current_model, dialog_messages, chat_mode_dict)
+    t_first_token = time.perf_counter() - t_start
+
+    # the placeholder is awaited before the first edit, after the first token
+    await asyncio.gather(placeholder_task, typing_task)
+    return t_first_token
+
+
+async def measure(fn, db, telegram, n_repeats):
+    await fn(db, telegram)  # warm-up (tokenizer, thread pool)
+
+    timings = [await fn(db, telegram) for _ in range(n_repeats)]
+    return statistics.median(timings)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-repeats", type=int, default=20)
+    parser.add_argument("--telegram-rtt", type=float, default=0.1, help="seconds per Telegram request")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per Database call")
+    parser.add_argument("--openai-ttft", type=float, default=0.3, help="seconds until OpenAI streams the first chunk")
+    args = parser.parse_args()
+
+    openai_utils._openai = StubOpenAI(args.openai_ttft)
+    telegram = StubTelegram(args.telegram_rtt)
+
+    print(f"{'dialog':>7} {'sequential ms':>14} {'concurrent ms':>14} {'saved ms':>9}")
+    for n_dialog_messages in DIALOG_SIZES:
+        db = database.open_database(database_name=f"ttft_{n_dialog_messages}", uri="memory://")
+        db.add_new_user(USER_ID, USER_ID, username="benchmark")
+        db.start_new_dialog(USER_ID)
+        db.set_dialog_messages(USER_ID, [
+            {"user": "How do I reverse a list in Python? " * 5, "bot": "Use reversed() or slicing. " * 30, "date": datetime.now()}
+            for _ in range(n_dialog_messages)
+        ])
+        db = SlowDatabase(db, args.db_latency)
+
+        t_sequential = await measure(handle_sequential, db, telegram, args.n_repeats)
+        t_concurrent = await measure(handle_concurrent, db, telegram, args.n_repeats)
+        print(f"{n_dialog_messages:>7} {1000 * t_sequential:>14.1f} {1000 * t_concurrent:>14.1f} {1000 * (t_sequential - t_concurrent):>9.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
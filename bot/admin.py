@@ -0,0 +1,255 @@
+"""Admin usage reports
+
+All aggregation runs on the MongoDB server, results are streamed from the cursor
+to CSV or JSONL, so memory usage doesn't depend on the number of users. Needs
+the MongoDB backend.
+
+Messages of archived dialogs (see enable_dialog_archiving) are stored compressed
+and can't be aggregated on the server: the daily report and top users by
+n_messages cover only dialogs that aren't archived yet, i.e. complete days within
+the last dialog_archive_after_days. n_dialogs in the users report includes
+archived dialogs.
+
+The models report sums the lifetime per-model counters of users, which carry no
+timestamps, so it has no time window. The daily report attributes messages to
+the model that answered them; messages stored before the model was recorded per
+message fall back to the dialog's model (the model at dialog start).
+
+Usage:
+    python3 bot/admin.py users [--since 2023-06-01] [--until 2023-07-01] [--format csv|jsonl] [--output users.csv]
+    python3 bot/admin.py models
+    python3 bot/admin.py daily --since 2023-06-01
+    python3 bot/admin.py top_users --by total_n_spent_dollars --n 20
+"""
+
+import sys
+import csv
+import json
+import argparse
+from datetime import datetime
+
+import database
+from mongo_database import MongoDatabase
+
+
+BATCH_SIZE = 1000
+TOP_USERS_METRICS = ["total_n_spent_dollars", "total_n_used_tokens", "n_generated_images", "n_transcribed_seconds", "n_messages"]
+
+
+def get_time_window_match(field: str, since: datetime = None, until: datetime = None):
+    condition = {}
+    if since is not None:
+        condition["$gte"] = since
+    if until is not None:
+        condition["$lt"] = until
+
+    return {field: condition} if len(condition) > 0 else {}
+
+
+def get_n_used_tokens_array():
+    # n_used_tokens as [{k: usage key, v: {name, n_input_tokens, n_output_tokens}}], empty for the old integer format
+    # (name is missing in entries written before the keys were escaped, their key is the model name)
+    return {"$cond": [
+        {"$eq": [{"$type": "$n_used_tokens"}, "object"]},
+        {"$objectToArray": "$n_used_tokens"},
+        []
+    ]}
+
+
+def users_report(db: MongoDatabase, since: datetime = None, until: datetime = None):
+    # users active in the window with their counters and number of dialogs
+    columns = [
+        "user_id", "username", "first_seen", "last_interaction",
+        "n_input_tokens", "n_output_tokens", "total_n_used_tokens", "total_n_spent_dollars",
+        "n_generated_images", "n_transcribed_seconds", "n_dialogs"
+    ]
+    pipeline = [
+        {"$match": get_time_window_match("last_interaction", since, until)},
+        {"$lookup": {
+            "from": db.dialog_collection.name,
+            "let": {"user_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
+                {"$count": "n"}
+            ],
+            "as": "dialogs"
+        }},
+        {"$lookup": {
+            "from": db.dialog_archive_collection.name,
+            "let": {"user_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
+                {"$count": "n"}
+            ],
+            "as": "archived_dialogs"
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id",
+            "username": 1,
+            "first_seen": 1,
+            "last_interaction": 1,
+            "n_input_tokens": {"$sum": {"$map": {"input": get_n_used_tokens_array(), "in": "$$this.v.n_input_tokens"}}},
+            "n_output_tokens": {"$sum": {"$map": {"input": get_n_used_tokens_array(), "in": "$$this.v.n_output_tokens"}}},
+            "total_n_used_tokens": {"$ifNull": ["$total_n_used_tokens", 0]},
+            "total_n_spent_dollars": {"$ifNull": ["$total_n_spent_dollars", 0]},
+            "n_generated_images": {"$ifNull": ["$n_generated_images", 0]},
+            "n_transcribed_seconds": {"$ifNull": ["$n_transcribed_seconds", 0]},
+            "n_dialogs": {"$add": [
+                {"$ifNull": [{"$first": "$dialogs.n"}, 0]},
+                {"$ifNull": [{"$first": "$archived_dialogs.n"}, 0]}
+            ]}
+        }}
+    ]
+
+    return columns, db.user_collection.aggregate(pipeline, allowDiskUse=True, batchSize=BATCH_SIZE)
+
+
+def models_report(db: MongoDatabase):
+    # cumulative totals per model over all users, see above
+    columns = ["model", "n_users", "n_input_tokens", "n_output_tokens", "n_spent_dollars"]
+    pipeline = [
+        {"$project": {"usage": {"$objectToArray": {"$ifNull": ["$usage", {}]}}, "n_used_tokens": get_n_used_tokens_array()}},
+        {"$project": {"models": {"$concatArrays": [
+            {"$map": {"input": "$n_used_tokens", "in": {
+                "model": {"$ifNull": ["$$this.v.name", "$$this.k"]},
+                "n_input_tokens": "$$this.v.n_input_tokens",
+                "n_output_tokens": "$$this.v.n_output_tokens",
+                "n_spent_dollars": 0
+            }}},
+            {"$map": {"input": "$usage", "in": {
+                "model": "$$this.v.name",
+                "n_input_tokens": 0,
+                "n_output_tokens": 0,
+                "n_spent_dollars": "$$this.v.n_spent_dollars"
+            }}}
+        ]}}},
+        {"$unwind": "$models"},
+        {"$group": {
+            "_id": {"model": "$models.model", "user_id": "$_id"},
+            "n_input_tokens": {"$sum": "$models.n_input_tokens"},
+            "n_output_tokens": {"$sum": "$models.n_output_tokens"},
+            "n_spent_dollars": {"$sum": "$models.n_spent_dollars"}
+        }},
+        {"$group": {
+            "_id": "$_id.model",
+            "n_users": {"$sum": 1},
+            "n_input_tokens": {"$sum": "$n_input_tokens"},
+            "n_output_tokens": {"$sum": "$n_output_tokens"},
+            "n_spent_dollars": {"$sum": "$n_spent_dollars"}
+        }},
+        {"$sort": {"n_spent_dollars": -1}},
+        {"$project": {"_id": 0, "model": "$_id", "n_users": 1, "n_input_tokens": 1, "n_output_tokens": 1, "n_spent_dollars": 1}}
+    ]
+
+    return columns, db.user_collection.aggregate(pipeline, allowDiskUse=True, batchSize=BATCH_SIZE)
+
+
+def daily_report(db: MongoDatabase, since: datetime = None, until: datetime = None):
+    # messages, dialogs and active users per day and model, archived dialogs are not included (see above)
+    columns = ["day", "model", "n_messages", "n_dialogs", "n_users"]
+    pipeline = [
+        # dialogs started after the window have no messages in it, skipped before unwinding
+        {"$match": get_time_window_match("start_time", None, until)},
+        {"$unwind": "$messages"},
+        {"$match": get_time_window_match("messages.date", since, until)},
+        {"$group": {
+            "_id": {
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$messages.date"}},
+                "model": {"$ifNull": ["$messages.model", "$model"]}
+            },
+            "n_messages": {"$sum": 1},
+            "dialog_ids": {"$addToSet": "$_id"},
+            "user_ids": {"$addToSet": "$user_id"}
+        }},
+        {"$sort": {"_id.day": 1, "_id.model": 1}},
+        {"$project": {
+            "_id": 0,
+            "day": "$_id.day",
+            "model": "$_id.model",
+            "n_messages": 1,
+            "n_dialogs": {"$size": "$dialog_ids"},
+            "n_users": {"$size": "$user_ids"}
+        }}
+    ]
+
+    return columns, db.dialog_collection.aggregate(pipeline, allowDiskUse=True, batchSize=BATCH_SIZE)
+
+
+def top_users_report(db: MongoDatabase, since: datetime = None, until: datetime = None, by: str = "total_n_spent_dollars", n: int = 10):
+    columns = ["user_id", "username", by]
+
+    if by == "n_messages":
+        # counted over messages in the window
+        pipeline = [
+            {"$match": get_time_window_match("start_time", None, until)},
+            {"$unwind": "$messages"},
+            {"$match": get_time_window_match("messages.date", since, until)},
+            {"$group": {"_id": "$user_id", "n_messages": {"$sum": 1}}},
+            {"$sort": {"n_messages": -1}},
+            {"$limit": n},
+            {"$lookup": {"from": db.user_collection.name, "localField": "_id", "foreignField": "_id", "as": "user"}},
+            {"$project": {"_id": 0, "user_id": "$_id", "username": {"$first": "$user.username"}, "n_messages": 1}}
+        ]
+        collection = db.dialog_collection
+    else:
+        # cumulative counters of users active in the window
+        pipeline = [
+            {"$match": get_time_window_match("last_interaction", since, until)},
+            {"$sort": {by: -1}},
+            {"$limit": n},
+            {"$project": {"_id": 0, "user_id": "$_id", "username": 1, by: {"$ifNull": [f"${by}", 0]}}}
+        ]
+        collection = db.user_collection
+
+    return columns, collection.aggregate(pipeline, allowDiskUse=True, batchSize=BATCH_SIZE)
+
+
+def write_rows(rows, columns: list, output_format: str, f):
+    if output_format == "csv":
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    elif output_format == "jsonl":
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("report", choices=["users", "models", "daily", "top_users"])
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None, help="start of the time window (inclusive)")
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None, help="end of the time window (exclusive)")
+    parser.add_argument("--by", choices=TOP_USERS_METRICS, default="total_n_spent_dollars", help="metric for top_users")
+    parser.add_argument("--n", type=int, default=10, help="number of users for top_users")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--output", default=None, help="output file (stdout by default)")
+    args = parser.parse_args()
+
+    if database.get_backend() not in ("mongodb", "mongodb+srv"):
+        sys.exit("Admin reports need the MongoDB backend (database_uri)")
+    db = database.open_database()
+
+    if args.report == "users":
+        columns, rows = users_report(db, args.since, args.until)
+    elif args.report == "models":
+        if args.since is not None or args.until is not None:
+            parser.error("the models report is cumulative, --since and --until are not supported")
+        columns, rows = models_report(db)
+    elif args.report == "daily":
+        columns, rows = daily_report(db, args.since, args.until)
+    else:
+        columns, rows = top_users_report(db, args.since, args.until, by=args.by, n=args.n)
+
+    if args.output is None:
+        write_rows(rows, columns, args.format, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as f:
+            write_rows(rows, columns, args.format, f)
+
+
+if __name__ == "__main__":
+    main()
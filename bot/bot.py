@@ -5,15 +5,21 @@ import traceback
 import html
 import json
 import tempfile
-import pydub
+import functools
+import contextvars
+import signal
+import time
+import uuid
 from pathlib import Path
 from datetime import datetime
-import openai
+from typing import Optional
 
 import telegram
 from telegram import (
     Update,
     User,
+    Message,
+    MessageEntity,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     BotCommand
@@ -33,14 +39,63 @@ from telegram.constants import ParseMode, ChatAction
 import config
 import database
 import openai_utils
+import formatting
+import quotas
+import overload
+from loop_watchdog import LoopWatchdog
+from cache import LRUCache
 
 
 # setup
-db = database.Database()
 logger = logging.getLogger(__name__)
 
-user_semaphores = {}
-user_tasks = {}
+PARSE_MODES = {
+    "html": ParseMode.HTML,
+    "markdown": ParseMode.MARKDOWN
+}  # chat mode parse_mode -> Telegram parse mode
+
+
+class BotState:
+    """Runtime state of one hosted bot (see config.bots)"""
+
+    def __init__(self, bot_config: config.BotConfig, db: database.Database):
+        self.bot_config = bot_config
+        self.db = db
+
+        self.user_semaphores = {}
+        self.user_tasks = {}
+        self.user_message_queues = {}  # (user_id, chat_id) -> [(update, message), ...]
+
+        # user_id -> ((chat_modes_version, config_version), {(page_index, action, current_mode): (text, reply_markup)})
+        self.chat_mode_menu_cache = LRUCache(maxsize=10000)
+
+        self.semantic_cache = None  # if enable_semantic_cache
+        self.long_term_memory = None  # if enable_long_term_memory
+        self.quota_tracker = None  # if enable_quotas
+
+        # file name -> (version, Telegram file_id) of files sent by reply_static_asset
+        self.static_asset_file_ids = {}
+
+
+bot_states = {}  # bot name -> BotState, created in run_bot
+
+
+def get_bot_state():
+    return bot_states[config.current_bot.get()]
+
+
+class CurrentBotDatabase:
+    # db.<method> goes to the database of the bot whose update is being handled
+    def __getattr__(self, name):
+        return getattr(get_bot_state().db, name)
+
+
+db = CurrentBotDatabase()
+
+dialog_summarization_tasks = {}
+background_tasks = set()
+
+overload_controller = None  # shared by all bots if enable_overload_control, created in run_bot
 
 HELP_MESSAGE = """Commands:
 ⚪ /new – Start new dialog
@@ -84,17 +139,29 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
         )
         db.start_new_dialog(user.id)
 
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
+    user_dict = db.get_user_attributes(user.id, [
+        "current_dialog_id",
+        "current_model",
+        "n_used_tokens",
+        "n_transcribed_seconds",
+        "n_generated_images",
+        "chat_modes",
+        "current_chat_mode_index",
+        "total_n_spent_dollars"
+    ])
+
+    if user_dict["current_dialog_id"] is None:
         db.start_new_dialog(user.id)
 
+    user_semaphores = get_bot_state().user_semaphores
     if user.id not in user_semaphores:
         user_semaphores[user.id] = asyncio.Semaphore(1)
 
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
+    if user_dict["current_model"] is None:
+        db.set_user_attribute(user.id, "current_model", config.get_snapshot().available_text_models[0])
 
     # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
+    n_used_tokens = user_dict["n_used_tokens"]
     if isinstance(n_used_tokens, int):  # old format
         new_n_used_tokens = {
             "gpt-3.5-turbo": {
@@ -105,45 +172,68 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
         db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
 
     # voice message transcription
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
+    if user_dict["n_transcribed_seconds"] is None:
         db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
 
     # image generation
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
+    if user_dict["n_generated_images"] is None:
         db.set_user_attribute(user.id, "n_generated_images", 0)
 
     # back compatibility for chat_modes
-    if db.get_user_attribute(user.id, "chat_modes") is None:
-        db.set_user_attribute(user.id, "chat_modes", config.get_default_chat_modes())
+    if user_dict["chat_modes"] is None:
+        db.set_user_attribute(user.id, "chat_modes", config.get_default_chat_mode_refs())
 
-    if db.get_user_attribute(user.id, "current_chat_mode_index") is None:
+    if user_dict["current_chat_mode_index"] is None:
         db.set_user_attribute(user.id, "current_chat_mode_index", 0)
 
+    # back compatibility for running usage totals
+    if user_dict["total_n_spent_dollars"] is None:
+        db.backfill_usage(user.id)
 
-async def is_bot_mentioned(update: Update, context: CallbackContext):
-     try:
-         message = update.message
 
-         if message.chat.type == "private":
-             return True
+class BotMentionFilter(filters.MessageFilter):
+    """Passes private messages, messages that mention the bot and replies to the bot's messages.
+
+    Used in handler filters, so unrelated group traffic is dropped before any handler runs.
+    """
+
+    def __init__(self):
+        super().__init__(name="BotMentionFilter")
+        self.n_dropped_updates = 0
 
-         if message.text is not None and ("@" + context.bot.username) in message.text:
-             return True
+    def filter(self, message: Message) -> bool:
+        if message.chat.type == "private":
+            return True
 
-         if message.reply_to_message is not None:
-             if message.reply_to_message.from_user.id == context.bot.id:
-                 return True
-     except:
-         return True
-     else:
-         return False
+        bot = message.get_bot()
+
+        if message.reply_to_message is not None and message.reply_to_message.from_user is not None:
+            if message.reply_to_message.from_user.id == bot.id:
+                return True
+
+        entity_types = [MessageEntity.MENTION, MessageEntity.TEXT_MENTION]
+        entities = {**message.parse_entities(entity_types), **message.parse_caption_entities(entity_types)}
+        for entity, entity_text in entities.items():
+            if entity.type == MessageEntity.TEXT_MENTION and entity.user.id == bot.id:
+                return True
+            if entity.type == MessageEntity.MENTION and entity_text[1:].lower() == bot.username.lower():
+                return True
+
+        self.n_dropped_updates += 1
+        if self.n_dropped_updates % 1000 == 0:
+            logger.info(f"Dropped {self.n_dropped_updates} group messages not addressed to the bot")
+
+        return False
+
+
+bot_mention_filter = BotMentionFilter()
 
 
 async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
     db.start_new_dialog(user_id)
 
     reply_text = "Hi! I'm <b>ChatGPT</b> bot implemented with OpenAI API 🤖\n\n"
@@ -156,19 +246,58 @@ async def start_handle(update: Update, context: CallbackContext):
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
 async def help_group_chat_handle(update: Update, context: CallbackContext):
      await register_user_if_not_exists(update, context, update.message.from_user)
      user_id = update.message.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     db.set_last_interaction(user_id, datetime.now())
 
      text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
 
      await update.message.reply_text(text, parse_mode=ParseMode.HTML)
-     await update.message.reply_video(config.help_group_chat_video_path)
+     await reply_static_asset(update.message, config.help_group_chat_video_path, kind="video")
+
+
+async def reply_static_asset(message: Message, path: Path, kind: str = "document"):
+    """Send a file from static/, uploading it only once per version of the file.
+
+    Telegram's file_id of the upload is kept in memory and in the database and
+    used for later sends. If Telegram doesn't accept it anymore, the file is uploaded again.
+    """
+    reply_fn = {
+        "video": message.reply_video,
+        "animation": message.reply_animation,
+        "photo": message.reply_photo,
+        "document": message.reply_document
+    }[kind]
+
+    stat = path.stat()
+    name, version = path.name, f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    static_asset_file_ids = get_bot_state().static_asset_file_ids
+    cached_version, file_id = static_asset_file_ids.get(name, (None, None))
+    if cached_version != version:
+        file_id = db.get_static_asset_file_id(name, version)
+
+    if file_id is not None:
+        try:
+            await reply_fn(file_id)
+            static_asset_file_ids[name] = (version, file_id)
+            return
+        except telegram.error.BadRequest as e:
+            logger.warning(f"Failed to send {name} by file_id, uploading it again. Reason: {e}")
+
+    sent_message = await reply_fn(path)
+
+    sent_file = getattr(sent_message, kind)
+    if kind == "photo":
+        sent_file = sent_file[-1]  # largest size
+    if sent_file is not None:
+        static_asset_file_ids[name] = (version, sent_file.file_id)
+        db.set_static_asset_file_id(name, version, sent_file.file_id)
 
 
 async def retry_handle(update: Update, context: CallbackContext):
@@ -176,24 +305,114 @@ async def retry_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
+    if get_overload_level() >= overload.REJECTING:
+        await reply_overloaded(update)
+        return
+
+    dialog_id = db.get_user_attribute(user_id, "current_dialog_id")
+    last_dialog_messages = db.get_dialog_messages(user_id, dialog_id=dialog_id, last_n=1)
+    if len(last_dialog_messages) == 0:
         await update.message.reply_text("No message to retry 🤷‍♂️")
         return
+    last_dialog_message = last_dialog_messages[0]
+
+    # answers generated with the previous retry are shown without a new request, then new ones are generated
+    if last_dialog_message.get("candidate_index", 0) + 1 < len(last_dialog_message.get("candidates", [])):
+        async with get_bot_state().user_semaphores[user_id]:
+            last_dialog_message = db.pop_dialog_message(user_id, dialog_id=dialog_id)
+            select_next_answer_candidate(last_dialog_message)
+            db.push_dialog_message(user_id, last_dialog_message, dialog_id=dialog_id)
+        await send_answer_candidate(update.message.reply_text, user_id, dialog_id, last_dialog_message)
+        return
+
+    # the last message stays in the dialog until the new answer replaces it, so that it isn't lost if the retry fails
+    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False, n_candidates=config.retry_n_candidates, is_retry=True)
+
+
+def select_next_answer_candidate(dialog_message: dict):
+    # the dialog context follows the shown answer
+    candidates = dialog_message["candidates"]
+    candidate_index = (dialog_message.get("candidate_index", 0) + 1) % len(candidates)
+    dialog_message["candidate_index"] = candidate_index
+    dialog_message["bot"] = candidates[candidate_index]
+
+
+def get_answer_candidates_reply_markup(dialog_id: str, dialog_message: dict):
+    candidates = dialog_message.get("candidates", [])
+    if len(candidates) < 2:
+        return None
+
+    # dialog_id and candidates_id fit into 64 bytes of callback data
+    text = f"🔄 Next alternative ({dialog_message['candidate_index'] + 1}/{len(candidates)})"
+    callback_data = f"next_candidate|{dialog_id}|{dialog_message['candidates_id']}"
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=callback_data)]])
+
+
+async def send_answer_candidate(send_fn, user_id: int, dialog_id: str, dialog_message: dict):
+    # send_fn is reply_text or edit_message_text, the answer goes with the "next alternative" button
+    reply_markup = get_answer_candidates_reply_markup(dialog_id, dialog_message)
+
+    # parse mode of the chat mode the answers were generated in
+    parse_mode = dialog_message.get("parse_mode")
+    if parse_mode is None:
+        chat_mode_index = db.get_user_attribute(user_id, "current_chat_mode_index")
+        parse_mode = db.get_chat_modes(user_id)[chat_mode_index]["parse_mode"]
 
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)  # last message was removed from the context
+    answer = dialog_message["bot"][:4096]  # telegram message limit
+    formatted_answer = formatting.format_answer(answer, parse_mode, is_complete=True)
+    try:
+        await send_fn(formatted_answer, reply_markup=reply_markup, parse_mode=PARSE_MODES[parse_mode])
+    except telegram.error.BadRequest as e:
+        if str(e).startswith("Message is not modified"):
+            return
+        logger.warning(f"Failed to send formatted answer, sending it as plain text. Reason: {e}")
+        await send_fn(answer, reply_markup=reply_markup)
 
-    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
 
+async def next_answer_candidate_handle(update: Update, context: CallbackContext):
+    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+    user_id = update.callback_query.from_user.id
+    db.set_last_interaction(user_id, datetime.now())
+
+    query = update.callback_query
 
-async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=False):
-    # check if bot was mentioned (for group chats)
-    if not await is_bot_mentioned(update, context):
+    # the dialog must not change while a reply is generated
+    user_semaphore = get_bot_state().user_semaphores[user_id]
+    if user_semaphore.locked():
+        await query.answer("⏳ Please wait for a reply to the previous message")
         return
+    await query.answer()
+
+    _, dialog_id, candidates_id = query.data.split("|")
+    async with user_semaphore:
+        try:
+            dialog_messages = db.get_dialog_messages(user_id, dialog_id=dialog_id)
+        except ValueError:
+            dialog_messages = []
+
+        # newest first, the turn is usually the last one
+        for index in reversed(range(len(dialog_messages))):
+            dialog_message = dialog_messages[index]
+            if dialog_message.get("candidates_id") == candidates_id:
+                break
+        else:
+            dialog_message = None
+
+        if dialog_message is not None:
+            select_next_answer_candidate(dialog_message)
+            db.update_dialog_message(user_id, index, dialog_message, dialog_id=dialog_id)
+
+    if dialog_message is None:
+        # the turn was retried or removed, its answers are gone
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    await send_answer_candidate(query.edit_message_text, user_id, dialog_id, dialog_message)
+
 
+async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=False, n_candidates=1, is_retry=False):
     # check if message is edited
     if update.edited_message is not None:
         await edited_message_handle(update, context)
@@ -217,54 +436,166 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         _message = _message.replace("@" + context.bot.username, "").strip()
 
     await register_user_if_not_exists(update, context, update.message.from_user)
+
+    # text messages sent in a burst or while a reply is generated are queued and merged
+    if config.enable_message_queue and message is None:
+        await queue_message(update, context, _message, use_new_dialog_timeout=use_new_dialog_timeout)
+        return
+
     if await is_previous_message_not_answered_yet(update, context): return
 
+    await process_message(update, context, _message, use_new_dialog_timeout=use_new_dialog_timeout, n_candidates=n_candidates, is_retry=is_retry)
+
+
+async def queue_message(update: Update, context: CallbackContext, message: str, use_new_dialog_timeout=False):
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    chat_mode_index = db.get_user_attribute(user_id, "current_chat_mode_index")
+    queue_key = (user_id, update.message.chat_id)
+    bot_state = get_bot_state()
+    user_message_queues = bot_state.user_message_queues
+
+    if queue_key in user_message_queues:
+        queue = user_message_queues[queue_key]
+        if len(queue) >= config.max_n_queued_messages:
+            text = "⏳ Please <b>wait</b> for a reply to the previous messages\n"
+            text += "Or you can /cancel it"
+            await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+            return
+
+        # the call that created the queue will process this message
+        queue.append((update, message))
+        return
+
+    queue = [(update, message)]
+    user_message_queues[queue_key] = queue
+
+    try:
+        # a message to an idle bot is answered at once, the delay applies only to messages sent during a reply
+        is_waiting = user_id in bot_state.user_tasks
+        while len(queue) > 0:
+            # wait until the user stops sending messages
+            n_queued_messages = 0
+            while is_waiting and n_queued_messages != len(queue):
+                n_queued_messages = len(queue)
+                await asyncio.sleep(config.message_coalescing_delay)
+            is_waiting = True
+
+            batch = queue[:]
+            del queue[:]
+            if len(batch) == 0:  # dropped by /cancel during the delay
+                break
+
+            # reply to the last message of the batch
+            last_update = batch[-1][0]
+            merged_message = "\n\n".join(message for _, message in batch if message)
+
+            await process_message(last_update, context, merged_message, use_new_dialog_timeout=use_new_dialog_timeout)
+    finally:
+        del user_message_queues[queue_key]
+
+
+async def process_message(update: Update, context: CallbackContext, _message: str, use_new_dialog_timeout=False, n_candidates=1, is_retry=False):
+    if get_overload_level() >= overload.REJECTING:
+        await reply_overloaded(update)
+        return
+
+    user_id = update.message.from_user.id
+    user_dict = db.get_user_attributes(user_id, ["current_chat_mode", "current_chat_mode_index"])
+    chat_mode, chat_mode_index = user_dict["current_chat_mode"], user_dict["current_chat_mode_index"]
 
     if chat_mode == "👩‍🎨 Artist":
-        await generate_image_handle(update, context, message=message)
+        await generate_image_handle(update, context, message=_message)
         return
 
+    bot_state = get_bot_state()
+
     async def message_handle_fn():
         # new dialog timeout
         if use_new_dialog_timeout:
-            if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
+            if (datetime.now() - db.get_last_interaction(user_id)).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id, last_n=1)) > 0:
                 db.start_new_dialog(user_id)
                 await update.message.reply_text(f"Starting new dialog due to timeout (<b>{db.get_chat_modes(user_id)[chat_mode_index]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.set_last_interaction(user_id, datetime.now())
 
         # in case of CancelledError
         n_input_tokens, n_output_tokens = 0, 0
-        current_model = db.get_user_attribute(user_id, "current_model")
+        current_model = None
+        moderation_task = None
+        quota_reservation = None
+
+        if _message is None or len(_message) == 0:
+             await update.message.reply_text("🥲 You sent <b>empty message</b>. Please, try again!", parse_mode=ParseMode.HTML)
+             return
+
+        # placeholder message and typing action are sent concurrently with loading the prompt,
+        # the placeholder is awaited only when there is something to show
+        placeholder_task = asyncio.ensure_future(update.message.reply_text("thinking ..."))
+        typing_task = asyncio.ensure_future(update.message.chat.send_action(action="typing"))
+        for telegram_task in (placeholder_task, typing_task):
+            telegram_task.add_done_callback(consume_task_exception)
 
         try:
-            # send placeholder message to user
-            placeholder_message = await update.message.reply_text("thinking ...")
+            t_start = time.monotonic()
 
-            # send typing action
-            await update.message.chat.send_action(action="typing")
+            # degraded replies under overload, the level is taken once per request
+            overload_level = get_overload_level()
+            max_tokens = config.overload_max_tokens if overload_level >= overload.LOWER_MAX_TOKENS else None
 
-            if _message is None or len(_message) == 0:
-                 await update.message.reply_text("🥲 You sent <b>empty message</b>. Please, try again!", parse_mode=ParseMode.HTML)
-                 return
+            # alternative answers only when there is spare capacity
+            n_answer_candidates = n_candidates if overload_level == overload.NORMAL else 1
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-            parse_mode = {
-                "html": ParseMode.HTML,
-                "markdown": ParseMode.MARKDOWN
-            }[db.get_chat_modes(user_id)[chat_mode_index]["parse_mode"]]
-            prompt_start = db.get_chat_modes(user_id)[chat_mode_index]["prompt_start"]
+            current_model, dialog_id, dialog_messages, dialog_summary, memory_snippets, chat_mode_dict, n_estimated_tokens = await run_in_executor(
+                load_prompt_data, user_id, chat_mode_index, _message, n_answer_candidates, is_retry
+            )
+            quota_reservation = reserve_quota(user_id, current_model, n_estimated_tokens)
+
+            parse_mode = PARSE_MODES[chat_mode_dict["parse_mode"]]
+            prompt_start = chat_mode_dict["prompt_start"]
+
+            # moderation runs concurrently with generation, the reply is retracted if the message is flagged
+            if config.get_snapshot().is_chat_mode_moderated(chat_mode_dict.get("key")):
+                moderation_task = asyncio.ensure_future(moderate_message(_message))
+
+            # only the first message of a dialog in a built-in chat mode doesn't depend on context
+            semantic_cache_threshold = None
+            if (
+                bot_state.semantic_cache is not None
+                and n_answer_candidates == 1
+                and len(dialog_messages) == 0
+                and dialog_summary == ""
+                and len(memory_snippets) == 0
+                and len(_message) <= config.semantic_cache_max_message_length
+            ):
+                semantic_cache_threshold = config.semantic_cache_thresholds.get(chat_mode_dict.get("key"))
+
+            cached_answer = None
+            if semantic_cache_threshold is not None:
+                cached_answer = bot_state.semantic_cache.get(chat_mode_dict["key"], current_model, _message, semantic_cache_threshold)
 
             chatgpt_instance = openai_utils.ChatGPT(model=current_model)
-            if config.enable_message_streaming:
-                gen = chatgpt_instance.send_message_stream(_message, dialog_messages=dialog_messages, chat_mode_prompt=prompt_start)
+            if cached_answer is not None:
+                async def cached_gen():
+                    yield "finished", cached_answer, (0, 0), 0
+
+                gen = cached_gen()
+            elif config.enable_message_streaming and overload_level < overload.NO_STREAMING:
+                gen = chatgpt_instance.send_message_stream(
+                    _message,
+                    dialog_messages=dialog_messages,
+                    chat_mode_prompt=prompt_start,
+                    dialog_summary=dialog_summary,
+                    memory_snippets=memory_snippets,
+                    max_tokens=max_tokens,
+                    n_candidates=n_answer_candidates
+                )
             else:
                 answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = await chatgpt_instance.send_message(
                     _message,
                     dialog_messages=dialog_messages,
-                    chat_mode_prompt=prompt_start
+                    chat_mode_prompt=prompt_start,
+                    dialog_summary=dialog_summary,
+                    memory_snippets=memory_snippets,
+                    max_tokens=max_tokens,
+                    n_candidates=n_answer_candidates
                 )
 
                 async def fake_gen():
@@ -272,52 +603,129 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
 
                 gen = fake_gen()
 
-            prev_answer = ""
+            placeholder_message = None
+            prev_answer, prev_formatted_answer = "", ""
+            is_rejected = False
             async for gen_item in gen:
                 status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = gen_item
 
+                # the complete answer is shown only after the verdict
+                if moderation_task is not None and (moderation_task.done() or status == "finished"):
+                    if not await moderation_task:
+                        is_rejected = True
+                        break
+
+                if placeholder_message is None:
+                    logger.info(f"Time to first token: {time.monotonic() - t_start:.3f}s (model {current_model})")
+                    placeholder_message = await placeholder_task
+
                 answer = answer[:4096]  # telegram message limit
 
                 # update only when n_update_chunk_symbols new symbols are ready
                 n_update_chunk_symbols = config.n_update_chunk_symbols
+                if get_overload_level() >= overload.FEWER_EDITS:
+                    n_update_chunk_symbols *= config.overload_edit_interval_factor
                 if abs(len(answer) - len(prev_answer)) < n_update_chunk_symbols and status != "finished":
                     continue
 
+                # partial answers are made valid for parse_mode, so that one edit per chunk is enough
+                formatted_answer = formatting.format_answer(answer, chat_mode_dict["parse_mode"], is_complete=(status == "finished"))
+                prev_answer = answer
+                if formatted_answer == prev_formatted_answer or len(formatted_answer) == 0:
+                    continue
+
                 try:
-                    await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=parse_mode)
+                    await context.bot.edit_message_text(formatted_answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=parse_mode)
                 except telegram.error.BadRequest as e:
                     if str(e).startswith("Message is not modified"):
                         continue
                     else:
+                        logger.warning(f"Failed to send formatted answer, sending it as plain text. Reason: {e}")
                         await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
 
                 await asyncio.sleep(0.01)  # wait a bit to avoid flooding
 
-                prev_answer = answer
+                prev_formatted_answer = formatted_answer
+
+            if is_rejected:
+                await gen.aclose()  # closes the OpenAI stream
+                quota_usage = reconcile_quota(quota_reservation, n_input_tokens + n_output_tokens)
+                db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, quota_usage=quota_usage)
+
+                # retract the partial reply
+                if placeholder_message is None:
+                    placeholder_message = await placeholder_task
+                try:
+                    await context.bot.delete_message(chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
+                except telegram.error.BadRequest:
+                    await context.bot.edit_message_text("...", chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
+
+                text = "🥲 Your request <b>doesn't comply</b> with OpenAI's usage policies."
+                await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+                return
 
             # update user data
-            new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now()}
-            db.set_dialog_messages(
-                user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                dialog_id=None
-            )
+            new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now(), "model": current_model}
+            answer_candidates = [answer, *chatgpt_instance.alternative_answers]
+            if len(answer_candidates) > 1:
+                new_dialog_message.update(
+                    candidates=answer_candidates, candidate_index=0, candidates_id=uuid.uuid4().hex[:8],
+                    parse_mode=chat_mode_dict["parse_mode"]
+                )
+            if is_retry:
+                db.pop_dialog_message(user_id, dialog_id=dialog_id)  # the retried message is replaced only after a successful reply
+            db.push_dialog_message(user_id, new_dialog_message, dialog_id=dialog_id)
+
+            if bot_state.long_term_memory is not None:
+                bot_state.long_term_memory.add(user_id, dialog_id, new_dialog_message)
+
+            quota_usage = reconcile_quota(quota_reservation, n_input_tokens + n_output_tokens)
+            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, quota_usage=quota_usage)
+
+            if semantic_cache_threshold is not None and cached_answer is None:
+                bot_state.semantic_cache.add(chat_mode_dict["key"], current_model, _message, answer)
 
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            if config.enable_dialog_summarization:
+                schedule_dialog_summarization(user_id)
+
+            if len(answer_candidates) > 1:
+                reply_markup = get_answer_candidates_reply_markup(dialog_id, new_dialog_message)
+                try:
+                    await context.bot.edit_message_reply_markup(chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, reply_markup=reply_markup)
+                except telegram.error.BadRequest as e:
+                    logger.warning(f"Failed to add alternative answers button. Reason: {e}")
 
         except asyncio.CancelledError:
+            if moderation_task is not None:
+                moderation_task.cancel()
+
             # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            if current_model is not None:
+                quota_usage = reconcile_quota(quota_reservation, n_input_tokens + n_output_tokens)
+                db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, quota_usage=quota_usage)
             raise
 
+        except quotas.QuotaExceeded as e:
+            placeholder_message = await placeholder_task
+            await context.bot.edit_message_text(
+                get_quota_exceeded_text(e),
+                chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id,
+                parse_mode=ParseMode.HTML
+            )
+            return
+
         except Exception as e:
+            # saved with the next usage update
+            reconcile_quota(quota_reservation, n_input_tokens + n_output_tokens)
+
             error_text = f"Something went wrong during completion. Reason: {e}"
             logger.error(error_text)
             await update.message.reply_text(error_text)
             return
 
-        # send message if some messages were removed from the context
-        if n_first_dialog_messages_removed > 0:
+        # send message if some messages were removed from the context; with summarization
+        # they are folded into the dialog summary, so nothing is lost and /new isn't needed
+        if n_first_dialog_messages_removed > 0 and not config.enable_dialog_summarization:
             text = f"\nSend /new to start a new dialog or go to /settings and switch to the <b>ChatGPT-16k</b> model."
             if n_first_dialog_messages_removed == 1:
                 text = "✍️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed from the context." + text
@@ -325,9 +733,9 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 text = f"✍️ <i>Note:</i> Your current dialog is too long, so the <b>first {n_first_dialog_messages_removed} messages</b> were removed from the context." + text
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    async with user_semaphores[user_id]:
+    async with bot_state.user_semaphores[user_id]:
         task = asyncio.create_task(message_handle_fn())
-        user_tasks[user_id] = task
+        bot_state.user_tasks[user_id] = task
 
         try:
             await task
@@ -336,15 +744,157 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         else:
             pass
         finally:
-            if user_id in user_tasks:
-                del user_tasks[user_id]
+            if user_id in bot_state.user_tasks:
+                del bot_state.user_tasks[user_id]
+
+
+def load_prompt_data(user_id: int, chat_mode_index: int, message: str, n_candidates: int = 1, is_retry: bool = False):
+    # blocking DB reads needed to build the prompt, run in a thread pool
+    user_dict = db.get_user_attributes(user_id, ["current_model", "current_dialog_id"])
+    current_model, dialog_id = user_dict["current_model"], user_dict["current_dialog_id"]
+    dialog_messages = db.get_dialog_messages(user_id, dialog_id=dialog_id)
+    if is_retry:
+        dialog_messages = dialog_messages[:-1]  # the retried message isn't part of its own context
+
+    # messages already folded into the running summary are not sent as is
+    dialog_summary = ""
+    if config.enable_dialog_summarization:
+        dialog_summary, n_summarized_messages = db.get_dialog_summary(user_id, dialog_id=dialog_id)
+        dialog_messages = dialog_messages[min(n_summarized_messages, len(dialog_messages)):]
+
+    memory_snippets = []
+    long_term_memory = get_bot_state().long_term_memory
+    if long_term_memory is not None:
+        if not long_term_memory.is_loaded(user_id):
+            long_term_memory.load(user_id, db.get_recent_dialogs(user_id, config.long_term_memory_n_dialogs, exclude_dialog_id=dialog_id))
+
+        memory_snippets = long_term_memory.search(
+            user_id, message,
+            exclude_dialog_id=dialog_id,
+            top_k=config.long_term_memory_top_k,
+            min_similarity=config.long_term_memory_min_similarity
+        )
+        memory_snippets = openai_utils.fit_to_token_budget(memory_snippets, config.long_term_memory_max_tokens, model=current_model)
+
+    chat_mode_dict = db.get_chat_modes(user_id)[chat_mode_index]
+
+    # reserved against the user's quotas before the request
+    n_estimated_tokens = 0
+    if get_bot_state().quota_tracker is not None:
+        n_estimated_tokens = openai_utils.estimate_n_tokens(
+            message, dialog_messages, chat_mode_dict["prompt_start"], dialog_summary, memory_snippets,
+            model=current_model, n_candidates=n_candidates
+        )
+        load_quota_usage(user_id)
+
+    return current_model, dialog_id, dialog_messages, dialog_summary, memory_snippets, chat_mode_dict, n_estimated_tokens
+
+
+def load_quota_usage(user_id: int):
+    # one read per user while the counters stay in memory
+    quota_tracker = get_bot_state().quota_tracker
+    if not quota_tracker.is_loaded(user_id):
+        quota_tracker.load(user_id, db.get_user_attribute(user_id, "quota_usage"))
+
+
+def reserve_quota(user_id: int, model: str, amount: float):
+    # None if quotas are disabled, raises quotas.QuotaExceeded
+    quota_tracker = get_bot_state().quota_tracker
+    if quota_tracker is None:
+        return None
+
+    load_quota_usage(user_id)
+    return quota_tracker.reserve(user_id, model, amount)
+
+
+def reconcile_quota(reservation: Optional[quotas.Reservation], amount: float):
+    # quota usage to be saved with the usage update
+    if reservation is None:
+        return None
+
+    return get_bot_state().quota_tracker.reconcile(reservation, amount)
+
+
+def get_overload_level():
+    if overload_controller is None:
+        return overload.NORMAL
+
+    return overload_controller.level
+
+
+async def reply_overloaded(update: Update):
+    text = "😔 The bot is <b>overloaded</b> right now. Please, try again in a minute!"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
+def get_quota_exceeded_text(e: quotas.QuotaExceeded):
+    when = "tomorrow" if e.period_type == "daily" else "next month"
+    return f"⛔️ You've reached your <b>{e.period_type}</b> limit for <b>{e.model}</b>. Please, come back {when}!"
+
+
+async def moderate_message(message: str):
+    # moderation errors let the message through, so that they don't break replies
+    try:
+        return await openai_utils.is_content_acceptable(message)
+    except Exception as e:
+        logger.error(f"Failed to moderate message, letting it through. Reason: {e}")
+        return True
+
+
+def consume_task_exception(task: asyncio.Task):
+    # fire-and-forget Telegram calls: log failures instead of "exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Background Telegram request failed. Reason: {task.exception()}")
+
+
+def schedule_dialog_summarization(user_id: int):
+    dialog_id = db.get_user_attribute(user_id, "current_dialog_id")
+    if dialog_id in dialog_summarization_tasks:
+        return
+
+    task = asyncio.create_task(summarize_dialog(user_id, dialog_id))
+    dialog_summarization_tasks[dialog_id] = task
+    task.add_done_callback(lambda _: dialog_summarization_tasks.pop(dialog_id, None))
+
+
+async def summarize_dialog(user_id: int, dialog_id: str):
+    model = config.dialog_summarization_model
+
+    try:
+        dialog_messages = db.get_dialog_messages(user_id, dialog_id=dialog_id)
+        dialog_summary, n_summarized_messages = db.get_dialog_summary(user_id, dialog_id=dialog_id)
+        n_summarized_messages = min(n_summarized_messages, len(dialog_messages))
+
+        if openai_utils.count_dialog_tokens(dialog_messages[n_summarized_messages:], model=model) <= config.dialog_summarization_threshold:
+            return
+
+        # fold everything except the most recent messages into the summary
+        n_new_summarized_messages = max(n_summarized_messages, len(dialog_messages) - config.n_dialog_messages_to_keep)
+        if n_new_summarized_messages == n_summarized_messages:
+            return
+
+        chatgpt_instance = openai_utils.ChatGPT(model=model)
+        new_dialog_summary, (n_input_tokens, n_output_tokens) = await chatgpt_instance.summarize_dialog(
+            dialog_summary,
+            dialog_messages[n_summarized_messages:n_new_summarized_messages]
+        )
+
+        db.set_dialog_summary(user_id, new_dialog_summary, n_new_summarized_messages, dialog_id=dialog_id)
+
+        # counted, but not limited: summarization isn't requested by the user
+        quota_usage = None
+        if get_bot_state().quota_tracker is not None:
+            quota_usage = get_bot_state().quota_tracker.add(user_id, model, n_input_tokens + n_output_tokens)
+        db.update_n_used_tokens(user_id, model, n_input_tokens, n_output_tokens, quota_usage=quota_usage)
+    except Exception as e:
+        logger.error(f"Failed to summarize dialog {dialog_id}. Reason: {e}")
 
 
 async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    if user_semaphores[user_id].locked():
+    if get_bot_state().user_semaphores[user_id].locked():
         text = "⏳ Please <b>wait</b> for a reply to the previous message\n"
         text += "Or you can /cancel it"
         await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
@@ -354,19 +904,44 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
 
 
 async def voice_message_handle(update: Update, context: CallbackContext):
-    # check if bot was mentioned (for group chats)
-    if not await is_bot_mentioned(update, context):
-        return
-
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
-    placeholder_message = await update.message.reply_text("transcribing ...")
+    # rejected before transcription, which would be wasted
+    if get_overload_level() >= overload.REJECTING:
+        await reply_overloaded(update)
+        return
 
     voice = update.message.voice
+    try:
+        quota_reservation = reserve_quota(user_id, "whisper", voice.duration)
+    except quotas.QuotaExceeded as e:
+        await update.message.reply_text(get_quota_exceeded_text(e), parse_mode=ParseMode.HTML)
+        return
+
+    placeholder_message = await update.message.reply_text("transcribing ...")
+
+    try:
+        transcribed_text = await transcribe_voice(context, voice)
+    except BaseException:
+        reconcile_quota(quota_reservation, 0)
+        raise
+
+    text = f"🎤: <i>{transcribed_text}</i>"
+    await context.bot.edit_message_text(text, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
+
+    # await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+    # update n_transcribed_seconds
+    db.add_n_transcribed_seconds(user_id, voice.duration, quota_usage=reconcile_quota(quota_reservation, voice.duration))
+
+    await message_handle(update, context, message=transcribed_text)
+
+
+async def transcribe_voice(context: CallbackContext, voice: telegram.Voice):
     with tempfile.TemporaryDirectory() as tmp_dir:
         tmp_dir = Path(tmp_dir)
         voice_ogg_path = tmp_dir / "voice.ogg"
@@ -377,6 +952,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
 
         # convert to mp3
         voice_mp3_path = tmp_dir / "voice.mp3"
+        import pydub
         pydub.AudioSegment.from_file(voice_ogg_path).export(voice_mp3_path, format="mp3")
 
         # transcribe
@@ -386,15 +962,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
             if transcribed_text is None:
                  transcribed_text = ""
 
-    text = f"🎤: <i>{transcribed_text}</i>"
-    await context.bot.edit_message_text(text, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
-
-    # await update.message.reply_text(text, parse_mode=ParseMode.HTML)
-
-    # update n_transcribed_seconds
-    db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
-
-    await message_handle(update, context, message=transcribed_text)
+    return transcribed_text
 
 
 async def generate_image_handle(update: Update, context: CallbackContext, message=None):
@@ -402,24 +970,43 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     await update.message.chat.send_action(action="upload_photo")
 
     message = message or update.message.text
 
+    # checked before the request: images are billed even if the request is cancelled,
+    # and moderation is fast compared to image generation
+    if config.get_snapshot().is_chat_mode_moderated("artist") and not await moderate_message(message):
+        text = "🥲 Your request <b>doesn't comply</b> with OpenAI's usage policies."
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        return
+
+    try:
+        quota_reservation = reserve_quota(user_id, "dalle-2", config.return_n_generated_images)
+    except quotas.QuotaExceeded as e:
+        await update.message.reply_text(get_quota_exceeded_text(e), parse_mode=ParseMode.HTML)
+        return
+
+    openai = openai_utils.get_openai()
     try:
         image_urls = await openai_utils.generate_images(message, n_images=config.return_n_generated_images)
     except openai.error.InvalidRequestError as e:
+        reconcile_quota(quota_reservation, 0)
         if str(e).startswith("Your request was rejected as a result of our safety system"):
             text = "🥲 Your request <b>doesn't comply</b> with OpenAI's usage policies."
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
             return
         else:
             raise
+    except BaseException:
+        reconcile_quota(quota_reservation, 0)
+        raise
 
     # token usage
-    db.set_user_attribute(user_id, "n_generated_images", config.return_n_generated_images + db.get_user_attribute(user_id, "n_generated_images"))
+    quota_usage = reconcile_quota(quota_reservation, config.return_n_generated_images)
+    db.add_n_generated_images(user_id, config.return_n_generated_images, quota_usage=quota_usage)
 
     for i, image_url in enumerate(image_urls):
         await update.message.chat.send_action(action="upload_photo")
@@ -431,7 +1018,7 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     db.start_new_dialog(user_id)
     await update.message.reply_text("Starting new dialog ✅")
@@ -444,22 +1031,52 @@ async def cancel_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
+
+    bot_state = get_bot_state()
 
-    if user_id in user_tasks:
-        task = user_tasks[user_id]
+    # drop messages waiting for the current reply
+    n_dropped_messages = 0
+    for (queue_user_id, _), queue in bot_state.user_message_queues.items():
+        if queue_user_id == user_id:
+            n_dropped_messages += len(queue)
+            queue.clear()
+
+    if user_id in bot_state.user_tasks:
+        task = bot_state.user_tasks[user_id]
         task.cancel()
+        if n_dropped_messages > 0:
+            await update.message.reply_text(f"✅ Dropped <b>{n_dropped_messages}</b> queued message(s)", parse_mode=ParseMode.HTML)
     elif is_in_command_conversation(update, context):
         context.user_data.clear()
         await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
+    elif n_dropped_messages > 0:
+        await update.message.reply_text(f"✅ Canceled, dropped <b>{n_dropped_messages}</b> queued message(s)", parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text("<i>Nothing to cancel...</i>", parse_mode=ParseMode.HTML)
 
 
 def get_chat_mode_menu(user_id: int, page_index: int, action="set_chat_mode"):
+    user_dict = db.get_user_attributes(user_id, ["current_chat_mode", "chat_modes_version"])
+    current_mode = user_dict["current_chat_mode"]
+    chat_modes_version = (user_dict["chat_modes_version"] or 0, config.get_snapshot().version)
+
+    chat_mode_menu_cache = get_bot_state().chat_mode_menu_cache
+    cached_version, user_menus = chat_mode_menu_cache.get(user_id, (None, None))
+    if cached_version != chat_modes_version:
+        user_menus = {}
+        chat_mode_menu_cache.set(user_id, (chat_modes_version, user_menus))
+
+    menu_key = (page_index, action, current_mode)
+    if menu_key not in user_menus:
+        user_menus[menu_key] = render_chat_mode_menu(db.get_chat_modes(user_id), page_index, action, current_mode)
+
+    return user_menus[menu_key]
+
+
+def render_chat_mode_menu(chat_modes: list, page_index: int, action: str, current_mode: str):
     n_chat_modes_per_page = config.n_chat_modes_per_page
-    current_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    
+
     if action == "edit_chat_mode":
         text = f"Select the <b>chat mode</b> from below to <b>edit</b>"
     elif action == "delete_chat_mode":
@@ -469,12 +1086,12 @@ def get_chat_mode_menu(user_id: int, page_index: int, action="set_chat_mode"):
         text = f"Current mode: <b>{current_mode}</b> \nSelect <b>chat mode</b> from below \nYou can also /add, /edit or /delete a chat mode"
 
     # buttons
-    chat_modes = db.get_chat_modes(user_id)
-    page_chat_modes = chat_modes[page_index * n_chat_modes_per_page:(page_index + 1) * n_chat_modes_per_page]
+    page_start = page_index * n_chat_modes_per_page
+    page_chat_modes = chat_modes[page_start:page_start + n_chat_modes_per_page]
     keyboard = []
-    for chat_mode in page_chat_modes:
+    for i, chat_mode in enumerate(page_chat_modes):
         name = chat_mode["name"]
-        key = chat_modes.index(chat_mode)
+        key = page_start + i
         keyboard.append([InlineKeyboardButton(name, callback_data=f"{action}|{key}")])
 
     # pagination
@@ -507,7 +1124,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     text, reply_markup = get_chat_mode_menu(user_id, 0)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
@@ -519,7 +1136,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
      if await is_previous_message_not_answered_yet(update.callback_query, context): return
 
      user_id = update.callback_query.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     db.set_last_interaction(user_id, datetime.now())
 
      query = update.callback_query
      await query.answer()
@@ -574,7 +1191,7 @@ async def add_chat_mode_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     text = "What is the <b>name</b> for the new mode?"
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -584,7 +1201,7 @@ async def add_chat_mode_handle(update: Update, context: CallbackContext):
 
 async def add_chat_mode_callback_handle(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     if context.user_data['add_mode_state'] == 'mode_name':
         context.user_data['mode_name'] = update.message.text
@@ -607,7 +1224,7 @@ async def add_chat_mode_callback_handle(update: Update, context: CallbackContext
         }
 
         chat_modes += [new_chat_mode]
-        db.set_user_attribute(user_id, "chat_modes", chat_modes)
+        db.set_chat_modes(user_id, chat_modes)
 
         text = f"👩🏼‍🎓 {context.user_data['mode_name']} has been added to the modes list"
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -633,7 +1250,7 @@ async def edit_chat_mode_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     context.user_data['edit_mode_state'] = "mode_name"
 
@@ -700,7 +1317,7 @@ async def use_current_prompt_callback_handle(update: Update, context: CallbackCo
 
 async def edit_chat_mode_content_handle(update: Update, context: CallbackContext, user: User):
     user_id = user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
     chat_modes = db.get_chat_modes(user_id)
     mode_index_to_edit = context.user_data['mode_index_to_edit']
 
@@ -737,7 +1354,7 @@ async def edit_chat_mode_content_handle(update: Update, context: CallbackContext
         }
 
         chat_modes[mode_index_to_edit] = edited_chat_mode
-        db.set_user_attribute(user_id, "chat_modes", chat_modes)
+        db.set_chat_modes(user_id, chat_modes)
 
         text = f"👩🏼‍🎓 <b>{context.user_data['mode_name']}</b> has been updated"
         try: 
@@ -770,7 +1387,7 @@ async def delete_chat_mode_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     context.user_data['delete_mode_state'] = "delete"
 
@@ -807,14 +1424,14 @@ async def delete_chat_mode_callback_handle(update: Update, context: CallbackCont
 
 async def delete_chat_mode_confirm_handle(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
     chat_modes = db.get_chat_modes(user_id)
     chat_mode_delete_index = context.user_data['mode_index_to_delete']
 
     if update.message.text.lower() == "yes":
         del_name = chat_modes[chat_mode_delete_index]['name']
         del chat_modes[chat_mode_delete_index]
-        db.set_user_attribute(user_id, "chat_modes", chat_modes)
+        db.set_chat_modes(user_id, chat_modes)
 
         current_mode_index = db.get_user_attribute(user_id, "current_chat_mode_index")
 
@@ -844,10 +1461,15 @@ async def delete_chat_mode_confirm_handle(update: Update, context: CallbackConte
 
 def get_settings_menu(user_id: int):
     current_model = db.get_user_attribute(user_id, "current_model")
-    text = config.models["info"][current_model]["description"]
+    return render_settings_menu(current_model, config.get_snapshot())
+
+
+@functools.lru_cache(maxsize=64)
+def render_settings_menu(current_model: str, snapshot: config.ConfigSnapshot):
+    text = snapshot.models["info"][current_model]["description"]
 
     text += "\n\n"
-    score_dict = config.models["info"][current_model]["scores"]
+    score_dict = snapshot.models["info"][current_model]["scores"]
     for score_key, score_value in score_dict.items():
         text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n\n"
 
@@ -855,8 +1477,8 @@ def get_settings_menu(user_id: int):
 
     # buttons to choose models
     buttons = []
-    for model_key in config.models["available_text_models"]:
-        title = config.models["info"][model_key]["name"]
+    for model_key in snapshot.available_text_models:
+        title = snapshot.models["info"][model_key]["name"]
         if model_key == current_model:
             title = "✅ " + title
 
@@ -873,7 +1495,7 @@ async def settings_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     text, reply_markup = get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
@@ -902,42 +1524,39 @@ async def show_balance_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    # count total usage statistics
-    total_n_spent_dollars = 0
-    total_n_used_tokens = 0
-
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
+    db.set_last_interaction(user_id, datetime.now())
+
+    user_dict = db.get_user_attributes(user_id, [
+        "usage",
+        "total_n_spent_dollars",
+        "total_n_used_tokens",
+        "n_generated_images",
+        "n_transcribed_seconds"
+    ])
+    usage_dict = user_dict["usage"] or {}
+    total_n_spent_dollars = user_dict["total_n_spent_dollars"] or 0.0
+    total_n_used_tokens = user_dict["total_n_used_tokens"] or 0
+    n_generated_images = user_dict["n_generated_images"] or 0
+    n_transcribed_seconds = user_dict["n_transcribed_seconds"] or 0.0
 
     details_text = "🏷️ Details:\n"
-    for model_key in sorted(n_used_tokens_dict.keys()):
-        n_input_tokens, n_output_tokens = n_used_tokens_dict[model_key]["n_input_tokens"], n_used_tokens_dict[model_key]["n_output_tokens"]
-        total_n_used_tokens += n_input_tokens + n_output_tokens
-
-        n_input_spent_dollars = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_input_tokens / 1000)
-        n_output_spent_dollars = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
-        total_n_spent_dollars += n_input_spent_dollars + n_output_spent_dollars
+    for usage_key in sorted(usage_dict.keys()):
+        if usage_key in {"dalle-2", "whisper"}:
+            continue
 
-        details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}$</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
+        model_usage = usage_dict[usage_key]
+        details_text += f"- {model_usage['name']}: <b>{model_usage['n_spent_dollars']:.03f}$</b> / <b>{model_usage['n_used_tokens']} tokens</b>\n"
 
     # image generation
-    image_generation_n_spent_dollars = config.models["info"]["dalle-2"]["price_per_1_image"] * n_generated_images
     if n_generated_images != 0:
+        image_generation_n_spent_dollars = usage_dict.get("dalle-2", {}).get("n_spent_dollars", 0.0)
         details_text += f"- DALL·E 2 (image generation): <b>{image_generation_n_spent_dollars:.03f}$</b> / <b>{n_generated_images} generated images</b>\n"
 
-    total_n_spent_dollars += image_generation_n_spent_dollars
-
     # voice recognition
-    voice_recognition_n_spent_dollars = config.models["info"]["whisper"]["price_per_1_min"] * (n_transcribed_seconds / 60)
     if n_transcribed_seconds != 0:
+        voice_recognition_n_spent_dollars = usage_dict.get("whisper", {}).get("n_spent_dollars", 0.0)
         details_text += f"- Whisper (voice recognition): <b>{voice_recognition_n_spent_dollars:.03f}$</b> / <b>{n_transcribed_seconds:.01f} seconds</b>\n"
 
-    total_n_spent_dollars += voice_recognition_n_spent_dollars
-
-
     text = f"You spent <b>${total_n_spent_dollars:.03f}</b>\n"
     text += f"You used <b>{total_n_used_tokens}</b> tokens\n\n"
     text += details_text
@@ -976,7 +1595,84 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
     except:
         await context.bot.send_message(update.effective_chat.id, "Some error in error handler")
 
+async def archive_dialogs_loop():
+    while True:
+        try:
+            n_archived_dialogs = await run_in_executor(
+                db.archive_old_dialogs,
+                config.dialog_archive_after_days,
+                config.n_recent_dialogs_per_user
+            )
+            if n_archived_dialogs > 0:
+                logger.info(f"Archived {n_archived_dialogs} dialogs of bot {config.current_bot.get()}")
+        except Exception as e:
+            logger.error(f"Failed to archive dialogs. Reason: {e}")
+
+        await asyncio.sleep(config.dialog_archive_interval)
+
+
+async def flush_last_interactions_loop():
+    while True:
+        await asyncio.sleep(config.last_interaction_flush_interval)
+
+        try:
+            await run_in_executor(db.flush_last_interactions)
+        except Exception as e:
+            logger.error(f"Failed to flush last interactions. Reason: {e}")
+
+
+async def reload_config_loop():
+    while True:
+        await asyncio.sleep(config.config_reload_interval)
+
+        try:
+            # reads and parses the files, off the event loop
+            if await run_in_executor(config.reload_if_changed):
+                logger.info(f"Reloaded chat modes and models config (version {config.get_snapshot().version})")
+
+                # cached answers may have been generated with the old prompts
+                for bot_state in bot_states.values():
+                    if bot_state.semantic_cache is not None:
+                        bot_state.semantic_cache.clear()
+        except Exception as e:
+            logger.error(f"Failed to reload config, keeping the previous one. Reason: {e}")
+
+
+def create_background_task(coroutine):
+    # keep a reference, so that the task isn't garbage collected
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return task
+
+
+def run_in_executor(fn, *args):
+    # thread pool threads don't inherit context variables, config.current_bot among them
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, fn, *args))
+
+
+async def warm_up_tokenizers():
+    # load encodings ahead of the first streamed reply, encodings are shared by all bots
+    models = {config.dialog_summarization_model}
+    for bot_config in config.bots:
+        with config.bot_context(bot_config.name):
+            models |= set(config.get_snapshot().available_text_models)
+
+    try:
+        await run_in_executor(openai_utils.warm_up_tokenizers, sorted(models))
+    except Exception as e:
+        logger.error(f"Failed to load tokenizers. Reason: {e}")
+
+
 async def post_init(application: Application):
+    # called in the bot's context, so the tasks inherit it
+    create_background_task(flush_last_interactions_loop())
+
+    if config.enable_dialog_archiving:
+        create_background_task(archive_dialogs_loop())
+
     await application.bot.set_my_commands([
         BotCommand("/new", "start new dialog"),
         BotCommand("/mode", "select a chat mode"),
@@ -990,33 +1686,68 @@ async def post_init(application: Application):
         BotCommand("/help", "show help message"),
     ])
 
-def run_bot() -> None:
+async def post_shutdown(application: Application):
+    bot_state = get_bot_state()
+
+    if bot_state.semantic_cache is not None:
+        logger.info(f"Semantic cache of bot {bot_state.bot_config.name}: {bot_state.semantic_cache.n_hits} hits, {bot_state.semantic_cache.n_misses} misses")
+
+    db.flush_last_interactions()
+
+
+def create_bot_state(bot_config: config.BotConfig, database_client):
+    bot_state = BotState(bot_config, database.open_database(database_name=bot_config.database_name, client=database_client))
+
+    if config.enable_semantic_cache:
+        # imported here, so that numpy isn't loaded when the cache is disabled
+        from semantic_cache import SemanticCache
+        bot_state.semantic_cache = SemanticCache(max_n_entries=config.semantic_cache_size)
+
+    if config.enable_quotas:
+        bot_state.quota_tracker = quotas.QuotaTracker(config.quotas)
+
+    if config.enable_long_term_memory:
+        from long_term_memory import LongTermMemory
+        bot_state.long_term_memory = LongTermMemory(
+            max_n_users=config.long_term_memory_max_n_users,
+            max_n_entries=config.long_term_memory_max_n_entries
+        )
+
+    return bot_state
+
+
+def build_application(bot_config: config.BotConfig):
+    if overload_controller is not None:
+        rate_limiter = overload.OverloadRateLimiter(overload_controller, max_retries=5)
+    else:
+        rate_limiter = AIORateLimiter(max_retries=5)
+
     application = (
         ApplicationBuilder()
-        .token(config.telegram_token)
+        .token(bot_config.telegram_token)
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=5))
-        .post_init(post_init)
+        .rate_limiter(rate_limiter)
         .build()
     )
 
     # add handlers
     user_filter = filters.ALL
-    if len(config.allowed_telegram_usernames) > 0:
-        usernames = [x for x in config.allowed_telegram_usernames if isinstance(x, str)]
-        user_ids = [x for x in config.allowed_telegram_usernames if isinstance(x, int)]
+    if len(bot_config.allowed_telegram_usernames) > 0:
+        usernames = [x for x in bot_config.allowed_telegram_usernames if isinstance(x, str)]
+        user_ids = [x for x in bot_config.allowed_telegram_usernames if isinstance(x, int)]
         user_filter = filters.User(username=usernames) | filters.User(user_id=user_ids)
 
     application.add_handler(CommandHandler("start", start_handle, filters=user_filter))
     application.add_handler(CommandHandler("help", help_handle, filters=user_filter))
     application.add_handler(CommandHandler("help_group_chat", help_group_chat_handle, filters=user_filter))
 
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, message_handle))
+    # group messages not addressed to the bot are dropped by bot_mention_filter (checked last)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter & bot_mention_filter, message_handle))
     application.add_handler(CommandHandler("retry", retry_handle, filters=user_filter))
     application.add_handler(CommandHandler("new", new_dialog_handle, filters=user_filter))
     application.add_handler(CommandHandler("cancel", cancel_handle, filters=user_filter))
 
-    application.add_handler(MessageHandler(filters.VOICE & user_filter, voice_message_handle))
+    application.add_handler(MessageHandler(filters.VOICE & user_filter & bot_mention_filter, voice_message_handle))
 
     application.add_handler(CommandHandler("mode", show_chat_modes_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(show_chat_modes_callback_handle, pattern="^show_chat_modes"))
@@ -1032,14 +1763,90 @@ def run_bot() -> None:
 
     application.add_handler(CommandHandler("settings", settings_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(set_settings_handle, pattern="^set_settings"))
+    application.add_handler(CallbackQueryHandler(next_answer_candidate_handle, pattern="^next_candidate"))
 
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
 
     application.add_error_handler(error_handle)
 
-    # start the bot
-    application.run_polling()
+    return application
+
+
+async def run_applications(applications: dict):
+    # all bots share the event loop, the OpenAI HTTP session, the database client and the tokenizers
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    openai_session = await openai_utils.open_http_session()
+
+    create_background_task(warm_up_tokenizers())
+    create_background_task(reload_config_loop())
+    if overload_controller is not None:
+        create_background_task(overload_controller.run())
+
+    loop_watchdog = None
+    if config.enable_loop_watchdog:
+        loop_watchdog = LoopWatchdog(threshold=config.loop_watchdog_threshold, interval=config.loop_watchdog_interval)
+        create_background_task(loop_watchdog.run())
+
+    started_applications = []
+    try:
+        for name, application in applications.items():
+            # the application's update fetcher task is created in start() and inherits the bot's
+            # context, so do the handlers of all updates it processes
+            with config.bot_context(name):
+                await application.initialize()
+                await post_init(application)
+                await application.updater.start_polling()
+                await application.start()
+            started_applications.append((name, application))
+            logger.info(f"Started bot {name} (@{application.bot.username})")
+
+        await stop_event.wait()
+    finally:
+        for name, application in reversed(started_applications):
+            with config.bot_context(name):
+                try:
+                    await application.updater.stop()
+                    await application.stop()
+                    await post_shutdown(application)
+                    await application.shutdown()
+                except Exception as e:
+                    logger.error(f"Failed to stop bot {name}. Reason: {e}")
+
+        logger.info(f"Dropped {bot_mention_filter.n_dropped_updates} group messages not addressed to the bot")
+        if loop_watchdog is not None:
+            logger.info(f"Event loop was blocked {loop_watchdog.n_blocks} times, max lag {loop_watchdog.max_lag:.3f}s")
+
+        for task in list(background_tasks):
+            task.cancel()
+
+        await openai_session.close()
+
+
+def run_bot() -> None:
+    global overload_controller
+
+    database_client = database.create_client()
+
+    if config.enable_overload_control:
+        overload_controller = overload.OverloadController(
+            config.overload_thresholds,
+            openai_utils.get_n_requests_in_flight,
+            update_interval=config.overload_update_interval,
+            recovery_delay=config.overload_recovery_delay
+        )
+
+    applications = {}
+    for bot_config in config.bots:
+        with config.bot_context(bot_config.name):
+            bot_states[bot_config.name] = create_bot_state(bot_config, database_client)
+            applications[bot_config.name] = build_application(bot_config)
 
+    # start the bots
+    asyncio.run(run_applications(applications))
 
 if __name__ == "__main__":
     run_bot()
\ No newline at end of file
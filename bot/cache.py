@@ -0,0 +1,36 @@
+from typing import Any, Hashable
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Bounded in-memory cache that evicts least recently used entries"""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None):
+        if key not in self._data:
+            return default
+
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
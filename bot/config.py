@@ -1,10 +1,14 @@
 import os
 import yaml
 import dotenv
+import contextlib
+import contextvars
 from pathlib import Path
+from types import MappingProxyType
+from dataclasses import dataclass
+from typing import Any, FrozenSet, Mapping, Optional, Tuple
 
 config_dir = Path(__file__).parent.parent.resolve() / "config"
-chat_modes = {}
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -24,30 +28,341 @@ enable_message_streaming = config_yaml.get("enable_message_streaming", True)
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
 n_update_chunk_symbols = config_yaml.get("n_update_chunk_symbols", 50)
+enable_message_queue = config_yaml.get("enable_message_queue", True)
+message_coalescing_delay = config_yaml.get("message_coalescing_delay", 1.0)
+max_n_queued_messages = config_yaml.get("max_n_queued_messages", 10)
+last_interaction_flush_interval = config_yaml.get("last_interaction_flush_interval", 5)
+enable_dialog_summarization = config_yaml.get("enable_dialog_summarization", False)
+dialog_summarization_model = config_yaml.get("dialog_summarization_model", "gpt-3.5-turbo")
+dialog_summarization_threshold = config_yaml.get("dialog_summarization_threshold", 2000)
+n_dialog_messages_to_keep = config_yaml.get("n_dialog_messages_to_keep", 4)
+enable_dialog_archiving = config_yaml.get("enable_dialog_archiving", False)
+dialog_archive_after_days = config_yaml.get("dialog_archive_after_days", 30)
+dialog_archive_ttl_days = config_yaml.get("dialog_archive_ttl_days", 365)
+n_recent_dialogs_per_user = config_yaml.get("n_recent_dialogs_per_user", 100)
+dialog_archive_interval = config_yaml.get("dialog_archive_interval", 3600)
+enable_semantic_cache = config_yaml.get("enable_semantic_cache", False)
+semantic_cache_thresholds = config_yaml.get("semantic_cache_thresholds", {"assistant": 0.92, "english_tutor": 0.92})
+semantic_cache_size = config_yaml.get("semantic_cache_size", 1000)
+semantic_cache_max_message_length = config_yaml.get("semantic_cache_max_message_length", 500)
+enable_long_term_memory = config_yaml.get("enable_long_term_memory", False)
+long_term_memory_n_dialogs = config_yaml.get("long_term_memory_n_dialogs", 50)
+long_term_memory_max_n_entries = config_yaml.get("long_term_memory_max_n_entries", 500)
+long_term_memory_max_n_users = config_yaml.get("long_term_memory_max_n_users", 1000)
+long_term_memory_top_k = config_yaml.get("long_term_memory_top_k", 3)
+long_term_memory_min_similarity = config_yaml.get("long_term_memory_min_similarity", 0.2)
+long_term_memory_max_tokens = config_yaml.get("long_term_memory_max_tokens", 500)
+enable_moderation = config_yaml.get("enable_moderation", False)
+enable_quotas = config_yaml.get("enable_quotas", False)
+quotas = config_yaml.get("quotas") or {}
+enable_overload_control = config_yaml.get("enable_overload_control", False)
+overload_thresholds = config_yaml.get("overload_thresholds") or {
+    "loop_lag": [0.2, 0.5, 1.0, 2.0],
+    "n_openai_requests": [50, 100, 150, 200],
+    "n_telegram_429_per_minute": [5, 20, 50, 100]
+}
+overload_update_interval = config_yaml.get("overload_update_interval", 1.0)
+overload_recovery_delay = config_yaml.get("overload_recovery_delay", 30)
+overload_edit_interval_factor = config_yaml.get("overload_edit_interval_factor", 4)
+overload_max_tokens = config_yaml.get("overload_max_tokens", 500)
+enable_loop_watchdog = config_yaml.get("enable_loop_watchdog", True)
+loop_watchdog_threshold = config_yaml.get("loop_watchdog_threshold", 0.5)
+loop_watchdog_interval = config_yaml.get("loop_watchdog_interval", 0.1)
+retry_n_candidates = config_yaml.get("retry_n_candidates", 3)
 mongodb_uri = os.getenv("MONGO_CONNECT_STRING")
+database_uri = config_yaml.get("database_uri") or mongodb_uri  # selects the storage backend, see database.py
+
+# tiktoken reads BPE files from here instead of downloading them (see Dockerfile)
+tiktoken_cache_dir = Path(__file__).parent.parent.resolve() / config_yaml.get("tiktoken_cache_dir", ".tiktoken_cache")
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(tiktoken_cache_dir))
 #mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
 
-# chat_modes
-with open(config_dir / "chat_modes.yml", 'r') as f:
-    chat_modes = yaml.safe_load(f)
+config_reload_interval = config_yaml.get("config_reload_interval", 10)
 
-def get_default_chat_modes():
-    default_chat_modes = []
-
-    for chat_mode in chat_modes.keys():   
-        new_chat_mode = {
-            "name": chat_modes[chat_mode]["name"],
-            "welcome_message": chat_modes[chat_mode]["welcome_message"],
-            "prompt_start": chat_modes[chat_mode]["prompt_start"],
-            "parse_mode": chat_modes[chat_mode]["parse_mode"]
+
+# chat_modes.yml and models.yml are loaded into an immutable snapshot, which is
+# rebuilt and swapped as a whole when the files change (see reload_if_changed)
+chat_modes_path = config_dir / "chat_modes.yml"
+models_path = config_dir / "models.yml"
+
+
+# several bots can be hosted in one process, each with its own token, database,
+# allowed users and overlays over chat_modes.yml and models.yml
+@dataclass(frozen=True)
+class BotConfig:
+    name: str
+    telegram_token: str
+    database_name: str = "chatgpt_telegram_bot"
+    allowed_telegram_usernames: Tuple = ()
+    chat_modes_overlay_path: Optional[Path] = None
+    models_overlay_path: Optional[Path] = None
+
+
+def _load_bot_configs():
+    if "bots" not in config_yaml:
+        return (BotConfig(name="default", telegram_token=telegram_token, allowed_telegram_usernames=tuple(allowed_telegram_usernames)),)
+
+    bot_configs = []
+    for i, bot_yaml in enumerate(config_yaml["bots"]):
+        name = bot_yaml["name"]
+        token_env = bot_yaml.get("telegram_token_env", "TELEGRAM_TOKEN")
+        if os.getenv(token_env) is None:
+            raise ValueError(f"Bot {name}: {token_env} is not set")
+
+        bot_configs.append(BotConfig(
+            name=name,
+            telegram_token=os.getenv(token_env),
+            # the first bot keeps the single-bot database, the others get their own by default
+            database_name=bot_yaml.get("database_name", "chatgpt_telegram_bot" if i == 0 else f"chatgpt_telegram_bot_{name}"),
+            allowed_telegram_usernames=tuple(bot_yaml.get("allowed_telegram_usernames", allowed_telegram_usernames)),
+            chat_modes_overlay_path=config_dir / bot_yaml["chat_modes"] if "chat_modes" in bot_yaml else None,
+            models_overlay_path=config_dir / bot_yaml["models"] if "models" in bot_yaml else None
+        ))
+
+    if len({bot_config.name for bot_config in bot_configs}) != len(bot_configs):
+        raise ValueError("Bot names must be unique")
+
+    # users are keyed by Telegram user id only, bots sharing a database would share their state
+    if len({bot_config.database_name for bot_config in bot_configs}) != len(bot_configs):
+        raise ValueError("Bot database names must be unique")
+
+    return tuple(bot_configs)
+
+
+bots = _load_bot_configs()
+_bots_by_name = {bot_config.name: bot_config for bot_config in bots}
+
+# bot whose update is being handled, set per application in bot.py; scripts use the first bot
+current_bot = contextvars.ContextVar("current_bot", default=bots[0].name)
+
+
+def get_bot_config():
+    return _bots_by_name[current_bot.get()]
+
+
+@contextlib.contextmanager
+def bot_context(name: str):
+    token = current_bot.set(name)
+    try:
+        yield
+    finally:
+        current_bot.reset(token)
+
+CHAT_MODE_FIELDS = ("name", "welcome_message", "prompt_start", "parse_mode")
+PARSE_MODES = {"html", "markdown"}
+TEXT_MODEL_TYPES = {"chat_completion", "completion"}
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    elif isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    else:
+        return value
+
+
+@dataclass(frozen=True, eq=False)
+class ConfigSnapshot:
+    version: int
+    chat_modes: Mapping[str, Mapping[str, str]]
+    models: Mapping[str, Any]
+
+    # derived
+    available_text_models: Tuple[str, ...]
+    text_models: FrozenSet[str]
+    model_types: Mapping[str, str]
+    token_prices: Mapping[str, Tuple[float, float]]  # model -> (per 1000 input tokens, per 1000 output tokens)
+    price_per_1_image: float
+    price_per_1_min: float  # voice recognition
+    moderated_chat_modes: FrozenSet[str]
+
+    # modes removed from chat_modes.yml by a reload, users who still reference them
+    # keep their last definition until restart (see reload_if_changed)
+    removed_chat_modes: Mapping[str, Mapping[str, str]]
+
+    def get_tokens_price(self, model: str, n_input_tokens: int, n_output_tokens: int):
+        price_per_1000_input_tokens, price_per_1000_output_tokens = self.token_prices.get(model, (0.0, 0.0))
+        return price_per_1000_input_tokens * (n_input_tokens / 1000) + price_per_1000_output_tokens * (n_output_tokens / 1000)
+
+    def is_chat_mode_moderated(self, chat_mode: Optional[str]):
+        # custom chat modes (no key) follow enable_moderation
+        if chat_mode in self.chat_modes:
+            return chat_mode in self.moderated_chat_modes
+        if chat_mode in self.removed_chat_modes:
+            return self.removed_chat_modes[chat_mode].get("moderation", enable_moderation)
+        return enable_moderation
+
+
+def build_snapshot(chat_modes_dict: dict, models_dict: dict, version: int = 0, previous: Optional[ConfigSnapshot] = None):
+    # validate
+    for key, chat_mode in chat_modes_dict.items():
+        for chat_mode_field in CHAT_MODE_FIELDS:
+            if chat_mode_field not in chat_mode:
+                raise ValueError(f"Chat mode {key} has no {chat_mode_field}")
+        if chat_mode["parse_mode"] not in PARSE_MODES:
+            raise ValueError(f"Chat mode {key} has unknown parse_mode: {chat_mode['parse_mode']}")
+        if chat_mode["prompt_start"] is None:
+            chat_mode["prompt_start"] = ""
+        if not isinstance(chat_mode.get("moderation", enable_moderation), bool):
+            raise ValueError(f"Chat mode {key} has non-boolean moderation")
+
+    models_info = models_dict["info"]
+    for model in models_dict["available_text_models"]:
+        if model not in models_info:
+            raise ValueError(f"Model {model} has no info")
+    for model, model_info in models_info.items():
+        if model_info.get("type") in TEXT_MODEL_TYPES:
+            for price_key in ("price_per_1000_input_tokens", "price_per_1000_output_tokens"):
+                if price_key not in model_info:
+                    raise ValueError(f"Model {model} has no {price_key}")
+    for model, price_key in (("dalle-2", "price_per_1_image"), ("whisper", "price_per_1_min")):
+        if price_key not in models_info.get(model, {}):
+            raise ValueError(f"Model {model} has no {price_key}")
+
+    # precompute
+    text_models = frozenset(model for model, model_info in models_info.items() if model_info.get("type") in TEXT_MODEL_TYPES)
+
+    removed_chat_modes = {}
+    if previous is not None:
+        removed_chat_modes = {
+            key: chat_mode for key, chat_mode in {**previous.removed_chat_modes, **previous.chat_modes}.items()
+            if key not in chat_modes_dict
         }
-        default_chat_modes += [new_chat_mode]
 
-    return default_chat_modes
+    return ConfigSnapshot(
+        version=version,
+        chat_modes=_freeze(chat_modes_dict),
+        models=_freeze(models_dict),
+        available_text_models=tuple(models_dict["available_text_models"]),
+        text_models=text_models,
+        model_types=MappingProxyType({model: models_info[model]["type"] for model in text_models}),
+        token_prices=MappingProxyType({
+            model: (float(models_info[model]["price_per_1000_input_tokens"]), float(models_info[model]["price_per_1000_output_tokens"]))
+            for model in text_models
+        }),
+        price_per_1_image=float(models_info["dalle-2"]["price_per_1_image"]),
+        price_per_1_min=float(models_info["whisper"]["price_per_1_min"]),
+        moderated_chat_modes=frozenset(key for key, chat_mode in chat_modes_dict.items() if chat_mode.get("moderation", enable_moderation)),
+        removed_chat_modes=MappingProxyType(removed_chat_modes)
+    )
+
+
+def apply_overlay(chat_modes_dict: dict, models_dict: dict, chat_modes_overlay: dict, models_overlay: dict):
+    # chat modes are replaced by key, null removes a mode
+    for key, chat_mode in chat_modes_overlay.items():
+        if chat_mode is None:
+            chat_modes_dict.pop(key, None)
+        else:
+            chat_modes_dict[key] = chat_mode
+
+    # available_text_models is replaced, model info is merged by model
+    if "available_text_models" in models_overlay:
+        models_dict["available_text_models"] = models_overlay["available_text_models"]
+    for model, model_info in models_overlay.get("info", {}).items():
+        models_dict["info"][model] = {**models_dict["info"].get(model, {}), **model_info}
+
+
+def _load_snapshot(bot_config: BotConfig, version: int = 0, previous: Optional[ConfigSnapshot] = None):
+    with open(chat_modes_path, 'r') as f:
+        chat_modes_dict = yaml.safe_load(f)
+
+    with open(models_path, 'r') as f:
+        models_dict = yaml.safe_load(f)
+
+    chat_modes_overlay, models_overlay = {}, {}
+    if bot_config.chat_modes_overlay_path is not None:
+        with open(bot_config.chat_modes_overlay_path, 'r') as f:
+            chat_modes_overlay = yaml.safe_load(f) or {}
+    if bot_config.models_overlay_path is not None:
+        with open(bot_config.models_overlay_path, 'r') as f:
+            models_overlay = yaml.safe_load(f) or {}
+    apply_overlay(chat_modes_dict, models_dict, chat_modes_overlay, models_overlay)
+
+    return build_snapshot(chat_modes_dict, models_dict, version=version, previous=previous)
+
+
+def _load_snapshots(version: int = 0, previous: Optional[dict] = None):
+    return {
+        bot_config.name: _load_snapshot(bot_config, version=version, previous=previous[bot_config.name] if previous is not None else None)
+        for bot_config in bots
+    }
+
+
+def _get_config_mtimes():
+    paths = {chat_modes_path, models_path}
+    for bot_config in bots:
+        paths |= {path for path in (bot_config.chat_modes_overlay_path, bot_config.models_overlay_path) if path is not None}
+
+    return tuple(os.stat(path).st_mtime_ns for path in sorted(paths))
+
+
+_snapshot_mtimes = _get_config_mtimes()
+_snapshots = _load_snapshots()
+
+# kept for back compatibility (first bot), rebound on reload
+chat_modes = _snapshots[bots[0].name].chat_modes
+models = _snapshots[bots[0].name].models
+
+
+def get_snapshot():
+    return _snapshots[current_bot.get()]
+
+
+def reload_if_changed():
+    """Rebuild the snapshots if chat_modes.yml, models.yml or a bot's overlay changed on disk.
+
+    Returns True if new snapshots were swapped in. If the new files are invalid,
+    the exception is raised and the previous snapshots stay active. Modes removed
+    from chat_modes.yml are kept as removed_chat_modes, so that users who selected
+    them keep talking to the same prompt until the next restart.
+    """
+    global _snapshots, _snapshot_mtimes, chat_modes, models
+
+    mtimes = _get_config_mtimes()
+    if mtimes == _snapshot_mtimes:
+        return False
+
+    # don't retry the same broken files on every check
+    _snapshot_mtimes = mtimes
+
+    # all bots are rebuilt together, so that they share the version number
+    snapshots = _load_snapshots(version=_snapshots[bots[0].name].version + 1, previous=_snapshots)
+    _snapshots = snapshots
+    chat_modes, models = snapshots[bots[0].name].chat_modes, snapshots[bots[0].name].models
+
+    return True
+
+
+def get_default_chat_mode(key: str):
+    snapshot = get_snapshot()
+    chat_mode = snapshot.chat_modes[key] if key in snapshot.chat_modes else snapshot.removed_chat_modes[key]
+    return {
+        "key": key,
+        "name": chat_mode["name"],
+        "welcome_message": chat_mode["welcome_message"],
+        "prompt_start": chat_mode["prompt_start"],
+        "parse_mode": chat_mode["parse_mode"]
+    }
+
+def get_removed_chat_mode(key: str):
+    # stands in for a reference to a mode no longer in chat_modes.yml, so that the positions
+    # of the user's other modes (and current_chat_mode_index) don't shift
+    return {
+        "key": key,
+        "name": f"⚠️ {key} (removed)",
+        "welcome_message": "⚠️ This chat mode was removed. Choose another one with /mode",
+        "prompt_start": "",
+        "parse_mode": "html",
+        "removed": True
+    }
+
+def get_default_chat_modes():
+    return [get_default_chat_mode(chat_mode) for chat_mode in get_snapshot().chat_modes.keys()]
 
-# models
-with open(config_dir / "models.yml", 'r') as f:
-    models = yaml.safe_load(f)
+def get_default_chat_mode_refs():
+    # built-in chat modes are stored in user documents by key only
+    return [{"key": chat_mode} for chat_mode in get_snapshot().chat_modes.keys()]
 
 # files
 help_group_chat_video_path = Path(__file__).parent.parent.resolve() / "static" / "help_group_chat.mp4"
@@ -1,23 +1,127 @@
-from typing import Optional, Any
+"""Storage of users, dialogs and static asset file ids
+
+Database is the interface used by the bot. The backend is selected by the
+scheme of database_uri (see open_database):
+
+    mongodb://, mongodb+srv://  MongoDatabase (mongo_database.py)
+    sqlite:///<directory>       SQLiteDatabase (sqlite_database.py), one file per database name
+    memory://                   MemoryDatabase (memory_database.py), for tests and benchmarks
+
+Logic that doesn't depend on the backend lives here. User documents are
+updated with MongoDB's update operators ($set, $inc, $max), which the other
+backends apply in Python (see document_database.apply_update).
+"""
 
-import pymongo
 import uuid
-from datetime import datetime
-from pymongo.server_api import ServerApi
+import importlib
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
 
 import config
 
 
-class Database:
+BACKENDS = {
+    "mongodb": ("mongo_database", "MongoDatabase"),
+    "mongodb+srv": ("mongo_database", "MongoDatabase"),
+    "sqlite": ("sqlite_database", "SQLiteDatabase"),
+    "memory": ("memory_database", "MemoryDatabase")
+}
+
+
+def get_backend(uri: Optional[str] = None):
+    uri = uri or config.database_uri
+    if uri is None:
+        raise ValueError("Database URI is not set (database_uri in config.yml or MONGO_CONNECT_STRING in config.env)")
+
+    scheme = uri.split("://", 1)[0].lower()
+    if scheme not in BACKENDS:
+        raise ValueError(f"Unknown database URI scheme: {scheme}")
+
+    return scheme
+
+
+def create_client(uri: Optional[str] = None):
+    # shared by the databases of all bots, None for backends without a client
+    uri = uri or config.database_uri
+    if BACKENDS[get_backend(uri)][0] == "mongo_database":
+        from mongo_database import create_client as create_mongo_client
+        return create_mongo_client(uri)
+
+    return None
+
+
+def open_database(database_name: str = "chatgpt_telegram_bot", uri: Optional[str] = None, client: Any = None):
+    # backends are imported on first use, so that e.g. pymongo isn't needed with SQLite
+    uri = uri or config.database_uri
+    module_name, class_name = BACKENDS[get_backend(uri)]
+
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(database_name=database_name, uri=uri, client=client)
+
+
+class Database(ABC):
+    """Storage interface of the bot, see the module docstring for the backends"""
+
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri, server_api=ServerApi('1'))
-        self.db = self.client["chatgpt_telegram_bot"]
+        # write-behind buffer for last_interaction: user_id -> datetime
+        self.last_interactions = {}
+        self.last_interactions_lock = threading.Lock()
+
+        # users active since the previous archiver pass (under last_interactions_lock), only they can
+        # have new excess dialogs; the first pass of the process checks all users
+        self.active_user_ids = set()
+        self.are_all_users_checked = False
 
-        self.user_collection = self.db["user"]
-        self.dialog_collection = self.db["dialog"]
+    # backend primitives
+
+    @abstractmethod
+    def _find_user(self, user_id: int, keys: list) -> Optional[dict]:
+        # the requested fields of the user document (missing ones are left out), None if the user doesn't exist
+        raise NotImplementedError
+
+    @abstractmethod
+    def _insert_user(self, user_dict: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _update_user(self, user_id: int, update: dict, unless_exists: Optional[str] = None) -> bool:
+        # applies a MongoDB update document, skipped if the field unless_exists is set; False if the user doesn't exist
+        raise NotImplementedError
+
+    @abstractmethod
+    def _save_last_interactions(self, last_interactions: dict):
+        # {user_id: datetime}, newer stored values are kept
+        raise NotImplementedError
+
+    @abstractmethod
+    def _insert_dialog(self, dialog_dict: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _iter_user_chat_modes(self, batch_size: int) -> Iterator[Tuple[int, list]]:
+        # (user_id, chat_modes) of users with embedded chat modes
+        raise NotImplementedError
+
+    @abstractmethod
+    def _set_users_chat_modes(self, user_chat_modes: List[Tuple[int, list]]) -> int:
+        # returns the number of updated users
+        raise NotImplementedError
+
+    @abstractmethod
+    def _find_old_dialog_ids(self, start_time_threshold: datetime, batch_size: int) -> Iterator[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _find_excess_dialog_ids(self, max_dialogs_per_user: int, batch_size: int, user_ids: Optional[Iterable[int]] = None) -> Iterator[str]:
+        # ids of dialogs after the newest max_dialogs_per_user of each of user_ids (all users if None)
+        raise NotImplementedError
+
+    # users
 
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        if self._find_user(user_id, ["_id"]) is not None:
             return True
         else:
             if raise_exception:
@@ -47,96 +151,362 @@ class Database:
             "current_dialog_id": None,
             "current_chat_mode": "assistant",
             "current_chat_mode_index": 0,
-            "current_model": config.models["available_text_models"][0],
+            "current_model": config.get_snapshot().available_text_models[0],
 
             "n_used_tokens": {},
 
+            # running totals, priced at the time of use
+            "usage": {},
+            "total_n_spent_dollars": 0.0,
+            "total_n_used_tokens": 0,
+
             "n_generated_images": 0,
             "n_transcribed_seconds": 0.0,  # voice message transcription
 
-            "chat_modes": config.get_default_chat_modes()
+            "chat_modes": config.get_default_chat_mode_refs()
         }
 
         if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+            self._insert_user(user_dict)
 
     def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = self.get_user_attributes(user_id, ["current_chat_mode", "current_model"])
 
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": user_dict["current_chat_mode"],
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
+            "model": user_dict["current_model"],
             "messages": []
         }
 
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        self._insert_dialog(dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
-        )
+        self._update_user(user_id, {"$set": {"current_dialog_id": dialog_id}})
+
+        with self.last_interactions_lock:
+            self.active_user_ids.add(user_id)
 
         return dialog_id
-    
+
     def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+        return self.get_user_attributes(user_id, [key])[key]
 
-        if key not in user_dict:
-            return None
+    def get_user_attributes(self, user_id: int, keys: list):
+        # fetch only the requested fields; missing fields are returned as None
+        user_dict = self._find_user(user_id, keys)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
-        return user_dict[key]
+        return {key: user_dict.get(key) for key in keys}
 
     def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        if not self._update_user(user_id, {"$set": {key: value}}):
+            raise ValueError(f"User {user_id} does not exist")
 
-    def add_new_chat_mode(self, user_id: int, name: str, welcome: str, prompt: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        chat_modes_dict = self.get_user_attribute(user_id, "chat_modes")
-        self.user_collection.insert_one({"_id": user_id}, )
+    def set_last_interaction(self, user_id: int, last_interaction: datetime):
+        # buffered in memory, written by flush_last_interactions
+        with self.last_interactions_lock:
+            self.last_interactions[user_id] = last_interaction
+            self.active_user_ids.add(user_id)
+
+    def get_last_interaction(self, user_id: int):
+        with self.last_interactions_lock:
+            if user_id in self.last_interactions:
+                return self.last_interactions[user_id]
+
+        return self.get_user_attribute(user_id, "last_interaction")
+
+    def flush_last_interactions(self):
+        with self.last_interactions_lock:
+            last_interactions, self.last_interactions = self.last_interactions, {}
+
+        if len(last_interactions) == 0:
+            return
+
+        try:
+            self._save_last_interactions(last_interactions)
+        except Exception:
+            # put values back unless they were updated in the meantime
+            with self.last_interactions_lock:
+                for user_id, last_interaction in last_interactions.items():
+                    self.last_interactions.setdefault(user_id, last_interaction)
+            raise
+
+    # chat modes
 
     def get_chat_modes(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
         chat_modes_dict = self.get_user_attribute(user_id, "chat_modes")
-        return chat_modes_dict
+        return self._resolve_chat_modes(chat_modes_dict)
+
+    def set_chat_modes(self, user_id: int, chat_modes: list):
+        # chat_modes_version lets rendered menus be cached until the list changes
+        update = {"$set": {"chat_modes": self._compress_chat_modes(chat_modes)}, "$inc": {"chat_modes_version": 1}}
+        if not self._update_user(user_id, update):
+            raise ValueError(f"User {user_id} does not exist")
+
+    def _resolve_chat_modes(self, chat_modes: list):
+        # built-in modes are stored as {"key": ...} and resolved from chat_modes.yml (or the
+        # modes removed from it by a reload), custom and edited modes are stored in full
+        snapshot = config.get_snapshot()
+        default_chat_modes = {**snapshot.removed_chat_modes, **snapshot.chat_modes}
+
+        resolved_chat_modes = []
+        for chat_mode in chat_modes:
+            if "prompt_start" in chat_mode:
+                resolved_chat_modes.append(chat_mode)
+            elif chat_mode.get("key") in default_chat_modes:
+                resolved_chat_modes.append(config.get_default_chat_mode(chat_mode["key"]))
+            else:
+                # modes removed from chat_modes.yml keep their position, handlers index by current_chat_mode_index
+                resolved_chat_modes.append(config.get_removed_chat_mode(chat_mode.get("key")))
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        return resolved_chat_modes
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
-        else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+    def _compress_chat_modes(self, chat_modes: list):
+        # modes resolved from chat_modes.yml carry their "key"; edited modes are new dicts without it
+        snapshot = config.get_snapshot()
+        default_chat_modes = {**snapshot.removed_chat_modes, **snapshot.chat_modes}
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        compressed_chat_modes = []
+        for chat_mode in chat_modes:
+            if chat_mode.get("key") in default_chat_modes or chat_mode.get("removed"):
+                # removed modes stay references, they resolve again if the mode is restored
+                compressed_chat_modes.append({"key": chat_mode["key"]})
+            else:
+                compressed_chat_modes.append({k: v for k, v in chat_mode.items() if k != "key"})
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        return compressed_chat_modes
 
-        if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+    def migrate_chat_modes_to_refs(self, batch_size: int = 1000):
+        """Replace embedded copies of built-in chat modes with references.
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-        return dialog_dict["messages"]
+        Streams over users and writes in batches. Only modes identical to the current
+        chat_modes.yml entry are replaced, so edited and custom modes are kept as is.
+        Returns the number of updated users.
+        """
+        fields = ("name", "welcome_message", "prompt_start", "parse_mode")
+        default_chat_mode_keys = {
+            tuple(chat_mode[field] for field in fields): chat_mode["key"]
+            for chat_mode in config.get_default_chat_modes()
+        }
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        n_updated_users = 0
+        user_chat_modes = []
+
+        for user_id, chat_modes in self._iter_user_chat_modes(batch_size):
+            new_chat_modes = []
+            for chat_mode in chat_modes:
+                key = default_chat_mode_keys.get(tuple(chat_mode.get(field) for field in fields))
+                new_chat_modes.append({"key": key} if key is not None else chat_mode)
+
+            if new_chat_modes != chat_modes:
+                user_chat_modes.append((user_id, new_chat_modes))
+
+            if len(user_chat_modes) >= batch_size:
+                n_updated_users += self._set_users_chat_modes(user_chat_modes)
+                user_chat_modes = []
+
+        if len(user_chat_modes) > 0:
+            n_updated_users += self._set_users_chat_modes(user_chat_modes)
+
+        return n_updated_users
+
+    # usage
+
+    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int, quota_usage: Optional[dict] = None):
+        # counters are incremented in place, so that concurrent requests of a user (and summarization) don't lose tokens
+        n_spent_dollars = config.get_snapshot().get_tokens_price(model, n_input_tokens, n_output_tokens)
+        usage_update = self._get_usage_update(model, n_spent_dollars, n_used_tokens=n_input_tokens + n_output_tokens)
 
-        if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+        usage_key = self._get_usage_key(model)
+        usage_update["$set"][f"n_used_tokens.{usage_key}.name"] = model
+        usage_update["$inc"][f"n_used_tokens.{usage_key}.n_input_tokens"] = n_input_tokens
+        usage_update["$inc"][f"n_used_tokens.{usage_key}.n_output_tokens"] = n_output_tokens
+        self._set_quota_usage(usage_update, quota_usage)
 
-        self.dialog_collection.update_one(
-            {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
-        )
\ No newline at end of file
+        self._update_user(user_id, usage_update)
+
+    def add_n_generated_images(self, user_id: int, n_generated_images: int, quota_usage: Optional[dict] = None):
+        n_spent_dollars = config.get_snapshot().price_per_1_image * n_generated_images
+        usage_update = self._get_usage_update("dalle-2", n_spent_dollars)
+        usage_update["$inc"]["n_generated_images"] = n_generated_images
+        self._set_quota_usage(usage_update, quota_usage)
+
+        self._update_user(user_id, usage_update)
+
+    def add_n_transcribed_seconds(self, user_id: int, n_transcribed_seconds: float, quota_usage: Optional[dict] = None):
+        n_spent_dollars = config.get_snapshot().price_per_1_min * (n_transcribed_seconds / 60)
+        usage_update = self._get_usage_update("whisper", n_spent_dollars)
+        usage_update["$inc"]["n_transcribed_seconds"] = n_transcribed_seconds
+        self._set_quota_usage(usage_update, quota_usage)
+
+        self._update_user(user_id, usage_update)
+
+    def backfill_usage(self, user_id: int):
+        # price usage recorded before running totals existed with the current prices (once per user)
+        user_dict = self.get_user_attributes(user_id, ["n_used_tokens", "n_generated_images", "n_transcribed_seconds"])
+
+        usage = {}
+        total_n_spent_dollars = 0.0
+        total_n_used_tokens = 0
+
+        for key, n_used_tokens in (user_dict["n_used_tokens"] or {}).items():
+            model = n_used_tokens.get("name", key)  # keys written before escaping are model names
+            n_input_tokens, n_output_tokens = n_used_tokens["n_input_tokens"], n_used_tokens["n_output_tokens"]
+            n_spent_dollars = config.get_snapshot().get_tokens_price(model, n_input_tokens, n_output_tokens)
+            usage[self._get_usage_key(model)] = {
+                "name": model,
+                "n_spent_dollars": n_spent_dollars,
+                "n_used_tokens": n_input_tokens + n_output_tokens
+            }
+            total_n_spent_dollars += n_spent_dollars
+            total_n_used_tokens += n_input_tokens + n_output_tokens
+
+        if user_dict["n_generated_images"]:
+            n_spent_dollars = config.get_snapshot().price_per_1_image * user_dict["n_generated_images"]
+            usage["dalle-2"] = {"name": "dalle-2", "n_spent_dollars": n_spent_dollars}
+            total_n_spent_dollars += n_spent_dollars
+
+        if user_dict["n_transcribed_seconds"]:
+            n_spent_dollars = config.get_snapshot().price_per_1_min * (user_dict["n_transcribed_seconds"] / 60)
+            usage["whisper"] = {"name": "whisper", "n_spent_dollars": n_spent_dollars}
+            total_n_spent_dollars += n_spent_dollars
+
+        self._update_user(
+            user_id,
+            {"$set": {"usage": usage, "total_n_spent_dollars": total_n_spent_dollars, "total_n_used_tokens": total_n_used_tokens}},
+            unless_exists="total_n_spent_dollars"
+        )
+
+    def _set_quota_usage(self, usage_update: dict, quota_usage: Optional[dict]):
+        # quota counters (see quotas.QuotaTracker) are saved with the usage update, not separately
+        if quota_usage is not None:
+            usage_update["$set"]["quota_usage"] = quota_usage
+
+    def _get_usage_key(self, model: str):
+        # model names like "gpt-3.5-turbo" can't be used as is in dotted update paths
+        return model.replace(".", "_")
+
+    def _get_usage_update(self, model: str, n_spent_dollars: float, n_used_tokens: int = 0):
+        usage_key = self._get_usage_key(model)
+        return {
+            "$set": {f"usage.{usage_key}.name": model},
+            "$inc": {
+                f"usage.{usage_key}.n_spent_dollars": n_spent_dollars,
+                f"usage.{usage_key}.n_used_tokens": n_used_tokens,
+                "total_n_spent_dollars": n_spent_dollars,
+                "total_n_used_tokens": n_used_tokens
+            }
+        }
+
+    # dialogs
+
+    @abstractmethod
+    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None, last_n: Optional[int] = None):
+        # last_n: fetch only the last n messages
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_recent_dialogs(self, user_id: int, limit: int, exclude_dialog_id: Optional[str] = None):
+        # [(dialog_id, messages), ...] newest first, archived dialogs are not included
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def push_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None):
+        # removes the last message and returns it (None if the dialog is empty)
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_dialog_message(self, user_id: int, index: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        # replaces the message at index, other messages are left as is
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None):
+        # (summary, n_summarized_messages)
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_dialog_summary(self, user_id: int, summary: str, n_summarized_messages: int, dialog_id: Optional[str] = None):
+        raise NotImplementedError
+
+    # archive
+
+    def archive_old_dialogs(self, max_age_days: int, max_dialogs_per_user: int, batch_size: int = 1000):
+        """Move old dialogs to the compressed archive.
+
+        A dialog is archived when it is older than max_age_days or when the user has more than
+        max_dialogs_per_user newer dialogs. Current dialogs are never archived.
+        Returns the number of archived dialogs.
+        """
+        n_archived_dialogs = 0
+
+        # by age
+        start_time_threshold = datetime.now() - timedelta(days=max_age_days)
+        n_archived_dialogs += self._archive_dialogs_in_batches(self._find_old_dialog_ids(start_time_threshold, batch_size), batch_size)
+
+        # by number of dialogs per user, only users active since the previous pass are checked
+        with self.last_interactions_lock:
+            active_user_ids, self.active_user_ids = self.active_user_ids, set()
+
+        user_ids = active_user_ids if self.are_all_users_checked else None
+        try:
+            n_archived_dialogs += self._archive_dialogs_in_batches(
+                self._find_excess_dialog_ids(max_dialogs_per_user, batch_size, user_ids=user_ids), batch_size
+            )
+        except Exception:
+            # checked again on the next pass
+            with self.last_interactions_lock:
+                self.active_user_ids |= active_user_ids
+            raise
+        self.are_all_users_checked = True
+
+        return n_archived_dialogs
+
+    def _archive_dialogs_in_batches(self, dialog_ids, batch_size: int):
+        n_archived_dialogs = 0
+
+        batch = []
+        for dialog_id in dialog_ids:
+            batch.append(dialog_id)
+            if len(batch) >= batch_size:
+                n_archived_dialogs += self.archive_dialogs(batch)
+                batch = []
+
+        if len(batch) > 0:
+            n_archived_dialogs += self.archive_dialogs(batch)
+
+        return n_archived_dialogs
+
+    @abstractmethod
+    def archive_dialogs(self, dialog_ids: list):
+        # returns the number of archived dialogs, current dialogs are skipped
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_archived_dialog(self, user_id: int, dialog_id: str):
+        raise NotImplementedError
+
+    # static assets
+
+    @abstractmethod
+    def get_static_asset_file_id(self, name: str, version: str):
+        # Telegram file_id of an uploaded static file, None if this version wasn't uploaded yet
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_static_asset_file_id(self, name: str, version: str, file_id: str):
+        raise NotImplementedError
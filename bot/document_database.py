@@ -0,0 +1,329 @@
+"""Database over a plain document store
+
+Backends without a query language of their own (SQLite and memory) store whole
+user, dialog and static asset documents and implement a few primitives
+(_get_user, _put_users, _get_dialog, ...). DocumentDatabase builds the
+Database interface on them: updates are applied in Python with apply_update
+inside a transaction, so that read-modify-write is atomic.
+"""
+
+import json
+import zlib
+import contextlib
+import threading
+from abc import abstractmethod
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+import config
+from database import Database
+
+
+def apply_update(document: dict, update: dict):
+    # MongoDB update operators used by Database, with dotted paths
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            *parent_keys, key = path.split(".")
+            target = document
+            for parent_key in parent_keys:
+                target = target.setdefault(parent_key, {})
+
+            if operator == "$set":
+                target[key] = value
+            elif operator == "$inc":
+                target[key] = target.get(key, 0) + value
+            elif operator == "$max":
+                if target.get(key) is None or value > target[key]:
+                    target[key] = value
+            else:
+                raise ValueError(f"Unsupported update operator: {operator}")
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat(timespec="microseconds")}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_object(object_dict: dict):
+    if len(object_dict) == 1 and "$date" in object_dict:
+        return datetime.fromisoformat(object_dict["$date"])
+    return object_dict
+
+
+def encode_document(document: dict):
+    return json.dumps(document, ensure_ascii=False, separators=(",", ":"), default=_encode_value)
+
+
+def decode_document(data: str):
+    return json.loads(data, object_hook=_decode_object)
+
+
+class DocumentDatabase(Database):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+
+    # store primitives
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield
+
+    @abstractmethod
+    def _get_user(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _put_users(self, user_dicts: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _iter_users(self, batch_size: int) -> Iterator[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_dialog(self, dialog_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_dialogs(self, dialog_ids: List[str]) -> List[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _put_dialog(self, dialog_dict: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _delete_dialogs(self, dialog_ids: List[str]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_user_dialogs(self, user_id: int, limit: int, exclude_dialog_id: Optional[str]) -> List[dict]:
+        # newest first
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_archived_dialog(self, dialog_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _put_archived_dialogs(self, archived_dialog_dicts: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _delete_archived_dialogs(self, archived_before: datetime):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_static_asset(self, name: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _put_static_asset(self, static_asset_dict: dict):
+        raise NotImplementedError
+
+    # Database primitives
+
+    def _find_user(self, user_id: int, keys: list):
+        user_dict = self._get_user(user_id)
+        if user_dict is None:
+            return None
+
+        return {key: user_dict[key] for key in ["_id", *keys] if key in user_dict}
+
+    def _insert_user(self, user_dict: dict):
+        with self._transaction():
+            if self._get_user(user_dict["_id"]) is None:
+                self._put_users([user_dict])
+
+    def _update_user(self, user_id: int, update: dict, unless_exists: Optional[str] = None):
+        with self._transaction():
+            user_dict = self._get_user(user_id)
+            if user_dict is None:
+                return False
+
+            if unless_exists is None or unless_exists not in user_dict:
+                apply_update(user_dict, update)
+                self._put_users([user_dict])
+
+            return True
+
+    def _save_last_interactions(self, last_interactions: dict):
+        with self._transaction():
+            user_dicts = []
+            for user_id, last_interaction in last_interactions.items():
+                user_dict = self._get_user(user_id)
+                if user_dict is not None:
+                    apply_update(user_dict, {"$max": {"last_interaction": last_interaction}})
+                    user_dicts.append(user_dict)
+
+            self._put_users(user_dicts)
+
+    def _insert_dialog(self, dialog_dict: dict):
+        self._put_dialog(dialog_dict)
+
+    def _iter_user_chat_modes(self, batch_size: int):
+        for user_dict in self._iter_users(batch_size):
+            chat_modes = user_dict.get("chat_modes") or []
+            if any("prompt_start" in chat_mode for chat_mode in chat_modes):
+                yield user_dict["_id"], chat_modes
+
+    def _set_users_chat_modes(self, user_chat_modes: list):
+        with self._transaction():
+            user_dicts = []
+            for user_id, chat_modes in user_chat_modes:
+                user_dict = self._get_user(user_id)
+                if user_dict is not None and user_dict.get("chat_modes") != chat_modes:
+                    user_dict["chat_modes"] = chat_modes
+                    user_dicts.append(user_dict)
+
+            self._put_users(user_dicts)
+
+        return len(user_dicts)
+
+    # dialogs
+
+    def _update_dialog(self, user_id: int, dialog_id: Optional[str], fn):
+        # fn changes the dialog document in place, its result is returned (None if there is no such dialog)
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        with self._transaction():
+            dialog_dict = self._get_dialog(dialog_id)
+            if dialog_dict is None or dialog_dict["user_id"] != user_id:
+                return None
+
+            result = fn(dialog_dict)
+            self._put_dialog(dialog_dict)
+
+        return result
+
+    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None, last_n: Optional[int] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        if last_n is not None and last_n <= 0:
+            return []
+
+        dialog_dict = self._get_dialog(dialog_id)
+        if dialog_dict is None or dialog_dict["user_id"] != user_id:
+            dialog_dict = self.get_archived_dialog(user_id, dialog_id)
+
+        messages = dialog_dict["messages"]
+        return messages if last_n is None else messages[-last_n:]
+
+    def get_recent_dialogs(self, user_id: int, limit: int, exclude_dialog_id: Optional[str] = None):
+        return [
+            (dialog_dict["_id"], [{"user": message["user"], "bot": message["bot"]} for message in dialog_dict.get("messages", [])])
+            for dialog_dict in self._get_user_dialogs(user_id, limit, exclude_dialog_id)
+        ]
+
+    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+        self._update_dialog(user_id, dialog_id, lambda dialog_dict: dialog_dict.update(messages=dialog_messages))
+
+    def push_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        self._update_dialog(user_id, dialog_id, lambda dialog_dict: dialog_dict.setdefault("messages", []).append(dialog_message))
+
+    def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None):
+        def pop(dialog_dict):
+            messages = dialog_dict.get("messages", [])
+            return messages.pop() if len(messages) > 0 else None
+
+        return self._update_dialog(user_id, dialog_id, pop)
+
+    def update_dialog_message(self, user_id: int, index: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        def update(dialog_dict):
+            messages = dialog_dict.get("messages", [])
+            if 0 <= index < len(messages):
+                messages[index] = dialog_message
+
+        self._update_dialog(user_id, dialog_id, update)
+
+    def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = self._get_dialog(dialog_id)
+        if dialog_dict is None or dialog_dict["user_id"] != user_id:
+            dialog_dict = self.get_archived_dialog(user_id, dialog_id)
+
+        return dialog_dict.get("summary", ""), dialog_dict.get("n_summarized_messages", 0)
+
+    def set_dialog_summary(self, user_id: int, summary: str, n_summarized_messages: int, dialog_id: Optional[str] = None):
+        self._update_dialog(
+            user_id, dialog_id,
+            lambda dialog_dict: dialog_dict.update(summary=summary, n_summarized_messages=n_summarized_messages)
+        )
+
+    # archive
+
+    def archive_old_dialogs(self, max_age_days: int, max_dialogs_per_user: int, batch_size: int = 1000):
+        n_archived_dialogs = super().archive_old_dialogs(max_age_days, max_dialogs_per_user, batch_size=batch_size)
+
+        # there is no TTL index, expired archived dialogs are deleted here
+        self._delete_archived_dialogs(datetime.now() - timedelta(days=config.dialog_archive_ttl_days))
+
+        return n_archived_dialogs
+
+    def archive_dialogs(self, dialog_ids: list):
+        archived_at = datetime.now()
+
+        with self._transaction():
+            current_dialog_ids = {}  # user_id -> current_dialog_id
+            archived_dialog_dicts = []
+            for dialog_dict in self._get_dialogs(dialog_ids):
+                user_id = dialog_dict["user_id"]
+                if user_id not in current_dialog_ids:
+                    user_dict = self._get_user(user_id) or {}
+                    current_dialog_ids[user_id] = user_dict.get("current_dialog_id")
+                if dialog_dict["_id"] == current_dialog_ids[user_id]:
+                    continue
+
+                archived_dialog_dict = self._compress_dialog(dialog_dict)
+                archived_dialog_dict["archived_at"] = archived_at
+                archived_dialog_dicts.append(archived_dialog_dict)
+
+            if len(archived_dialog_dicts) == 0:
+                return 0
+
+            self._put_archived_dialogs(archived_dialog_dicts)
+            self._delete_dialogs([archived_dialog_dict["_id"] for archived_dialog_dict in archived_dialog_dicts])
+
+        return len(archived_dialog_dicts)
+
+    def get_archived_dialog(self, user_id: int, dialog_id: str):
+        archived_dialog_dict = self._get_archived_dialog(dialog_id)
+        if archived_dialog_dict is None or archived_dialog_dict["user_id"] != user_id:
+            raise ValueError(f"Dialog {dialog_id} does not exist")
+
+        return self._decompress_dialog(archived_dialog_dict)
+
+    def _compress_dialog(self, dialog_dict: dict):
+        # metadata stays readable, the rest (messages, summary, ...) is stored as zlib-compressed JSON
+        metadata_keys = {"_id", "user_id", "chat_mode", "start_time", "model"}
+
+        archived_dialog_dict = {key: value for key, value in dialog_dict.items() if key in metadata_keys}
+        data = {key: value for key, value in dialog_dict.items() if key not in metadata_keys}
+        archived_dialog_dict["data"] = zlib.compress(encode_document(data).encode())
+
+        return archived_dialog_dict
+
+    def _decompress_dialog(self, archived_dialog_dict: dict):
+        dialog_dict = {key: value for key, value in archived_dialog_dict.items() if key not in {"data", "archived_at"}}
+        dialog_dict.update(decode_document(zlib.decompress(archived_dialog_dict["data"]).decode()))
+
+        return dialog_dict
+
+    # static assets
+
+    def get_static_asset_file_id(self, name: str, version: str):
+        static_asset_dict = self._get_static_asset(name)
+        if static_asset_dict is None or static_asset_dict["version"] != version:
+            return None
+
+        return static_asset_dict["file_id"]
+
+    def set_static_asset_file_id(self, name: str, version: str, file_id: str):
+        self._put_static_asset({"_id": name, "version": version, "file_id": file_id, "uploaded_at": datetime.now()})
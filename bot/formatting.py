@@ -0,0 +1,176 @@
+"""Formatting of (partial) answers for Telegram parse modes
+
+While an answer is streamed, a snapshot often ends inside a tag, an entity or
+a code block, which Telegram rejects. format_answer turns any snapshot into
+text that is valid for the chat mode's parse_mode: unsupported tags and
+characters are escaped, an incomplete trailing tag is held back and open tags,
+entities and code blocks are closed.
+"""
+
+import re
+import html
+
+
+# tags supported by Telegram, with the attributes that are kept
+HTML_TAGS = {
+    "b": (), "strong": (), "i": (), "em": (), "u": (), "ins": (), "s": (), "strike": (), "del": (),
+    "tg-spoiler": (), "span": ("class",), "a": ("href",), "code": ("class",), "pre": (), "blockquote": ()
+}
+HTML_CODE_TAGS = {"code", "pre"}
+MAX_HTML_TAG_LENGTH = 200  # longer text after "<" is not held back as an incomplete tag
+
+_html_tag_re = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)((?:\s+[^<>]*)?)>")
+_html_tag_prefix_re = re.compile(r"</?(?:[a-zA-Z][a-zA-Z0-9-]*(?:\s[^<>]*)?)?")  # "<" not followed by a letter is text
+_html_attribute_re = re.compile(r"""([a-zA-Z-]+)\s*=\s*("[^"]*"|'[^']*')""")
+_html_entity_re = re.compile(r"&(?:[a-zA-Z]+|#[0-9]+|#x[0-9a-fA-F]+);")
+
+_markdown_link_re = re.compile(r"\[[^\[\]\n]*\]\([^()\s]*\)")
+
+
+def format_answer(text: str, parse_mode: str, is_complete: bool = False):
+    # parse_mode as in chat_modes.yml
+    if parse_mode == "html":
+        return format_html(text, is_complete=is_complete)
+    elif parse_mode == "markdown":
+        return format_markdown(text)
+    else:
+        raise ValueError(f"Unknown parse mode: {parse_mode}")
+
+
+def _format_html_tag(match: re.Match, open_tags: list):
+    # returns the tag to output (None if it's not valid here)
+    is_closing, tag, attributes = match.group(1) == "/", match.group(2).lower(), match.group(3)
+    if tag not in HTML_TAGS:
+        return None
+
+    in_code = len(open_tags) > 0 and open_tags[-1] in HTML_CODE_TAGS
+
+    if is_closing:
+        if tag not in open_tags or (in_code and tag != open_tags[-1]):
+            return None
+
+        # close the tags opened after this one
+        closing_tags = ""
+        while open_tags[-1] != tag:
+            closing_tags += f"</{open_tags.pop()}>"
+        open_tags.pop()
+
+        return closing_tags + f"</{tag}>"
+
+    # only <code> can be nested in <pre>
+    if in_code and not (tag == "code" and open_tags[-1] == "pre"):
+        return None
+
+    kept_attributes = ""
+    for name, value in _html_attribute_re.findall(attributes):
+        if name.lower() in HTML_TAGS[tag]:
+            kept_attributes += f" {name.lower()}={value}"
+    if tag == "a" and not kept_attributes:
+        return None
+
+    open_tags.append(tag)
+    return f"<{tag}{kept_attributes}>"
+
+
+def format_html(text: str, is_complete: bool = False):
+    output, open_tags = [], []
+
+    i = 0
+    while i < len(text):
+        char = text[i]
+
+        if char == "<":
+            match = _html_tag_re.match(text, i)
+            if match is not None:
+                tag = _format_html_tag(match, open_tags)
+                output.append(tag if tag is not None else html.escape(match.group(0), quote=False))
+                i = match.end()
+                continue
+
+            # the rest of the tag hasn't been generated yet
+            if not is_complete and len(text) - i <= MAX_HTML_TAG_LENGTH and _html_tag_prefix_re.fullmatch(text, i):
+                break
+
+            output.append("&lt;")
+        elif char == "&":
+            match = _html_entity_re.match(text, i)
+            if match is not None:
+                output.append(match.group(0))
+                i = match.end()
+                continue
+
+            output.append("&amp;")
+        elif char == ">":
+            output.append("&gt;")
+        else:
+            output.append(char)
+
+        i += 1
+
+    for tag in reversed(open_tags):
+        output.append(f"</{tag}>")
+
+    return "".join(output)
+
+
+def format_markdown(text: str):
+    # Telegram's legacy Markdown: *bold*, _italic_, `code`, ```pre```, [text](url), no nesting
+    output = []
+    entity, entity_start = None, 0  # opening marker and its position in output
+
+    i = 0
+    while i < len(text):
+        if entity is None:
+            if text.startswith("```", i):
+                entity, entity_start = "```", len(output)
+                output.append("```")
+                i += 3
+                continue
+
+            # **bold** is common in model answers, but is an empty entity in legacy Markdown
+            if text.startswith("**", i):
+                i += 1
+
+            char = text[i]
+            prev_char, next_char = text[i - 1] if i > 0 else " ", text[i + 1] if i + 1 < len(text) else " "
+
+            if char in "*_`":
+                if next_char.isspace() or (char in "*_" and prev_char.isalnum()):
+                    # list bullets, snake_case, a*b and the like are not entities, emphasis starts at a word boundary
+                    output.append("\\" + char)
+                else:
+                    entity, entity_start = char, len(output)
+                    output.append(char)
+            elif char == "[":
+                match = _markdown_link_re.match(text, i)
+                if match is not None:
+                    output.append(match.group(0))
+                    i = match.end()
+                    continue
+                output.append("\\[")
+            elif char == "\\" and next_char in "*_`[":
+                output.append(text[i:i + 2])
+                i += 1
+            else:
+                output.append(char)
+        else:
+            if text.startswith(entity, i):
+                if entity == "*" and text.startswith("**", i):
+                    i += 1
+                output.append(entity)
+                i += len(entity)
+                entity = None
+                continue
+
+            output.append(text[i])
+
+        i += 1
+
+    if entity is not None:
+        if "".join(output[entity_start + 1:]).strip() == "":
+            # nothing inside yet
+            del output[entity_start:]
+        else:
+            output.append(entity)
+
+    return "".join(output)
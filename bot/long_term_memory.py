@@ -0,0 +1,151 @@
+"""Retrieval memory over a user's past dialogs
+
+Every question-answer pair is a document, vectorized with hashed words and word
+bigrams (no external embedding service). Vectors of each user are kept in a
+float16 NumPy matrix that grows up to max_n_entries and then works as a ring
+buffer, together with per-feature document frequencies for TF-IDF weighting at
+query time. Users' indices are built from the dialog collection on first use,
+updated as messages are saved and evicted least recently used first.
+"""
+
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from cache import LRUCache
+from semantic_cache import hash_features, normalize_text
+
+
+MAX_SNIPPET_PART_LENGTH = 300  # characters of the question and of the answer
+
+
+def get_features(text: str):
+    words = normalize_text(text).split()
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def get_snippet(dialog_message: dict):
+    def truncate(text):
+        return text if len(text) <= MAX_SNIPPET_PART_LENGTH else text[:MAX_SNIPPET_PART_LENGTH] + "…"
+
+    return f"User: {truncate(dialog_message['user'])}\nAssistant: {truncate(dialog_message['bot'])}"
+
+
+class _UserIndex:
+    def __init__(self, max_n_entries: int, n_features: int):
+        self.max_n_entries = max_n_entries
+        self.vectors = np.zeros((0, n_features), dtype=np.float16)
+        self.document_frequencies = np.zeros(n_features, dtype=np.int32)
+        self.snippets: List[str] = []
+        self.dialog_ids: List[str] = []
+        self.next_position = 0
+
+    def add(self, vector: np.ndarray, snippet: str, dialog_id: str):
+        n_entries = len(self.snippets)
+        if n_entries < self.max_n_entries:
+            if n_entries == len(self.vectors):
+                # grow geometrically, so that users with few dialogs stay small
+                capacity = min(max(2 * n_entries, 16), self.max_n_entries)
+                vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float16)
+                vectors[:n_entries] = self.vectors
+                self.vectors = vectors
+
+            position = n_entries
+            self.snippets.append(snippet)
+            self.dialog_ids.append(dialog_id)
+        else:
+            # overwrite the oldest entry
+            position = self.next_position
+            self.document_frequencies -= (self.vectors[position] != 0)
+            self.snippets[position] = snippet
+            self.dialog_ids[position] = dialog_id
+
+        self.vectors[position] = vector
+        self.document_frequencies += (vector != 0)
+        self.next_position = (position + 1) % self.max_n_entries
+
+
+class LongTermMemory:
+    """Per-user TF-IDF index of question-answer pairs from past dialogs"""
+
+    def __init__(self, max_n_users: int = 1000, max_n_entries: int = 500, n_features: int = 1024):
+        self.max_n_entries = max_n_entries
+        self.n_features = n_features
+
+        # indices are loaded in the thread pool and updated from the event loop
+        self._users = LRUCache(maxsize=max_n_users)
+        self._lock = threading.Lock()
+
+    def vectorize(self, text: str):
+        features = get_features(text)
+        if len(features) == 0:
+            return None
+
+        # sublinear term frequency
+        vector = hash_features(features, self.n_features)
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+
+        return vector / norm
+
+    def is_loaded(self, user_id: int):
+        with self._lock:
+            return user_id in self._users
+
+    def load(self, user_id: int, dialogs: List[Tuple[str, list]]):
+        # dialogs: [(dialog_id, messages), ...] newest first, as returned by Database.get_recent_dialogs
+        user_index = _UserIndex(self.max_n_entries, self.n_features)
+        for dialog_id, dialog_messages in reversed(dialogs):
+            for dialog_message in dialog_messages:
+                self._add_to_index(user_index, dialog_id, dialog_message)
+
+        with self._lock:
+            self._users.set(user_id, user_index)
+
+    def add(self, user_id: int, dialog_id: str, dialog_message: dict):
+        # users that aren't loaded get the message from the database on load
+        with self._lock:
+            user_index = self._users.get(user_id)
+            if user_index is not None:
+                self._add_to_index(user_index, dialog_id, dialog_message)
+
+    def search(self, user_id: int, query: str, exclude_dialog_id: Optional[str] = None, top_k: int = 3, min_similarity: float = 0.2):
+        """Snippets of the top_k most similar past messages, most similar first.
+
+        Messages of exclude_dialog_id (the current dialog, already in the context) are skipped.
+        """
+        query_vector = self.vectorize(query)
+        if query_vector is None:
+            return []
+
+        with self._lock:
+            user_index = self._users.get(user_id)
+            if user_index is None or len(user_index.snippets) == 0:
+                return []
+
+            n_entries = len(user_index.snippets)
+            idf = np.log((1 + n_entries) / (1 + user_index.document_frequencies)).astype(np.float32) + 1.0
+            vectors = user_index.vectors[:n_entries].astype(np.float32) * idf
+            snippets, dialog_ids = list(user_index.snippets), list(user_index.dialog_ids)
+
+        query_vector = query_vector * idf
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+        similarities = (vectors @ query_vector) / np.maximum(norms, 1e-8)
+
+        results = []
+        for position in np.argsort(-similarities):
+            if similarities[position] < min_similarity or len(results) == top_k:
+                break
+            if dialog_ids[position] != exclude_dialog_id:
+                results.append(snippets[position])
+
+        return results
+
+    def _add_to_index(self, user_index: _UserIndex, dialog_id: str, dialog_message: dict):
+        vector = self.vectorize(f"{dialog_message['user']}\n{dialog_message['bot']}")
+        if vector is not None:
+            user_index.add(vector, get_snippet(dialog_message), dialog_id)
@@ -0,0 +1,97 @@
+"""Detection of code that blocks the event loop
+
+A heartbeat task on the event loop records when it last ran and how late its
+sleeps wake up (the loop lag). A daemon thread checks the heartbeat; when it
+is older than the threshold, the loop is blocked right now, so the thread
+takes the loop thread's stack from sys._current_frames() and logs it with the
+handler and update being processed. The cost is one wake-up per interval on
+the loop and in the thread, stacks are only captured while the loop is blocked.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+# frames of these files are searched for the handler and its update
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_handler(frame):
+    """(handler name, update id) of the outermost bot function that has an update, or (None, None)."""
+    handler, update_id = None, None
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(SOURCE_DIR):
+            update = frame.f_locals.get("update")
+            if hasattr(update, "update_id"):
+                handler, update_id = frame.f_code.co_name, update.update_id
+        frame = frame.f_back
+
+    return handler, update_id
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.n_blocks = 0
+
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stop_event = threading.Event()
+
+    async def run(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop_event.clear()
+
+        thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                t_start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._heartbeat = time.monotonic()
+
+                self.lag = max(self._heartbeat - t_start - self.interval, 0.0)
+                self.max_lag = max(self.max_lag, self.lag)
+                if self.lag >= self.threshold:
+                    # the stack was logged by the watchdog thread while the loop was blocked
+                    logger.warning(f"Event loop was blocked for {self.lag:.3f}s")
+        finally:
+            self._stop_event.set()
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stop_event.wait(self.interval):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.threshold or heartbeat == reported_heartbeat:
+                continue
+
+            # one report per blocking
+            reported_heartbeat = heartbeat
+            self.n_blocks += 1
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            handler, update_id = find_handler(frame)
+            stack = "".join(traceback.format_stack(frame))
+            del frame
+
+            logger.warning(
+                f"Event loop is blocked for {blocked_for:.3f}s in handler {handler} (update {update_id}), stack:\n{stack}"
+            )
@@ -0,0 +1,106 @@
+import copy
+from collections import defaultdict
+from typing import Any, Optional
+
+from document_database import DocumentDatabase
+
+
+class MemoryDatabase(DocumentDatabase):
+    """Database kept in process memory, for tests and benchmarks (memory:// URI)
+
+    Documents are copied on the way in and out, so that callers can't change
+    stored documents, as with the other backends.
+    """
+
+    def __init__(self, database_name: str = "chatgpt_telegram_bot", uri: Optional[str] = None, client: Any = None):
+        super().__init__()
+        self.database_name = database_name
+
+        self.users = {}
+        self.dialogs = {}
+        self.user_dialog_ids = defaultdict(set)
+        self.archived_dialogs = {}
+        self.static_assets = {}
+
+    def _get_user(self, user_id: int):
+        with self._lock:
+            return copy.deepcopy(self.users.get(user_id))
+
+    def _put_users(self, user_dicts: list):
+        with self._lock:
+            for user_dict in user_dicts:
+                self.users[user_dict["_id"]] = copy.deepcopy(user_dict)
+
+    def _iter_users(self, batch_size: int):
+        with self._lock:
+            user_ids = list(self.users)
+
+        for user_id in user_ids:
+            user_dict = self._get_user(user_id)
+            if user_dict is not None:
+                yield user_dict
+
+    def _get_dialog(self, dialog_id: str):
+        with self._lock:
+            return copy.deepcopy(self.dialogs.get(dialog_id))
+
+    def _get_dialogs(self, dialog_ids: list):
+        with self._lock:
+            return [copy.deepcopy(self.dialogs[dialog_id]) for dialog_id in dialog_ids if dialog_id in self.dialogs]
+
+    def _put_dialog(self, dialog_dict: dict):
+        with self._lock:
+            self.dialogs[dialog_dict["_id"]] = copy.deepcopy(dialog_dict)
+            self.user_dialog_ids[dialog_dict["user_id"]].add(dialog_dict["_id"])
+
+    def _delete_dialogs(self, dialog_ids: list):
+        with self._lock:
+            for dialog_id in dialog_ids:
+                dialog_dict = self.dialogs.pop(dialog_id, None)
+                if dialog_dict is not None:
+                    self.user_dialog_ids[dialog_dict["user_id"]].discard(dialog_id)
+
+    def _get_sorted_user_dialogs(self, user_id: int):
+        # newest first
+        dialog_dicts = [self.dialogs[dialog_id] for dialog_id in self.user_dialog_ids.get(user_id, ())]
+        return sorted(dialog_dicts, key=lambda dialog_dict: dialog_dict["start_time"], reverse=True)
+
+    def _get_user_dialogs(self, user_id: int, limit: int, exclude_dialog_id: Optional[str]):
+        with self._lock:
+            dialog_dicts = [dialog_dict for dialog_dict in self._get_sorted_user_dialogs(user_id) if dialog_dict["_id"] != exclude_dialog_id]
+            return copy.deepcopy(dialog_dicts[:limit])
+
+    def _find_old_dialog_ids(self, start_time_threshold, batch_size: int):
+        with self._lock:
+            return [dialog_id for dialog_id, dialog_dict in self.dialogs.items() if dialog_dict["start_time"] < start_time_threshold]
+
+    def _find_excess_dialog_ids(self, max_dialogs_per_user: int, batch_size: int, user_ids=None):
+        with self._lock:
+            return [
+                dialog_dict["_id"]
+                for user_id in (list(self.user_dialog_ids) if user_ids is None else user_ids)
+                for dialog_dict in self._get_sorted_user_dialogs(user_id)[max_dialogs_per_user:]
+            ]
+
+    def _get_archived_dialog(self, dialog_id: str):
+        with self._lock:
+            return copy.deepcopy(self.archived_dialogs.get(dialog_id))
+
+    def _put_archived_dialogs(self, archived_dialog_dicts: list):
+        with self._lock:
+            for archived_dialog_dict in archived_dialog_dicts:
+                self.archived_dialogs[archived_dialog_dict["_id"]] = copy.deepcopy(archived_dialog_dict)
+
+    def _delete_archived_dialogs(self, archived_before):
+        with self._lock:
+            for dialog_id, archived_dialog_dict in list(self.archived_dialogs.items()):
+                if archived_dialog_dict["archived_at"] < archived_before:
+                    del self.archived_dialogs[dialog_id]
+
+    def _get_static_asset(self, name: str):
+        with self._lock:
+            return copy.deepcopy(self.static_assets.get(name))
+
+    def _put_static_asset(self, static_asset_dict: dict):
+        with self._lock:
+            self.static_assets[static_asset_dict["_id"]] = copy.deepcopy(static_asset_dict)
@@ -0,0 +1,23 @@
+"""Replace embedded copies of built-in chat modes in user documents with references to chat_modes.yml
+
+Usage:
+    python3 bot/migrate_chat_modes.py [--batch-size 1000]
+"""
+
+import argparse
+
+import database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    db = database.open_database()
+    n_updated_users = db.migrate_chat_modes_to_refs(batch_size=args.batch_size)
+    print(f"Updated {n_updated_users} users")
+
+
+if __name__ == "__main__":
+    main()
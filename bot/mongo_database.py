@@ -0,0 +1,270 @@
+import bson
+import zlib
+import pymongo
+from datetime import datetime
+from typing import Optional
+from pymongo.server_api import ServerApi
+from pymongo.errors import OperationFailure
+
+import config
+from database import Database
+
+
+def create_client(uri: Optional[str] = None):
+    return pymongo.MongoClient(uri or config.database_uri, server_api=ServerApi('1'))
+
+
+class MongoDatabase(Database):
+    def __init__(self, database_name: str = "chatgpt_telegram_bot", uri: Optional[str] = None, client: Optional[pymongo.MongoClient] = None):
+        super().__init__()
+
+        # bots hosted in one process pass a shared client, so that they share its connection pool
+        self.client = client if client is not None else create_client(uri)
+        self.db = self.client[database_name]
+
+        self.user_collection = self.db["user"]
+        self.dialog_collection = self.db["dialog"]
+        self.dialog_archive_collection = self.db["dialog_archive"]
+        self.static_asset_collection = self.db["static_asset"]
+
+        self.create_indexes()
+
+    def create_indexes(self):
+        # create_index is a no-op for existing indexes, so this is safe to run on every start
+        self.user_collection.create_index("current_dialog_id")
+
+        # recent dialogs per user and the archiver's age scan
+        self.dialog_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)])
+        self.dialog_collection.create_index("start_time")
+
+        # archived dialogs are hard deleted after TTL
+        self.dialog_archive_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)])
+        dialog_archive_ttl = config.dialog_archive_ttl_days * 24 * 3600
+        try:
+            self.dialog_archive_collection.create_index("archived_at", expireAfterSeconds=dialog_archive_ttl)
+        except OperationFailure:
+            # TTL was changed in config
+            self.db.command(
+                "collMod", self.dialog_archive_collection.name,
+                index={"keyPattern": {"archived_at": 1}, "expireAfterSeconds": dialog_archive_ttl}
+            )
+
+    def _find_user(self, user_id: int, keys: list):
+        return self.user_collection.find_one({"_id": user_id}, {key: 1 for key in keys})
+
+    def _insert_user(self, user_dict: dict):
+        self.user_collection.insert_one(user_dict)
+
+    def _update_user(self, user_id: int, update: dict, unless_exists: Optional[str] = None):
+        filter = {"_id": user_id}
+        if unless_exists is not None:
+            filter[unless_exists] = {"$exists": False}
+
+        return self.user_collection.update_one(filter, update).matched_count > 0
+
+    def _save_last_interactions(self, last_interactions: dict):
+        # $max keeps a newer value written by another process
+        requests = [
+            pymongo.UpdateOne({"_id": user_id}, {"$max": {"last_interaction": last_interaction}})
+            for user_id, last_interaction in last_interactions.items()
+        ]
+        self.user_collection.bulk_write(requests, ordered=False)
+
+    def _insert_dialog(self, dialog_dict: dict):
+        self.dialog_collection.insert_one(dialog_dict)
+
+    def _iter_user_chat_modes(self, batch_size: int):
+        cursor = self.user_collection.find(
+            {"chat_modes.prompt_start": {"$exists": True}},
+            {"chat_modes": 1},
+            batch_size=batch_size
+        )
+        for user_dict in cursor:
+            yield user_dict["_id"], user_dict["chat_modes"]
+
+    def _set_users_chat_modes(self, user_chat_modes: list):
+        requests = [pymongo.UpdateOne({"_id": user_id}, {"$set": {"chat_modes": chat_modes}}) for user_id, chat_modes in user_chat_modes]
+        return self.user_collection.bulk_write(requests, ordered=False).modified_count
+
+    def _find_old_dialog_ids(self, start_time_threshold: datetime, batch_size: int):
+        cursor = self.dialog_collection.find(
+            {"start_time": {"$lt": start_time_threshold}},
+            {"_id": 1},
+            batch_size=batch_size
+        )
+        return (dialog_dict["_id"] for dialog_dict in cursor)
+
+    def _find_excess_dialog_ids(self, max_dialogs_per_user: int, batch_size: int, user_ids=None):
+        if user_ids is None:
+            # all users, once per process
+            cursor = self.dialog_collection.aggregate([
+                {"$sort": {"user_id": 1, "start_time": -1}},
+                {"$group": {"_id": "$user_id", "dialog_ids": {"$push": "$_id"}}},
+                {"$match": {f"dialog_ids.{max_dialogs_per_user}": {"$exists": True}}},
+                {"$project": {"dialog_ids": {"$slice": ["$dialog_ids", max_dialogs_per_user, {"$size": "$dialog_ids"}]}}}
+            ], allowDiskUse=True, batchSize=batch_size)
+            yield from (dialog_id for user_dict in cursor for dialog_id in user_dict["dialog_ids"])
+            return
+
+        # walks the (user_id, start_time) index of each user past the newest dialogs
+        for user_id in user_ids:
+            cursor = self.dialog_collection.find(
+                {"user_id": user_id},
+                {"_id": 1},
+                batch_size=batch_size
+            ).sort("start_time", pymongo.DESCENDING).skip(max_dialogs_per_user)
+            yield from (dialog_dict["_id"] for dialog_dict in cursor)
+
+    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None, last_n: Optional[int] = None):
+        # last_n: fetch only the last n messages
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        if last_n is not None and last_n <= 0:
+            return []
+
+        projection = {"messages": 1 if last_n is None else {"$slice": -last_n}}
+        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, projection)
+        if dialog_dict is None:
+            dialog_dict = self.get_archived_dialog(user_id, dialog_id)
+            if last_n is not None:
+                dialog_dict["messages"] = dialog_dict["messages"][-last_n:]
+
+        return dialog_dict["messages"]
+
+    def get_recent_dialogs(self, user_id: int, limit: int, exclude_dialog_id: Optional[str] = None):
+        # [(dialog_id, messages), ...] newest first, archived dialogs are not included
+        cursor = self.dialog_collection.find(
+            {"user_id": user_id, "_id": {"$ne": exclude_dialog_id}},
+            {"messages.user": 1, "messages.bot": 1}
+        ).sort("start_time", pymongo.DESCENDING).limit(limit)
+
+        return [(dialog_dict["_id"], dialog_dict.get("messages", [])) for dialog_dict in cursor]
+
+    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"messages": dialog_messages}}
+        )
+
+    def push_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": dialog_message}}
+        )
+
+    def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None):
+        # removes the last message and returns it (None if the dialog is empty)
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$pop": {"messages": 1}},
+            projection={"messages": {"$slice": -1}},
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        if dialog_dict is None or len(dialog_dict["messages"]) == 0:
+            return None
+
+        return dialog_dict["messages"][-1]
+
+    def update_dialog_message(self, user_id: int, index: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {f"messages.{index}": dialog_message}}
+        )
+
+    def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"summary": 1, "n_summarized_messages": 1}
+        )
+        if dialog_dict is None:
+            dialog_dict = self.get_archived_dialog(user_id, dialog_id)
+
+        return dialog_dict.get("summary", ""), dialog_dict.get("n_summarized_messages", 0)
+
+    def set_dialog_summary(self, user_id: int, summary: str, n_summarized_messages: int, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+
+        self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"summary": summary, "n_summarized_messages": n_summarized_messages}}
+        )
+
+    def archive_dialogs(self, dialog_ids: list):
+        current_dialog_ids = {
+            user_dict["current_dialog_id"]
+            for user_dict in self.user_collection.find({"current_dialog_id": {"$in": dialog_ids}}, {"current_dialog_id": 1})
+        }
+
+        archived_at = datetime.now()
+        requests = []
+        archived_dialog_ids = []
+        for dialog_dict in self.dialog_collection.find({"_id": {"$in": dialog_ids}}):
+            if dialog_dict["_id"] in current_dialog_ids:
+                continue
+
+            archived_dialog_dict = self._compress_dialog(dialog_dict)
+            archived_dialog_dict["archived_at"] = archived_at
+
+            # upsert, so that an interrupted previous run doesn't fail on duplicate keys
+            requests.append(pymongo.ReplaceOne({"_id": dialog_dict["_id"]}, archived_dialog_dict, upsert=True))
+            archived_dialog_ids.append(dialog_dict["_id"])
+
+        if len(requests) == 0:
+            return 0
+
+        self.dialog_archive_collection.bulk_write(requests, ordered=False)
+        self.dialog_collection.delete_many({"_id": {"$in": archived_dialog_ids}})
+
+        return len(archived_dialog_ids)
+
+    def get_archived_dialog(self, user_id: int, dialog_id: str):
+        archived_dialog_dict = self.dialog_archive_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if archived_dialog_dict is None:
+            raise ValueError(f"Dialog {dialog_id} does not exist")
+
+        return self._decompress_dialog(archived_dialog_dict)
+
+    def get_static_asset_file_id(self, name: str, version: str):
+        # Telegram file_id of an uploaded static file, None if this version wasn't uploaded yet
+        static_asset_dict = self.static_asset_collection.find_one({"_id": name, "version": version}, {"file_id": 1})
+        return static_asset_dict["file_id"] if static_asset_dict is not None else None
+
+    def set_static_asset_file_id(self, name: str, version: str, file_id: str):
+        self.static_asset_collection.update_one(
+            {"_id": name},
+            {"$set": {"version": version, "file_id": file_id, "uploaded_at": datetime.now()}},
+            upsert=True
+        )
+
+    def _compress_dialog(self, dialog_dict: dict):
+        # metadata stays queryable, the rest (messages, summary, ...) is stored as zlib-compressed BSON
+        metadata_keys = {"_id", "user_id", "chat_mode", "start_time", "model"}
+
+        archived_dialog_dict = {key: value for key, value in dialog_dict.items() if key in metadata_keys}
+        data = {key: value for key, value in dialog_dict.items() if key not in metadata_keys}
+        archived_dialog_dict["data"] = bson.Binary(zlib.compress(bson.encode(data)))
+
+        return archived_dialog_dict
+
+    def _decompress_dialog(self, archived_dialog_dict: dict):
+        dialog_dict = {key: value for key, value in archived_dialog_dict.items() if key not in {"data", "archived_at"}}
+        dialog_dict.update(bson.decode(zlib.decompress(archived_dialog_dict["data"])))
+
+        return dialog_dict
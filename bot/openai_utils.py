@@ -1,8 +1,18 @@
+import hashlib
+import contextlib
+
 import config
+from cache import LRUCache
+
+# openai and tiktoken are imported on first use to keep startup fast
+_openai = None
+_encodings = {}
 
-import tiktoken
-import openai
-openai.api_key = config.openai_api_key
+# sha256 of the text -> is acceptable
+_moderation_verdicts = LRUCache(maxsize=10000)
+
+# completion, image and transcription requests being made, a signal of the overload controller
+_n_requests_in_flight = 0
 
 
 OPENAI_COMPLETION_OPTIONS = {
@@ -13,102 +23,164 @@ OPENAI_COMPLETION_OPTIONS = {
     "presence_penalty": 0
 }
 
+DIALOG_SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the current summary with the new messages. Keep facts, names, decisions, code identifiers and open questions "
+    "that may be needed later in the conversation. Be concise, use the language of the conversation and reply with the summary only."
+)
+
+MEMORY_PROMPT = "Excerpts from earlier conversations with the user that may be relevant:"
+
 
 class ChatGPT:
     def __init__(self, model="gpt-3.5-turbo"):
-        assert model in {"text-davinci-003", "gpt-3.5-turbo", "gpt-4", "gpt-3.5-turbo-16k"}, f"Unknown model: {model}"
+        snapshot = config.get_snapshot()
+        assert model in snapshot.text_models, f"Unknown model: {model}"
         self.model = model
+        self.model_type = snapshot.model_types[model]
+
+        # other answers of the last request made with n_candidates > 1, distinct from the returned one
+        self.alternative_answers = []
 
-    async def send_message(self, message, dialog_messages=[], chat_mode_prompt=""):
+    async def send_message(self, message, dialog_messages=[], chat_mode_prompt="", dialog_summary="", memory_snippets=[], max_tokens=None, n_candidates=1):
+        openai = get_openai()
+        completion_options = get_completion_options(max_tokens)
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model in {"gpt-3.5-turbo", "gpt-4", "gpt-3.5-turbo-16k"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode_prompt)
-                    r = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message["content"]
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode_prompt)
-                    r = await openai.Completion.acreate(
-                        engine=self.model,
-                        prompt=prompt,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].text
-                else:
-                    raise ValueError(f"Unknown model: {self.model}")
-
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        with _count_request():
+            answer = None
+            while answer is None:
+                try:
+                    if self.model_type == "chat_completion":
+                        messages = self._generate_prompt_messages(message, dialog_messages, chat_mode_prompt, dialog_summary, memory_snippets)
+                        r = await openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            n=n_candidates,
+                            **completion_options
+                        )
+                        answers = [choice.message["content"] for choice in r.choices]
+                    elif self.model_type == "completion":
+                        prompt = self._generate_prompt(message, dialog_messages, chat_mode_prompt, dialog_summary, memory_snippets)
+                        r = await openai.Completion.acreate(
+                            engine=self.model,
+                            prompt=prompt,
+                            n=n_candidates,
+                            **completion_options
+                        )
+                        answers = [choice.text for choice in r.choices]
+                    else:
+                        raise ValueError(f"Unknown model: {self.model}")
+
+                    answer = self._postprocess_answer(answers[0])
+                    self.alternative_answers = self._get_alternative_answers(answer, answers[1:])
+                    n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens  # of all candidates
+                except openai.error.InvalidRequestError as e:  # too many tokens
+                    if len(dialog_messages) == 0:
+                        raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
+
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
 
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
         return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode_prompt=""):
+    async def send_message_stream(self, message, dialog_messages=[], chat_mode_prompt="", dialog_summary="", memory_snippets=[], max_tokens=None, n_candidates=1):
+        # with n_candidates > 1 the first answer is streamed, the others are set to alternative_answers at the end
+        openai = get_openai()
+        completion_options = get_completion_options(max_tokens)
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model in {"gpt-3.5-turbo", "gpt-4", "gpt-3.5-turbo-16k"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode_prompt)
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-                        if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                            n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode_prompt)
-                    r_gen = await openai.Completion.acreate(
-                        engine=self.model,
-                        prompt=prompt,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
-                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                        yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-
-                answer = self._postprocess_answer(answer)
-
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        with _count_request():
+            answer = None
+            while answer is None:
+                try:
+                    if self.model_type == "chat_completion":
+                        messages = self._generate_prompt_messages(message, dialog_messages, chat_mode_prompt, dialog_summary, memory_snippets)
+                        r_gen = await openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            n=n_candidates,
+                            stream=True,
+                            **completion_options
+                        )
+
+                        answer = ""
+                        answers = [""] * n_candidates
+                        async for r_item in r_gen:
+                            for choice in r_item.choices:
+                                if "content" not in choice.delta:
+                                    continue
+
+                                answers[choice.index] += choice.delta.content
+                                if choice.index == 0:
+                                    answer = answers[0]
+                                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
+                                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+                                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                        for alternative_answer in answers[1:]:
+                            n_output_tokens += self._count_tokens_from_messages(messages, alternative_answer, model=self.model)[1]
+                    elif self.model_type == "completion":
+                        prompt = self._generate_prompt(message, dialog_messages, chat_mode_prompt, dialog_summary, memory_snippets)
+                        r_gen = await openai.Completion.acreate(
+                            engine=self.model,
+                            prompt=prompt,
+                            n=n_candidates,
+                            stream=True,
+                            **completion_options
+                        )
+
+                        answer = ""
+                        answers = [""] * n_candidates
+                        async for r_item in r_gen:
+                            for choice in r_item.choices:
+                                answers[choice.index] += choice.text
+                                if choice.index == 0:
+                                    answer = answers[0]
+                                    n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
+                                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+                                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                        for alternative_answer in answers[1:]:
+                            n_output_tokens += self._count_tokens_from_prompt(prompt, alternative_answer, model=self.model)[1]
+
+                    answer = self._postprocess_answer(answer)
+                    self.alternative_answers = self._get_alternative_answers(answer, answers[1:])
+
+                except openai.error.InvalidRequestError as e:  # too many tokens
+                    if len(dialog_messages) == 0:
+                        raise e
+
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
 
         yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
 
-    def _generate_prompt(self, message, dialog_messages, chat_mode_prompt):
+    async def summarize_dialog(self, dialog_summary, dialog_messages):
+        message = ""
+        if dialog_summary:
+            message += f"Current summary:\n{dialog_summary}\n\n"
+
+        message += "New messages:\n"
+        for dialog_message in dialog_messages:
+            message += f"User: {dialog_message['user']}\n"
+            message += f"Assistant: {dialog_message['bot']}\n"
+
+        answer, (n_input_tokens, n_output_tokens), _ = await self.send_message(message, dialog_messages=[], chat_mode_prompt=DIALOG_SUMMARY_PROMPT)
+        return answer, (n_input_tokens, n_output_tokens)
+
+    def _generate_prompt(self, message, dialog_messages, chat_mode_prompt, dialog_summary="", memory_snippets=[]):
         prompt = chat_mode_prompt
         prompt += "\n\n"
 
+        # relevant messages from the user's previous dialogs
+        if memory_snippets:
+            prompt += MEMORY_PROMPT + "\n" + "\n\n".join(memory_snippets) + "\n\n"
+
+        # summary of the messages that are no longer in the context
+        if dialog_summary:
+            prompt += f"Summary of the earlier conversation:\n{dialog_summary}\n\n"
+
         # add chat context
         if len(dialog_messages) > 0:
             prompt += "Chat:\n"
@@ -122,9 +194,17 @@ class ChatGPT:
 
         return prompt
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode_prompt):
+    def _generate_prompt_messages(self, message, dialog_messages, chat_mode_prompt, dialog_summary="", memory_snippets=[]):
         prompt = chat_mode_prompt
 
+        # relevant messages from the user's previous dialogs
+        if memory_snippets:
+            prompt += f"\n\n{MEMORY_PROMPT}\n" + "\n\n".join(memory_snippets)
+
+        # summary of the messages that are no longer in the context
+        if dialog_summary:
+            prompt += f"\n\nSummary of the earlier conversation:\n{dialog_summary}"
+
         messages = [{"role": "system", "content": prompt}]
         for dialog_message in dialog_messages:
             messages.append({"role": "user", "content": dialog_message["user"]})
@@ -137,8 +217,17 @@ class ChatGPT:
         answer = answer.strip()
         return answer
 
+    def _get_alternative_answers(self, answer, other_answers):
+        # empty and repeated candidates are dropped
+        alternative_answers = []
+        for other_answer in map(self._postprocess_answer, other_answers):
+            if other_answer and other_answer != answer and other_answer not in alternative_answers:
+                alternative_answers.append(other_answer)
+
+        return alternative_answers
+
     def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = get_encoding(model)
 
         if model == "gpt-3.5-turbo":
             tokens_per_message = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
@@ -169,7 +258,7 @@ class ChatGPT:
         return n_input_tokens, n_output_tokens
 
     def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = get_encoding(model)
 
         n_input_tokens = len(encoding.encode(prompt)) + 1
         n_output_tokens = len(encoding.encode(answer))
@@ -177,17 +266,123 @@ class ChatGPT:
         return n_input_tokens, n_output_tokens
 
 
+def get_openai():
+    global _openai
+
+    if _openai is None:
+        import openai
+        openai.api_key = config.openai_api_key
+        _openai = openai
+
+    return _openai
+
+
+async def open_http_session():
+    """Share one aiohttp connection pool between all OpenAI requests.
+
+    openai creates a session per request unless openai.aiosession is set. It is a
+    context variable, so this has to be called before the tasks that make requests
+    are created.
+    """
+    import aiohttp
+
+    session = aiohttp.ClientSession()
+    get_openai().aiosession.set(session)
+
+    return session
+
+
+def get_completion_options(max_tokens=None):
+    # max_tokens lowers the answer length of a single request, OPENAI_COMPLETION_OPTIONS stays as is
+    if max_tokens is None:
+        return OPENAI_COMPLETION_OPTIONS
+
+    return {**OPENAI_COMPLETION_OPTIONS, "max_tokens": min(max_tokens, OPENAI_COMPLETION_OPTIONS["max_tokens"])}
+
+
+@contextlib.contextmanager
+def _count_request():
+    global _n_requests_in_flight
+
+    _n_requests_in_flight += 1
+    try:
+        yield
+    finally:
+        _n_requests_in_flight -= 1
+
+
+def get_n_requests_in_flight():
+    return _n_requests_in_flight
+
+
+def get_encoding(model):
+    if model not in _encodings:
+        import tiktoken
+        _encodings[model] = tiktoken.encoding_for_model(model)
+
+    return _encodings[model]
+
+
+def warm_up_tokenizers(models):
+    for model in models:
+        get_encoding(model)
+
+
+def count_dialog_tokens(dialog_messages, model="gpt-3.5-turbo"):
+    encoding = get_encoding(model)
+
+    n_tokens = 0
+    for dialog_message in dialog_messages:
+        n_tokens += len(encoding.encode(dialog_message["user"])) + len(encoding.encode(dialog_message["bot"]))
+
+    return n_tokens
+
+
+def estimate_n_tokens(message, dialog_messages=[], chat_mode_prompt="", dialog_summary="", memory_snippets=[], model="gpt-3.5-turbo", n_candidates=1):
+    # upper bound for a request: the prompt texts and the maximal answers
+    encoding = get_encoding(model)
+
+    texts = [message, chat_mode_prompt, dialog_summary, *memory_snippets]
+    n_tokens = sum(len(encoding.encode(text)) for text in texts)
+    n_tokens += count_dialog_tokens(dialog_messages, model=model)
+
+    return n_tokens + n_candidates * OPENAI_COMPLETION_OPTIONS["max_tokens"]
+
+
+def fit_to_token_budget(texts, max_n_tokens, model="gpt-3.5-turbo"):
+    # texts in the given order while they fit into max_n_tokens, texts that don't fit are skipped
+    encoding = get_encoding(model)
+
+    fitted_texts, n_tokens = [], 0
+    for text in texts:
+        n_text_tokens = len(encoding.encode(text))
+        if n_tokens + n_text_tokens <= max_n_tokens:
+            fitted_texts.append(text)
+            n_tokens += n_text_tokens
+
+    return fitted_texts
+
+
 async def transcribe_audio(audio_file):
-    r = await openai.Audio.atranscribe("whisper-1", audio_file)
+    with _count_request():
+        r = await get_openai().Audio.atranscribe("whisper-1", audio_file)
     return r["text"]
 
 
 async def generate_images(prompt, n_images=4):
-    r = await openai.Image.acreate(prompt=prompt, n=n_images, size="512x512")
+    with _count_request():
+        r = await get_openai().Image.acreate(prompt=prompt, n=n_images, size="512x512")
     image_urls = [item.url for item in r.data]
     return image_urls
 
 
 async def is_content_acceptable(prompt):
-    r = await openai.Moderation.acreate(input=prompt)
-    return not all(r.results[0].categories.values())
+    key = hashlib.sha256(prompt.encode()).digest()
+
+    is_acceptable = _moderation_verdicts.get(key)
+    if is_acceptable is None:
+        r = await get_openai().Moderation.acreate(input=prompt)
+        is_acceptable = not r.results[0].flagged
+        _moderation_verdicts.set(key, is_acceptable)
+
+    return is_acceptable
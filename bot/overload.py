@@ -0,0 +1,124 @@
+"""Load shedding and graceful degradation under overload
+
+The overload level is derived from three signals: event loop lag, the number
+of OpenAI requests in flight and the rate of Telegram 429 (RetryAfter)
+responses. Every signal has one threshold per level above normal, the level is
+the highest one reached by any signal. It goes up at once and comes down one
+step at a time, after the signals have stayed below the current level for
+recovery_delay seconds, so that the bot doesn't flap between levels.
+"""
+
+import time
+import asyncio
+import logging
+import collections
+from typing import Callable
+
+from telegram.error import RetryAfter
+from telegram.ext import AIORateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+# levels, each one includes the degradations of the previous ones
+NORMAL = 0
+FEWER_EDITS = 1  # streamed answers are edited less often
+NO_STREAMING = 2  # answers are sent at once
+LOWER_MAX_TOKENS = 3  # answers are shorter
+REJECTING = 4  # new requests are politely rejected
+
+LEVEL_NAMES = ("normal", "fewer_edits", "no_streaming", "lower_max_tokens", "rejecting")
+SIGNALS = ("loop_lag", "n_openai_requests", "n_telegram_429_per_minute")
+
+
+class OverloadController:
+    def __init__(
+        self,
+        thresholds: dict,
+        get_n_openai_requests: Callable[[], int],
+        update_interval: float = 1.0,
+        recovery_delay: float = 30.0
+    ):
+        # signal -> thresholds of levels FEWER_EDITS..REJECTING, signals not listed are ignored
+        for signal, signal_thresholds in thresholds.items():
+            if signal not in SIGNALS:
+                raise ValueError(f"Unknown overload signal: {signal}")
+            if len(signal_thresholds) != len(LEVEL_NAMES) - 1 or list(signal_thresholds) != sorted(signal_thresholds):
+                raise ValueError(f"Overload signal {signal} needs {len(LEVEL_NAMES) - 1} ascending thresholds")
+
+        self.thresholds = thresholds
+        self.get_n_openai_requests = get_n_openai_requests
+        self.update_interval = update_interval
+        self.recovery_delay = recovery_delay
+
+        self.level = NORMAL
+        self.loop_lag = 0.0
+        self._telegram_429_times = collections.deque()
+        self._last_high_time = time.monotonic()  # last time the signals were at the current level or above
+
+    def record_telegram_429(self):
+        self._telegram_429_times.append(time.monotonic())
+
+    def get_signals(self):
+        # forget 429s older than a minute
+        now = time.monotonic()
+        while len(self._telegram_429_times) > 0 and now - self._telegram_429_times[0] > 60:
+            self._telegram_429_times.popleft()
+
+        return {
+            "loop_lag": self.loop_lag,
+            "n_openai_requests": self.get_n_openai_requests(),
+            "n_telegram_429_per_minute": len(self._telegram_429_times)
+        }
+
+    def update(self):
+        signals = self.get_signals()
+
+        signal_level = NORMAL
+        for signal, signal_thresholds in self.thresholds.items():
+            signal_level = max(signal_level, sum(signals[signal] >= threshold for threshold in signal_thresholds))
+
+        now = time.monotonic()
+        if signal_level >= self.level:
+            if signal_level > self.level:
+                logger.warning(f"Overload level raised to {LEVEL_NAMES[signal_level]}, signals: {signals}")
+            self.level = signal_level
+            self._last_high_time = now
+        elif now - self._last_high_time >= self.recovery_delay:
+            self.level -= 1
+            self._last_high_time = now
+            logger.info(f"Overload level lowered to {LEVEL_NAMES[self.level]}, signals: {signals}")
+
+        return self.level
+
+    async def run(self):
+        # the lag is how late a sleep wakes up, measured on the loop being monitored
+        loop = asyncio.get_running_loop()
+        while True:
+            t_start = loop.time()
+            await asyncio.sleep(self.update_interval)
+            self.loop_lag = max(loop.time() - t_start - self.update_interval, 0.0)
+
+            self.update()
+
+
+class OverloadRateLimiter(AIORateLimiter):
+    """AIORateLimiter that reports Telegram's 429 responses to an OverloadController"""
+
+    def __init__(self, overload_controller: OverloadController, **kwargs):
+        super().__init__(**kwargs)
+        self.overload_controller = overload_controller
+
+        if not hasattr(AIORateLimiter, "_run_request"):
+            logger.warning("AIORateLimiter._run_request is gone, Telegram 429s are not counted as an overload signal")
+
+    # _run_request is private to python-telegram-bot's AIORateLimiter (20.1, pinned in requirements.txt),
+    # check it on upgrades. process_request would be the public hook, but it retries RetryAfter
+    # internally and only the last of the 429s would reach an override of it
+    async def _run_request(self, *args, **kwargs):
+        # every attempt goes through here, retries of process_request included
+        try:
+            return await super()._run_request(*args, **kwargs)
+        except RetryAfter:
+            self.overload_controller.record_telegram_429()
+            raise
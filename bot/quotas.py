@@ -0,0 +1,149 @@
+"""Daily and monthly per-user usage limits
+
+Counters live in memory and are loaded from the user document once per user,
+checks don't touch the database. The estimated amount is reserved before a
+request and replaced with the actual amount afterwards, so concurrent requests
+can't overshoot a limit. The counters are saved together with the usage
+update that follows every request (see Database.update_n_used_tokens).
+
+Amounts are in tokens for text models, in images for dalle-2 and in seconds
+for whisper.
+"""
+
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from cache import LRUCache
+
+
+PERIOD_FORMATS = {
+    "daily": "%Y-%m-%d",
+    "monthly": "%Y-%m"
+}
+
+
+def get_model_key(model: str):
+    # same as Database._get_usage_key, model names are used as field names
+    return model.replace(".", "_")
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, model: str, period_type: str, limit: float):
+        super().__init__(f"{period_type} limit of {limit} for {model} is reached")
+        self.model = model
+        self.period_type = period_type
+        self.limit = limit
+
+
+class Reservation:
+    def __init__(self, user_id: int, model: str, amount: float):
+        self.user_id = user_id
+        self.model = model
+        self.amount = amount
+        self.is_reconciled = False
+
+
+class _UserCounters:
+    def __init__(self, quota_usage: Optional[dict], now: datetime):
+        # period_type -> {"period": ..., "models": {model_key: amount}}, only current periods are kept
+        self.usage = {}
+        for period_type, period_format in PERIOD_FORMATS.items():
+            period_usage = (quota_usage or {}).get(period_type) or {}
+            if period_usage.get("period") == now.strftime(period_format):
+                self.usage[period_type] = {"period": period_usage["period"], "models": dict(period_usage.get("models", {}))}
+
+        self.reserved: Dict[str, float] = {}  # model_key -> amount
+
+    def get_period_usage(self, period_type: str, now: datetime):
+        period = now.strftime(PERIOD_FORMATS[period_type])
+        if self.usage.get(period_type, {}).get("period") != period:
+            self.usage[period_type] = {"period": period, "models": {}}
+
+        return self.usage[period_type]["models"]
+
+
+class QuotaTracker:
+    def __init__(self, limits: dict, max_n_users: int = 100000):
+        # period_type -> {model_key: limit}
+        self.limits = {
+            period_type: {get_model_key(model): limit for model, limit in (limits.get(period_type) or {}).items()}
+            for period_type in PERIOD_FORMATS
+        }
+
+        # reservations are made in the thread pool and on the event loop
+        self._users = LRUCache(maxsize=max_n_users)
+        self._lock = threading.Lock()
+
+    def is_loaded(self, user_id: int):
+        with self._lock:
+            return user_id in self._users
+
+    def load(self, user_id: int, quota_usage: Optional[dict]):
+        # quota_usage: the "quota_usage" field of the user document
+        with self._lock:
+            if user_id not in self._users:
+                self._users.set(user_id, _UserCounters(quota_usage, datetime.now()))
+
+    def reserve(self, user_id: int, model: str, amount: float):
+        """Reserve amount for a request, raises QuotaExceeded if a limit would be exceeded."""
+        model_key = get_model_key(model)
+        now = datetime.now()
+
+        with self._lock:
+            user_counters = self._users.get(user_id)
+            if user_counters is None:
+                raise ValueError(f"Quota usage of user {user_id} is not loaded")
+            n_reserved = user_counters.reserved.get(model_key, 0)
+
+            for period_type, period_limits in self.limits.items():
+                if model_key not in period_limits:
+                    continue
+
+                n_used = user_counters.get_period_usage(period_type, now).get(model_key, 0)
+                if n_used + n_reserved + amount > period_limits[model_key]:
+                    raise QuotaExceeded(model, period_type, period_limits[model_key])
+
+            user_counters.reserved[model_key] = n_reserved + amount
+
+        return Reservation(user_id, model, amount)
+
+    def reconcile(self, reservation: Reservation, amount: float):
+        """Replace the reserved amount with the actual one, returns quota_usage to be saved.
+
+        Reconciling the same reservation again only returns quota_usage.
+        """
+        model_key = get_model_key(reservation.model)
+
+        with self._lock:
+            if reservation.is_reconciled:
+                amount = 0
+            else:
+                reservation.is_reconciled = True
+                user_counters = self._users.get(reservation.user_id)
+                if user_counters is not None:
+                    user_counters.reserved[model_key] = max(user_counters.reserved.get(model_key, 0) - reservation.amount, 0)
+
+        return self.add(reservation.user_id, reservation.model, amount)
+
+    def add(self, user_id: int, model: str, amount: float):
+        """Count usage that wasn't reserved, returns quota_usage to be saved.
+
+        Returns None for users that aren't loaded, so that saving doesn't overwrite their counters.
+        """
+        model_key = get_model_key(model)
+        now = datetime.now()
+
+        with self._lock:
+            user_counters = self._users.get(user_id)
+            if user_counters is None:
+                return None
+
+            for period_type in PERIOD_FORMATS:
+                period_usage = user_counters.get_period_usage(period_type, now)
+                period_usage[model_key] = period_usage.get(model_key, 0) + amount
+
+            return {
+                period_type: {"period": period_usage["period"], "models": dict(period_usage["models"])}
+                for period_type, period_usage in user_counters.usage.items()
+            }
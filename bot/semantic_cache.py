@@ -0,0 +1,122 @@
+"""Near-duplicate question cache
+
+Questions are turned into hashed vectors of character trigrams and words (no
+external embedding service), answers of similar enough questions are reused.
+Each (chat mode, model) pair has its own fixed-size ring buffer of vectors, so
+memory is bounded by max_n_entries * n_features * 4 bytes per pair, and lookup
+is one matrix-vector product.
+"""
+
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+NGRAM_SIZE = 3
+
+_non_word_re = re.compile(r"[^\w]+")
+_number_re = re.compile(r"\d+")
+
+
+def normalize_text(text: str):
+    return _non_word_re.sub(" ", text.lower()).strip()
+
+
+def get_features(text: str):
+    normalized_text = normalize_text(text)
+    padded_text = f" {normalized_text} "
+
+    features = [padded_text[i:i + NGRAM_SIZE] for i in range(len(padded_text) - NGRAM_SIZE + 1)]
+    features += [f"w:{word}" for word in normalized_text.split()]
+
+    return features
+
+
+def hash_features(features: List[str], n_features: int):
+    # signed feature hashing, the top bit of the hash decides the sign, so that collisions cancel out on average
+    hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes >> 31, -1.0, 1.0)
+
+    return np.bincount(hashes % n_features, weights=signs, minlength=n_features).astype(np.float32)
+
+
+class _Index:
+    def __init__(self, max_n_entries: int, n_features: int):
+        self.vectors = np.zeros((max_n_entries, n_features), dtype=np.float32)
+        self.numbers: List[Optional[Tuple[str, ...]]] = [None] * max_n_entries
+        self.answers: List[Optional[str]] = [None] * max_n_entries
+        self.n_entries = 0
+        self.next_position = 0
+
+    def add(self, vector: np.ndarray, numbers: Tuple[str, ...], answer: str):
+        position = self.next_position
+        self.vectors[position] = vector
+        self.numbers[position] = numbers
+        self.answers[position] = answer
+
+        max_n_entries = len(self.answers)
+        self.next_position = (position + 1) % max_n_entries
+        self.n_entries = min(self.n_entries + 1, max_n_entries)
+
+
+class SemanticCache:
+    """Answers of previous single-turn questions, looked up by cosine similarity"""
+
+    def __init__(self, max_n_entries: int = 1000, n_features: int = 1024):
+        self.max_n_entries = max_n_entries
+        self.n_features = n_features
+
+        self._indices: Dict[Tuple[str, str], _Index] = {}
+
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def vectorize(self, text: str):
+        features = get_features(text)
+        if len(features) == 0:
+            return None
+
+        vector = hash_features(features, self.n_features)
+
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+
+        return vector / norm
+
+    def get(self, chat_mode: str, model: str, message: str, threshold: float):
+        index = self._indices.get((chat_mode, model))
+        vector = self.vectorize(message)
+        if index is None or index.n_entries == 0 or vector is None:
+            self.n_misses += 1
+            return None
+
+        similarities = index.vectors[:index.n_entries] @ vector
+        position = int(np.argmax(similarities))
+
+        # "what is 2+2" and "what is 2+3" are very similar as text, but not as questions
+        if similarities[position] >= threshold and index.numbers[position] == tuple(_number_re.findall(message)):
+            self.n_hits += 1
+            return index.answers[position]
+
+        self.n_misses += 1
+        return None
+
+    def add(self, chat_mode: str, model: str, message: str, answer: str):
+        vector = self.vectorize(message)
+        if vector is None:
+            return
+
+        key = (chat_mode, model)
+        if key not in self._indices:
+            self._indices[key] = _Index(self.max_n_entries, self.n_features)
+
+        self._indices[key].add(vector, tuple(_number_re.findall(message)), answer)
+
+    def clear(self):
+        self._indices.clear()
+
+    def __len__(self):
+        return sum(index.n_entries for index in self._indices.values())
@@ -0,0 +1,208 @@
+import sqlite3
+import contextlib
+from pathlib import Path
+from datetime import datetime
+from typing import Any, Optional
+
+from document_database import DocumentDatabase, encode_document, decode_document
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS dialog (id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, start_time TEXT NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS dialog_user_id_start_time ON dialog (user_id, start_time DESC);
+CREATE INDEX IF NOT EXISTS dialog_start_time ON dialog (start_time);
+CREATE TABLE IF NOT EXISTS dialog_archive (id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, archived_at TEXT NOT NULL, metadata TEXT NOT NULL, data BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS dialog_archive_archived_at ON dialog_archive (archived_at);
+CREATE TABLE IF NOT EXISTS static_asset (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+"""
+
+# statements are constant and parametrized, so sqlite3 compiles each one once per connection and reuses it
+SELECT_USER = "SELECT data FROM user WHERE id = ?"
+SELECT_USERS_AFTER = "SELECT id, data FROM user WHERE id > ? ORDER BY id LIMIT ?"
+REPLACE_USER = "INSERT OR REPLACE INTO user (id, data) VALUES (?, ?)"
+SELECT_DIALOG = "SELECT data FROM dialog WHERE id = ?"
+REPLACE_DIALOG = "INSERT OR REPLACE INTO dialog (id, user_id, start_time, data) VALUES (?, ?, ?, ?)"
+DELETE_DIALOG = "DELETE FROM dialog WHERE id = ?"
+SELECT_USER_DIALOGS = "SELECT data FROM dialog WHERE user_id = ? AND id IS NOT ? ORDER BY start_time DESC LIMIT ?"
+SELECT_OLD_DIALOG_IDS = "SELECT id FROM dialog WHERE start_time < ?"
+SELECT_EXCESS_DIALOG_IDS = """
+SELECT id FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY start_time DESC) AS position FROM dialog
+) WHERE position > ?
+"""
+SELECT_USER_EXCESS_DIALOG_IDS = "SELECT id FROM dialog WHERE user_id = ? ORDER BY start_time DESC LIMIT -1 OFFSET ?"
+SELECT_ARCHIVED_DIALOG = "SELECT archived_at, metadata, data FROM dialog_archive WHERE id = ?"
+REPLACE_ARCHIVED_DIALOG = "INSERT OR REPLACE INTO dialog_archive (id, user_id, archived_at, metadata, data) VALUES (?, ?, ?, ?, ?)"
+DELETE_ARCHIVED_DIALOGS = "DELETE FROM dialog_archive WHERE archived_at < ?"
+SELECT_STATIC_ASSET = "SELECT data FROM static_asset WHERE name = ?"
+REPLACE_STATIC_ASSET = "INSERT OR REPLACE INTO static_asset (name, data) VALUES (?, ?)"
+
+MAX_N_QUERY_PARAMETERS = 500  # older SQLite versions allow at most 999
+
+
+def get_database_dir(uri: str):
+    # sqlite:///data is relative to the repo root, sqlite:////var/lib/bot is absolute
+    path = uri.split("://", 1)[1]
+    if path.startswith("/"):
+        path = path[1:]
+
+    return Path(__file__).parent.parent.resolve() / path
+
+
+def format_time(time: datetime):
+    # fixed width, so that the text columns sort as times
+    return time.isoformat(timespec="microseconds")
+
+
+class SQLiteDatabase(DocumentDatabase):
+    """Database in an embedded SQLite file (sqlite:///<directory> URI), one file per database name
+
+    The file is opened in WAL mode, so that readers don't block the writer, with
+    synchronous=NORMAL, which is durable in WAL mode except on power loss. Documents
+    are stored as JSON, writes of several documents go in one transaction with executemany.
+    """
+
+    def __init__(self, database_name: str = "chatgpt_telegram_bot", uri: Optional[str] = None, client: Any = None):
+        super().__init__()
+
+        database_dir = get_database_dir(uri)
+        database_dir.mkdir(parents=True, exist_ok=True)
+        self.path = database_dir / f"{database_name}.sqlite3"
+
+        # shared by the event loop and the thread pool, access is serialized by self._lock;
+        # transactions are managed explicitly (see _transaction)
+        self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+        self._transaction_depth = 0
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock at the start, so that read-modify-write is atomic across processes too
+        with self._lock:
+            if self._transaction_depth > 0:
+                self._transaction_depth += 1
+                try:
+                    yield
+                finally:
+                    self._transaction_depth -= 1
+                return
+
+            self.connection.execute("BEGIN IMMEDIATE")
+            self._transaction_depth = 1
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+            finally:
+                self._transaction_depth = 0
+
+    def _fetch_one(self, query: str, parameters: tuple):
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+    def _get_user(self, user_id: int):
+        row = self._fetch_one(SELECT_USER, (user_id,))
+        return decode_document(row[0]) if row is not None else None
+
+    def _put_users(self, user_dicts: list):
+        if len(user_dicts) == 0:
+            return
+
+        with self._transaction():
+            self.connection.executemany(REPLACE_USER, [(user_dict["_id"], encode_document(user_dict)) for user_dict in user_dicts])
+
+    def _iter_users(self, batch_size: int):
+        # pages by id, so that no cursor stays open while the caller writes
+        last_user_id = -2 ** 63
+        while True:
+            with self._lock:
+                rows = self.connection.execute(SELECT_USERS_AFTER, (last_user_id, batch_size)).fetchall()
+            if len(rows) == 0:
+                return
+
+            for user_id, data in rows:
+                yield decode_document(data)
+            last_user_id = rows[-1][0]
+
+    def _get_dialog(self, dialog_id: str):
+        row = self._fetch_one(SELECT_DIALOG, (dialog_id,))
+        return decode_document(row[0]) if row is not None else None
+
+    def _get_dialogs(self, dialog_ids: list):
+        dialog_dicts = []
+        with self._lock:
+            for i in range(0, len(dialog_ids), MAX_N_QUERY_PARAMETERS):
+                batch = dialog_ids[i:i + MAX_N_QUERY_PARAMETERS]
+                query = f"SELECT data FROM dialog WHERE id IN ({', '.join('?' * len(batch))})"
+                dialog_dicts += [decode_document(data) for data, in self.connection.execute(query, batch)]
+
+        return dialog_dicts
+
+    def _put_dialog(self, dialog_dict: dict):
+        parameters = (dialog_dict["_id"], dialog_dict["user_id"], format_time(dialog_dict["start_time"]), encode_document(dialog_dict))
+        with self._lock:
+            self.connection.execute(REPLACE_DIALOG, parameters)
+
+    def _delete_dialogs(self, dialog_ids: list):
+        with self._transaction():
+            self.connection.executemany(DELETE_DIALOG, [(dialog_id,) for dialog_id in dialog_ids])
+
+    def _get_user_dialogs(self, user_id: int, limit: int, exclude_dialog_id: Optional[str]):
+        with self._lock:
+            rows = self.connection.execute(SELECT_USER_DIALOGS, (user_id, exclude_dialog_id, limit)).fetchall()
+
+        return [decode_document(data) for data, in rows]
+
+    def _find_old_dialog_ids(self, start_time_threshold: datetime, batch_size: int):
+        with self._lock:
+            return [dialog_id for dialog_id, in self.connection.execute(SELECT_OLD_DIALOG_IDS, (format_time(start_time_threshold),))]
+
+    def _find_excess_dialog_ids(self, max_dialogs_per_user: int, batch_size: int, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                return [dialog_id for dialog_id, in self.connection.execute(SELECT_EXCESS_DIALOG_IDS, (max_dialogs_per_user,))]
+
+            return [
+                dialog_id
+                for user_id in user_ids
+                for dialog_id, in self.connection.execute(SELECT_USER_EXCESS_DIALOG_IDS, (user_id, max_dialogs_per_user))
+            ]
+
+    def _get_archived_dialog(self, dialog_id: str):
+        row = self._fetch_one(SELECT_ARCHIVED_DIALOG, (dialog_id,))
+        if row is None:
+            return None
+
+        archived_at, metadata, data = row
+        return {**decode_document(metadata), "archived_at": datetime.fromisoformat(archived_at), "data": data}
+
+    def _put_archived_dialogs(self, archived_dialog_dicts: list):
+        rows = []
+        for archived_dialog_dict in archived_dialog_dicts:
+            metadata = {key: value for key, value in archived_dialog_dict.items() if key not in {"data", "archived_at"}}
+            rows.append((
+                archived_dialog_dict["_id"], archived_dialog_dict["user_id"], format_time(archived_dialog_dict["archived_at"]),
+                encode_document(metadata), archived_dialog_dict["data"]
+            ))
+
+        with self._transaction():
+            self.connection.executemany(REPLACE_ARCHIVED_DIALOG, rows)
+
+    def _delete_archived_dialogs(self, archived_before: datetime):
+        with self._lock:
+            self.connection.execute(DELETE_ARCHIVED_DIALOGS, (format_time(archived_before),))
+
+    def _get_static_asset(self, name: str):
+        row = self._fetch_one(SELECT_STATIC_ASSET, (name,))
+        return decode_document(row[0]) if row is not None else None
+
+    def _put_static_asset(self, static_asset_dict: dict):
+        with self._lock:
+            self.connection.execute(REPLACE_STATIC_ASSET, (static_asset_dict["_id"], encode_document(static_asset_dict)))
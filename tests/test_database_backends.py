@@ -0,0 +1,265 @@
+"""Contract tests of the storage backends
+
+The same tests run against every backend: memory:// and SQLite (in a temporary
+directory) always, MongoDB if MONGO_CONNECT_STRING is set in config/config.env;
+its test database is dropped afterwards.
+
+Usage:
+    python3 -m pytest tests
+"""
+
+import sys
+import uuid
+from pathlib import Path
+from datetime import datetime, timedelta
+
+import yaml
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import config
+import database
+
+
+USER_ID = 1
+MODEL = "gpt-3.5-turbo"
+
+BACKEND_URIS = ["memory://", "sqlite:///{tmp_dir}"]
+if config.mongodb_uri is not None:
+    BACKEND_URIS.append(config.mongodb_uri)
+
+
+@pytest.fixture(params=BACKEND_URIS, ids=lambda uri: uri.split("://")[0])
+def db(request, tmp_path):
+    uri = request.param.format(tmp_dir=tmp_path)
+    db = database.open_database(database_name=f"chatgpt_telegram_bot_test_{uuid.uuid4().hex[:8]}", uri=uri)
+    db.add_new_user(USER_ID, USER_ID, username="test")
+    db.start_new_dialog(USER_ID)
+
+    yield db
+
+    if database.get_backend(uri) == "mongodb":
+        db.client.drop_database(db.db.name)
+
+
+def make_dialog_message(user_text: str, bot_text: str = "answer"):
+    return {"user": user_text, "bot": bot_text, "date": datetime.now()}
+
+
+def test_users(db):
+    assert db.check_if_user_exists(USER_ID)
+    assert not db.check_if_user_exists(USER_ID + 1)
+    with pytest.raises(ValueError):
+        db.check_if_user_exists(USER_ID + 1, raise_exception=True)
+
+    db.add_new_user(USER_ID, USER_ID, username="other")  # existing users are kept as is
+    assert db.get_user_attribute(USER_ID, "username") == "test"
+
+    db.set_user_attribute(USER_ID, "current_model", "gpt-4")
+    assert db.get_user_attributes(USER_ID, ["current_model", "missing"]) == {"current_model": "gpt-4", "missing": None}
+
+    with pytest.raises(ValueError):
+        db.set_user_attribute(USER_ID + 1, "current_model", "gpt-4")
+    with pytest.raises(ValueError):
+        db.get_user_attribute(USER_ID + 1, "current_model")
+
+
+def test_last_interaction(db):
+    last_interaction = datetime.now() + timedelta(days=1)
+    db.set_last_interaction(USER_ID, last_interaction)
+    assert db.get_last_interaction(USER_ID) == last_interaction
+
+    db.flush_last_interactions()
+    assert db.get_user_attribute(USER_ID, "last_interaction") == last_interaction
+
+    # an older buffered value doesn't overwrite a newer stored one
+    db.set_last_interaction(USER_ID, last_interaction - timedelta(days=5))
+    db.flush_last_interactions()
+    assert db.get_user_attribute(USER_ID, "last_interaction") == last_interaction
+
+
+def test_chat_modes(db):
+    default_chat_modes = db.get_chat_modes(USER_ID)
+    assert default_chat_modes == config.get_default_chat_modes()
+
+    custom_chat_mode = {"name": "Custom", "welcome_message": "Hi", "prompt_start": "You are custom.", "parse_mode": "html"}
+    db.set_chat_modes(USER_ID, default_chat_modes + [custom_chat_mode])
+    assert db.get_chat_modes(USER_ID)[-1] == custom_chat_mode
+    assert db.get_user_attribute(USER_ID, "chat_modes_version") == 1
+
+    # built-in modes stored in full are replaced by references
+    db.set_user_attribute(USER_ID, "chat_modes", config.get_default_chat_modes())
+    assert db.migrate_chat_modes_to_refs() == 1
+    assert db.get_user_attribute(USER_ID, "chat_modes") == config.get_default_chat_mode_refs()
+    assert db.migrate_chat_modes_to_refs() == 0
+
+
+def test_removed_chat_mode_keeps_positions(db, monkeypatch):
+    chat_modes = db.get_chat_modes(USER_ID)
+    removed_key = chat_modes[0]["key"]
+    db.set_user_attribute(USER_ID, "current_chat_mode_index", len(chat_modes) - 1)
+
+    with open(config.chat_modes_path) as f:
+        chat_modes_dict = yaml.safe_load(f)
+    with open(config.models_path) as f:
+        models_dict = yaml.safe_load(f)
+    del chat_modes_dict[removed_key]
+    monkeypatch.setitem(config._snapshots, config.current_bot.get(), config.build_snapshot(chat_modes_dict, models_dict))
+
+    # the removed mode is replaced in place, the current index still selects the same mode
+    resolved_chat_modes = db.get_chat_modes(USER_ID)
+    assert len(resolved_chat_modes) == len(chat_modes)
+    assert resolved_chat_modes[0]["removed"] and resolved_chat_modes[0]["key"] == removed_key
+    assert resolved_chat_modes[1:] == chat_modes[1:]
+    assert resolved_chat_modes[db.get_user_attribute(USER_ID, "current_chat_mode_index")] == chat_modes[-1]
+
+    # and its reference is kept when the list is written back
+    db.set_chat_modes(USER_ID, resolved_chat_modes)
+    assert db.get_user_attribute(USER_ID, "chat_modes")[0] == {"key": removed_key}
+
+    monkeypatch.undo()
+    assert db.get_chat_modes(USER_ID) == chat_modes
+
+
+def test_chat_mode_removed_by_reload(db, monkeypatch):
+    chat_modes = db.get_chat_modes(USER_ID)
+    removed_key = chat_modes[0]["key"]
+
+    with open(config.chat_modes_path) as f:
+        chat_modes_dict = yaml.safe_load(f)
+    with open(config.models_path) as f:
+        models_dict = yaml.safe_load(f)
+    del chat_modes_dict[removed_key]
+    snapshot = config.build_snapshot(chat_modes_dict, models_dict, version=1, previous=config.get_snapshot())
+    monkeypatch.setitem(config._snapshots, config.current_bot.get(), snapshot)
+
+    # users keep the last definition of the mode until restart, new users don't get it
+    assert db.get_chat_modes(USER_ID) == chat_modes
+    assert removed_key not in [chat_mode["key"] for chat_mode in config.get_default_chat_modes()]
+
+    # the tombstone is carried over by the next reload
+    snapshot = config.build_snapshot(chat_modes_dict, models_dict, version=2, previous=snapshot)
+    monkeypatch.setitem(config._snapshots, config.current_bot.get(), snapshot)
+    assert db.get_chat_modes(USER_ID) == chat_modes
+
+
+def test_usage(db):
+    db.update_n_used_tokens(USER_ID, MODEL, 10, 20, quota_usage={"daily": {}})
+    db.update_n_used_tokens(USER_ID, MODEL, 1, 2)
+    db.add_n_generated_images(USER_ID, 2)
+    db.add_n_transcribed_seconds(USER_ID, 30.0)
+
+    user_dict = db.get_user_attributes(USER_ID, ["n_used_tokens", "usage", "total_n_used_tokens", "quota_usage", "n_generated_images", "n_transcribed_seconds"])
+    assert user_dict["n_used_tokens"] == {"gpt-3_5-turbo": {"name": MODEL, "n_input_tokens": 11, "n_output_tokens": 22}}
+    assert user_dict["usage"]["gpt-3_5-turbo"]["n_used_tokens"] == 33
+    assert user_dict["total_n_used_tokens"] == 33
+    assert user_dict["quota_usage"] == {"daily": {}}
+    assert user_dict["n_generated_images"] == 2
+    assert user_dict["n_transcribed_seconds"] == 30.0
+
+    # running totals already exist, backfill doesn't change them
+    db.backfill_usage(USER_ID)
+    assert db.get_user_attribute(USER_ID, "total_n_used_tokens") == 33
+
+
+def test_dialog_messages(db):
+    assert db.get_dialog_messages(USER_ID) == []
+    assert db.pop_dialog_message(USER_ID) is None
+
+    db.push_dialog_message(USER_ID, make_dialog_message("first"))
+    db.push_dialog_message(USER_ID, make_dialog_message("second"))
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID)] == ["first", "second"]
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID, last_n=1)] == ["second"]
+    assert db.get_dialog_messages(USER_ID, last_n=0) == []
+    assert isinstance(db.get_dialog_messages(USER_ID)[0]["date"], datetime)
+
+    db.update_dialog_message(USER_ID, 0, make_dialog_message("first", "edited"))
+    assert db.get_dialog_messages(USER_ID)[0]["bot"] == "edited"
+
+    assert db.pop_dialog_message(USER_ID)["user"] == "second"
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID)] == ["first"]
+
+    db.set_dialog_messages(USER_ID, [make_dialog_message("replaced")])
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID)] == ["replaced"]
+
+
+def test_dialogs_of_other_users_are_not_accessible(db):
+    dialog_id = db.get_user_attribute(USER_ID, "current_dialog_id")
+    db.push_dialog_message(USER_ID, make_dialog_message("private"))
+
+    db.add_new_user(USER_ID + 1, USER_ID + 1)
+    db.push_dialog_message(USER_ID + 1, make_dialog_message("intruder"), dialog_id=dialog_id)
+    assert db.pop_dialog_message(USER_ID + 1, dialog_id=dialog_id) is None
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID)] == ["private"]
+
+
+def test_dialog_summary(db):
+    assert db.get_dialog_summary(USER_ID) == ("", 0)
+
+    db.set_dialog_summary(USER_ID, "summary", 2)
+    assert db.get_dialog_summary(USER_ID) == ("summary", 2)
+
+
+def test_recent_dialogs(db):
+    first_dialog_id = db.get_user_attribute(USER_ID, "current_dialog_id")
+    db.push_dialog_message(USER_ID, make_dialog_message("first"))
+    second_dialog_id = db.start_new_dialog(USER_ID)
+    db.push_dialog_message(USER_ID, make_dialog_message("second"))
+
+    assert [dialog_id for dialog_id, _ in db.get_recent_dialogs(USER_ID, limit=10)] == [second_dialog_id, first_dialog_id]
+    assert db.get_recent_dialogs(USER_ID, limit=1) == [(second_dialog_id, [{"user": "second", "bot": "answer"}])]
+    assert db.get_recent_dialogs(USER_ID, limit=10, exclude_dialog_id=second_dialog_id) == [(first_dialog_id, [{"user": "first", "bot": "answer"}])]
+
+
+def test_archive(db):
+    old_dialog_id = db.get_user_attribute(USER_ID, "current_dialog_id")
+    db.push_dialog_message(USER_ID, make_dialog_message("old"))
+    db.set_dialog_summary(USER_ID, "old summary", 1)
+    current_dialog_id = db.start_new_dialog(USER_ID)
+
+    # the current dialog is never archived
+    assert db.archive_old_dialogs(max_age_days=30, max_dialogs_per_user=1) == 1
+    assert db.archive_old_dialogs(max_age_days=30, max_dialogs_per_user=1) == 0
+    assert [dialog_id for dialog_id, _ in db.get_recent_dialogs(USER_ID, limit=10)] == [current_dialog_id]
+
+    # archived dialogs are still readable
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID, dialog_id=old_dialog_id)] == ["old"]
+    assert [message["user"] for message in db.get_dialog_messages(USER_ID, dialog_id=old_dialog_id, last_n=1)] == ["old"]
+    assert db.get_dialog_summary(USER_ID, dialog_id=old_dialog_id) == ("old summary", 1)
+
+    with pytest.raises(ValueError):
+        db.get_archived_dialog(USER_ID + 1, old_dialog_id)
+
+
+def test_archive_checks_active_users(db):
+    db.archive_old_dialogs(max_age_days=30, max_dialogs_per_user=1)  # the first pass checks all users
+
+    # only users active since the previous pass are checked for excess dialogs
+    db.add_new_user(USER_ID + 1, USER_ID + 1)
+    db.start_new_dialog(USER_ID + 1)
+    db.start_new_dialog(USER_ID + 1)
+    db.active_user_ids.clear()
+    assert db.archive_old_dialogs(max_age_days=30, max_dialogs_per_user=1) == 0
+
+    db.set_last_interaction(USER_ID + 1, datetime.now())
+    assert db.archive_old_dialogs(max_age_days=30, max_dialogs_per_user=1) == 1
+
+
+def test_static_assets(db):
+    assert db.get_static_asset_file_id("help.mp4", "v1") is None
+
+    db.set_static_asset_file_id("help.mp4", "v1", "file-1")
+    assert db.get_static_asset_file_id("help.mp4", "v1") == "file-1"
+    assert db.get_static_asset_file_id("help.mp4", "v2") is None
+
+    db.set_static_asset_file_id("help.mp4", "v2", "file-2")
+    assert db.get_static_asset_file_id("help.mp4", "v2") == "file-2"
+
+
+def test_incomplete_backend_is_rejected():
+    class IncompleteDatabase(database.Database):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteDatabase()